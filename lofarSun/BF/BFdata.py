@@ -3,18 +3,20 @@ import matplotlib.dates as mdates
 import matplotlib as mpl
 
 from .lofarJ2000xySun import j2000xy
+from .bflocalisation import fit_gauss_beams, localise_beams
 import datetime
 import glob
+import multiprocessing
 import os
+from collections import deque
 
 from astropy import units as u
 from astropy.io import fits
 
 import numpy as np
 from skimage import measure
-from scipy.interpolate import griddata
 from scipy.ndimage import gaussian_filter
-from scipy.interpolate import interp2d
+from scipy.interpolate import RegularGridInterpolator
 from scipy.optimize import curve_fit
 import matplotlib.pyplot as plt
 import scipy.ndimage
@@ -34,6 +36,368 @@ except:
     pass
 
 
+# interpolation of the beam intensities on an image grid,
+# the triangulation and the weights depend only on the beam positions and the grid,
+# they are computed once and every image is then a sparse matrix-vector product
+
+def _color_vertices(tri):
+    # greedy coloring of the vertices of the triangulation,
+    # two vertices of the same triangle never share a color
+    indptr, indices = tri.vertex_neighbor_vertices
+    color = -np.ones(tri.npoints, dtype=int)
+    for idx in range(tri.npoints):
+        used = set(color[indices[indptr[idx]:indptr[idx + 1]]])
+        color[idx] = min(set(range(len(used) + 1)) - used)
+    return color
+
+
+def beam_interp_weights(xb, yb, X, Y, method='cubic'):
+    """weights of the interpolation of the beams (xb, yb) on the grid (X, Y),
+    same as scipy.interpolate.griddata with the given method
+
+    Args:
+        xb, yb (array): beam positions
+        X, Y (array): grid
+        method (str, optional): 'nearest', 'linear' or 'cubic'. Defaults to 'cubic'.
+
+    Returns:
+        dict: 'matrix' (sparse [pixel, beam] or [pixel, 3 beam] for cubic, to be
+              multiplied by the values, or the values and their gradients, None for
+              cubic if this scipy does not allow it, see _clough_tocher_matrix),
+              'outside' (mask of the pixels outside the convex hull), 'shape', 'tri',
+              'xi' (the pixels inside the convex hull, for cubic)
+    """
+    from scipy.spatial import Delaunay, cKDTree
+    import scipy.sparse
+
+    points = np.column_stack((np.ravel(xb), np.ravel(yb))).astype(np.float64)
+    xi = np.column_stack((np.ravel(X), np.ravel(Y))).astype(np.float64)
+    n_pix, n_point = xi.shape[0], points.shape[0]
+
+    if method == 'nearest':
+        nearest = cKDTree(points).query(xi)[1]
+        matrix = scipy.sparse.csr_matrix((np.ones(n_pix), (np.arange(n_pix), nearest)),
+                                         shape=(n_pix, n_point))
+        return {'method': method, 'matrix': matrix, 'outside': np.zeros(n_pix, dtype=bool),
+                'shape': np.shape(X), 'tri': None, 'xi': None}
+    if method not in ['linear', 'cubic']:
+        raise ValueError("Unknown interpolation method %r" % method)
+
+    tri = Delaunay(points)
+    simplex = tri.find_simplex(xi)
+    inside = np.where(simplex >= 0)[0]
+    vertices = tri.simplices[simplex[inside]]  # [pixel, 3]
+    rows = np.repeat(inside, 3)
+
+    if method == 'linear':
+        # barycentric coordinates
+        transform = tri.transform[simplex[inside]]
+        bary = np.einsum('nij,nj->ni', transform[:, :2, :], xi[inside] - transform[:, 2, :])
+        bary = np.column_stack((bary, 1 - bary.sum(axis=1)))
+        matrix = scipy.sparse.csr_matrix((bary.ravel(), (rows, vertices.ravel())),
+                                         shape=(n_pix, n_point))
+    else:
+        matrix = _clough_tocher_matrix(tri, xi[inside], inside, vertices, n_pix)
+
+    outside = np.ones(n_pix, dtype=bool)
+    outside[inside] = False
+    return {'method': method, 'matrix': matrix, 'outside': outside,
+            'shape': np.shape(X), 'tri': tri, 'xi': xi[inside] if method == 'cubic' else None}
+
+
+def _clough_tocher_matrix(tri, xi, inside, vertices, n_pix):
+    # the Clough-Tocher interpolant is linear in the values and the gradients
+    # of the 3 vertices of the triangle, the coefficients are found with one
+    # evaluation per vertex color (value, d/dx, d/dy) as no triangle has
+    # two vertices of the same color.
+    # scipy has no public way to give the gradients to CloughTocher2DInterpolator,
+    # they are set through its grad attribute, and the matrix is checked against
+    # the public interpolator; None (direct interpolation of every image in
+    # beam_interp_apply) if the attribute is missing or does not give the same images
+    from scipy.interpolate import CloughTocher2DInterpolator
+    import scipy.sparse
+
+    n_point = tri.points.shape[0]
+    color = _color_vertices(tri)
+    n_color = color.max() + 1
+    basis = np.zeros((n_point, 3 * n_color))
+    basis[np.arange(n_point), 3 * color] = 1
+    grad = np.zeros((n_point, 3 * n_color, 2))
+    grad[np.arange(n_point), 3 * color + 1, 0] = 1
+    grad[np.arange(n_point), 3 * color + 2, 1] = 1
+    interp = CloughTocher2DInterpolator(tri, basis)
+    if getattr(interp, 'grad', None) is None or np.shape(interp.grad) != grad.shape:
+        return None
+    try:
+        interp.grad = grad
+        coeff = interp(xi)  # [pixel, 3 n_color]
+    except (AttributeError, TypeError, ValueError):
+        return None
+    rows = np.repeat(inside, 3)
+    vertex_color = color[vertices]
+    matrix = scipy.sparse.hstack([
+        scipy.sparse.csr_matrix(
+            (np.take_along_axis(coeff, 3 * vertex_color + comp, axis=1).ravel(),
+             (rows, vertices.ravel())), shape=(n_pix, n_point))
+        for comp in range(3)]).tocsr()
+
+    values = np.random.default_rng(0).random(n_point)
+    grad_values = beam_interp_gradients(tri, values)
+    if grad_values is None:
+        return None
+    image = matrix[inside] @ np.concatenate((values, grad_values[:, 0], grad_values[:, 1]))
+    if not np.allclose(image, CloughTocher2DInterpolator(tri, values)(xi), rtol=1e-9, atol=1e-12):
+        return None
+    return matrix
+
+
+def beam_interp_gradients(tri, values):
+    """gradients at the beams of the Clough-Tocher interpolation, as estimated by griddata
+
+    Args:
+        tri (Delaunay or array): triangulation of the beams, or the beam positions [beam, 2]
+        values (array): value of each beam [beam] or [beam, frame]
+
+    Returns:
+        array: gradients [beam, 2] or [beam, frame, 2], None if the interpolator
+               of this scipy does not expose them (grad is not a public attribute)
+    """
+    from scipy.spatial import Delaunay
+    from scipy.interpolate import CloughTocher2DInterpolator
+
+    if not isinstance(tri, Delaunay):
+        tri = Delaunay(np.asarray(tri, dtype=np.float64))
+    values = np.asarray(values, dtype=np.float64)
+    grad = getattr(CloughTocher2DInterpolator(tri, values), 'grad', None)
+    if grad is None or np.size(grad) != 2 * values.size:
+        return None
+    return np.reshape(grad, values.shape + (2,))
+
+
+def beam_interp_apply(weights, values, fill_value=np.nan, grad=None):
+    """interpolate the beam values with the weights from beam_interp_weights
+
+    Args:
+        weights (dict): output of beam_interp_weights
+        values (array): value of each beam [beam], or of many frames [beam, frame]
+        fill_value (float or array, optional): value outside the convex hull,
+            one per frame for many frames. Defaults to nan.
+        grad (array, optional): gradients from beam_interp_gradients for 'cubic',
+            estimated here if None. Defaults to None.
+
+    Returns:
+        array: image of the shape of the grid, or [frame, grid shape] for many frames
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if weights['matrix'] is None:
+        # cubic without the weights, see _clough_tocher_matrix
+        from scipy.interpolate import CloughTocher2DInterpolator
+        image = np.empty((weights['outside'].shape[0],) + values.shape[1:])
+        image[~weights['outside']] = CloughTocher2DInterpolator(weights['tri'], values)(weights['xi'])
+    else:
+        if weights['method'] == 'cubic':
+            if grad is None:
+                grad = beam_interp_gradients(weights['tri'], values)
+            values = np.concatenate((values, grad[..., 0], grad[..., 1]), axis=0)
+        image = weights['matrix'] @ values
+    image[weights['outside']] = fill_value
+    if image.ndim == 1:
+        return image.reshape(weights['shape'])
+    return image.T.reshape((image.shape[1],) + tuple(weights['shape']))
+
+
+class _ImageCubeWriter:
+    # write a cube of images [freq, time, y, x] chunk by chunk to .npy, .h5/.hdf5 or .fits,
+    # the images come in the C order of (freq, time)
+
+    def __init__(self, out, shape, dtype, x, y, freqs, times, xb, yb, title=''):
+        self.out = out
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.n_written = 0
+        self.ext = os.path.splitext(out)[1].lower()
+        self.axes = {'x': x, 'y': y, 'freq': freqs, 'time': times, 'xb': xb, 'yb': yb}
+        if self.ext == '.npy':
+            self.data = np.lib.format.open_memmap(out, mode='w+', dtype=self.dtype, shape=self.shape)
+        elif self.ext in ['.h5', '.hdf5']:
+            import h5py
+            self.file = h5py.File(out, 'w')
+            self.data = self.file.create_dataset('cube', shape=self.shape, dtype=self.dtype,
+                                                 chunks=(1, 1) + self.shape[2:])
+            for key, value in self.axes.items():
+                self.file.create_dataset(key, data=np.asarray(value))
+            self.file['cube'].attrs['title'] = title
+        elif self.ext in ['.fits', '.fit']:
+            if os.path.exists(out):
+                os.remove(out)
+            header = fits.PrimaryHDU().header
+            header['BITPIX'] = -32 if self.dtype.itemsize == 4 else -64
+            header['NAXIS'] = 4
+            header['NAXIS1'] = self.shape[3]
+            header['NAXIS2'] = self.shape[2]
+            header['NAXIS3'] = self.shape[1]
+            header['NAXIS4'] = self.shape[0]
+            header['EXTEND'] = True
+            header['TELESCOP'] = "LOFAR"
+            header['OBJECT'] = "Sun"
+            header['TITLE'] = title
+            header['CTYPE1'] = 'SOLAR-X'
+            header['CUNIT1'] = 'arcsec'
+            header['CRPIX1'] = 1
+            header['CRVAL1'] = float(x[0])
+            header['CDELT1'] = float(x[1] - x[0]) if len(x) > 1 else 1.
+            header['CTYPE2'] = 'SOLAR-Y'
+            header['CUNIT2'] = 'arcsec'
+            header['CRPIX2'] = 1
+            header['CRVAL2'] = float(y[0])
+            header['CDELT2'] = float(y[1] - y[0]) if len(y) > 1 else 1.
+            header['CTYPE3'] = 'TIME'
+            header['CTYPE4'] = 'FREQ'
+            self.data = fits.StreamingHDU(out, header)
+            self.fits_dtype = '>f4' if self.dtype.itemsize == 4 else '>f8'
+        else:
+            raise ValueError('Unknown output format ' + out + ', use .npy, .h5, .hdf5 or .fits')
+
+    def write(self, block):
+        n_frame = block.shape[0]
+        if self.ext == '.fits' or self.ext == '.fit':
+            self.data.write(np.asarray(block, dtype=self.fits_dtype))
+        elif self.ext == '.npy':
+            self.data.reshape((-1,) + self.shape[2:])[self.n_written:self.n_written + n_frame] = block
+        else:
+            for idx in range(n_frame):
+                self.data[np.unravel_index(self.n_written + idx, self.shape[:2])] = block[idx]
+        self.n_written += n_frame
+
+    def close(self):
+        if self.ext == '.npy':
+            self.data.flush()
+            del self.data
+        elif self.ext in ['.h5', '.hdf5']:
+            self.file.close()
+        else:
+            self.data.close()
+            col_f = fits.Column(name='FREQ', array=self.axes['freq'], format="D")
+            col_t = fits.Column(name='TIME', array=self.axes['time'], format="D")
+            col_x = fits.Column(name='X', array=self.axes['xb'], format="D")
+            col_y = fits.Column(name='Y', array=self.axes['yb'], format="D")
+            for hdu in [fits.BinTableHDU.from_columns([col_f], name="FREQ"),
+                        fits.BinTableHDU.from_columns([col_t], name="TIME"),
+                        fits.BinTableHDU.from_columns([col_x, col_y], name="BeamXY")]:
+                fits.append(self.out, hdu.data, hdu.header)
+
+
+def beam_major_h5_name(fname):
+    """default name of the beam-major HDF5 copy of the FITS cube fname"""
+    return os.path.splitext(fname)[0] + '.beams.h5'
+
+
+def fits_to_beam_major(fname, fname_h5=None, t_block=256, chunk_ft=(256, 256)):
+    """copy the [freq, time, beam] cube of a FITS file to a beam-major HDF5 dataset
+    'cube' [beam, freq, time], chunked so that the dynamic spectrum of one beam
+    is read without touching the other beams, the FITS file is read t_block times
+    at once through a memory map
+
+    Args:
+        fname (str): FITS cube (as written by h5_to_fits_cube)
+        fname_h5 (str, optional): output file. Defaults to beam_major_h5_name(fname).
+        t_block (int, optional): number of times read at once. Defaults to 256.
+        chunk_ft (tuple, optional): (freq, time) size of the HDF5 chunks. Defaults to (256, 256).
+
+    Returns:
+        str: name of the HDF5 file
+    """
+    import h5py
+    if fname_h5 is None:
+        fname_h5 = beam_major_h5_name(fname)
+    with fits.open(fname, memmap=True) as hdul:
+        data = hdul[0].data
+        n_f, n_t, n_b = data.shape
+        chunks = (1, min(chunk_ft[0], n_f), min(chunk_ft[1], n_t))
+        fname_tmp = fname_h5 + '.tmp'
+        with h5py.File(fname_tmp, 'w') as f_h5:
+            cube = f_h5.create_dataset('cube', shape=(n_b, n_f, n_t), dtype=data.dtype.newbyteorder('='),
+                                       chunks=chunks)
+            for t_start in range(0, n_t, t_block):
+                block = np.asarray(data[:, t_start:t_start + t_block, :])
+                cube[:, :, t_start:t_start + t_block] = np.transpose(block, (2, 0, 1))
+            stat = os.stat(fname)
+            cube.attrs['source'] = os.path.abspath(fname)
+            cube.attrs['source_mtime'] = stat.st_mtime
+            cube.attrs['source_size'] = stat.st_size
+    os.replace(fname_tmp, fname_h5)
+    return fname_h5
+
+
+def _beam_major_is_current(fname, fname_h5):
+    # the beam-major copy exists and was made from the current fname
+    import h5py
+    if not os.path.exists(fname_h5):
+        return False
+    stat = os.stat(fname)
+    try:
+        with h5py.File(fname_h5, 'r') as f_h5:
+            attrs = f_h5['cube'].attrs
+            return attrs['source_mtime'] == stat.st_mtime and attrs['source_size'] == stat.st_size
+    except (OSError, KeyError):
+        return False
+
+
+class LazyBFcube:
+    """[freq, time, beam] cube of a FITS file read on demand, used as BFcube.data_cube
+    by BFcube.load_fits(memmap=True)
+
+    Indexing reads only the requested part: the images (one beam vector per
+    (freq, time)) come from the memory map of the FITS file, where the beams are
+    contiguous, the dynamic spectrum of one beam comes from the beam-major HDF5
+    copy when there is one (see fits_to_beam_major) and from the memory map otherwise.
+    np.asarray(cube) loads the whole cube.
+
+    Args:
+        data (array): memory map of the FITS data [freq, time, beam]
+        beam_major (h5py.Dataset, optional): the same data [beam, freq, time]
+    """
+
+    def __init__(self, data, beam_major=None):
+        self.data = data
+        self.beam_major = beam_major
+        self.shape = data.shape
+        self.dtype = data.dtype
+        self.ndim = data.ndim
+        self.size = data.size
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if self.beam_major is not None and len(key) == 3 and self._beam_key(key):
+            return self.beam_major[key[2], key[0], key[1]]
+        return np.asarray(self.data[key])
+
+    @staticmethod
+    def _beam_key(key):
+        # a single beam with (freq, time) slices or integers, which h5py reads directly
+        if not isinstance(key[2], (int, np.integer)):
+            return False
+        for item in key[:2]:
+            if isinstance(item, slice):
+                if item.step is not None and item.step < 1:
+                    return False
+            elif not isinstance(item, (int, np.integer)):
+                return False
+        return True
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.data[...], dtype=dtype)
+
+    def close(self):
+        if self.beam_major is not None:
+            self.beam_major.file.close()
+            self.beam_major = None
+
+
 class BFcube:
     def __init__(self):
         self.fname = ''
@@ -44,6 +408,9 @@ class BFcube:
         self.time_ds = 0
         self.xb = 0
         self.yb = 0
+        self.xb_track = None
+        self.yb_track = None
+        self._interp_cache = {}
 
     def load_sav_xy(self, fname, header_name='ds'):
         self.fname = fname
@@ -57,8 +424,12 @@ class BFcube:
             24 + mdates.date2num(datetime.datetime(1979, 1, 1))
         self.xb = data[header_name][0]['XB']
         self.yb = data[header_name][0]['YB']
+        self.xb_track, self.yb_track = None, None
+        self._interp_cache = {}
 
-    def load_sav_radec(self, fname, header_name='cube_ds'):
+    def load_sav_radec(self, fname, header_name='cube_ds', track=False):
+        # track: also compute the beam positions at every time of the cube,
+        # in xb_track, yb_track [beam, time], xb, yb are at the first time
         self.fname = fname
         self.havedata = True
         data = readsav(fname, python_dict=True)
@@ -73,39 +444,82 @@ class BFcube:
         dec_beam = data[header_name][0]['DEC']
         [self.xb, self.yb] = j2000xy(
             ra_beam, dec_beam, mdates.num2date(self.time_ds[0]))
-
-    def load_fits(self, fname):
+        self.xb_track, self.yb_track = None, None
+        self._interp_cache = {}
+        if track:
+            t_beam = np.array(mdates.num2date(self.time_ds))
+            [self.xb_track, self.yb_track] = j2000xy(
+                np.asarray(ra_beam)[:, None], np.asarray(dec_beam)[:, None], t_beam[None, :])
+
+    def load_fits(self, fname, memmap=False, beam_major=False):
         # fits cube file
+        # memmap: keep the cube on disk, data_cube is then a LazyBFcube which reads
+        #   only the indexed part, e.g. one image or the dynamic spectrum of one beam
+        # beam_major: with memmap, also use a beam-major HDF5 copy of the cube for the
+        #   dynamic spectra of single beams, made on the first open (True for
+        #   beam_major_h5_name(fname), or the name of the HDF5 file)
         self.fname = fname
         self.havedata = True
 
-        hdu = fits.open(fname)
+        if isinstance(self.data_cube, LazyBFcube):
+            self.data_cube.close()
         self.title = 'LOFAR BFcube'
-        self.data_cube = hdu[0].data
+        if memmap:
+            hdu = fits.open(fname, memmap=True)
+            cube_beam_major = None
+            if beam_major:
+                import h5py
+                fname_h5 = beam_major_h5_name(fname) if beam_major is True else beam_major
+                if not _beam_major_is_current(fname, fname_h5):
+                    fits_to_beam_major(fname, fname_h5)
+                cube_beam_major = h5py.File(fname_h5, 'r')['cube']
+            self.data_cube = LazyBFcube(hdu[0].data, cube_beam_major)
+        else:
+            hdu = fits.open(fname)
+            self.data_cube = hdu[0].data
         self.freqs_ds = hdu[1].data['FREQ'][:]
         self.time_ds = hdu[2].data['TIME'][:]
         self.xb = hdu[3].data['X']
         self.yb = hdu[3].data['Y']
-
-    def bf_image_by_idx(self, f_idx, t_idx, fov=3000, asecpix=20, extrap=True, interpm='cubic'):
-        data_beam = self.data_cube[f_idx, t_idx, :]
+        self.xb_track, self.yb_track = None, None
+        self._interp_cache = {}
+
+    def bf_image_weights(self, fov=3000, asecpix=20, extrap=True, interpm='cubic'):
+        # grid and interpolation weights of the images, cached per (fov, asecpix, extrap, interpm),
+        # recomputed if the beam positions changed
+        key = (fov, asecpix, extrap, interpm)
+        cached = self._interp_cache.get(key)
+        if (cached is not None and np.array_equal(cached['xb'], self.xb)
+                and np.array_equal(cached['yb'], self.yb)):
+            return cached
         x = np.arange(-fov, fov, asecpix)
         y = np.arange(-fov, fov, asecpix)
         X, Y = np.meshgrid(x, y)
-        method = interpm
         if extrap:
             r = 1.5*np.max(np.sqrt(self.xb**2+self.yb**2))
             theta = np.linspace(0, 2*np.pi, 36)
             bf_xb = np.hstack((self.xb, r*np.cos(theta)))
             bf_yb = np.hstack((self.yb, r*np.sin(theta)))
-            data_beam_bf = np.hstack(
-                (data_beam, np.ones(np.size(theta))*np.median(data_beam)))-np.min(data_beam)
         else:
             bf_xb = self.xb
             bf_yb = self.yb
+        cached = {'xb': np.array(self.xb, copy=True), 'yb': np.array(self.yb, copy=True),
+                  'X': X, 'Y': Y, 'x': x, 'y': y,
+                  'weights': beam_interp_weights(bf_xb, bf_yb, X, Y, method=interpm)}
+        self._interp_cache[key] = cached
+        return cached
+
+    def bf_image_by_idx(self, f_idx, t_idx, fov=3000, asecpix=20, extrap=True, interpm='cubic'):
+        data_beam = self.data_cube[f_idx, t_idx, :]
+        cached = self.bf_image_weights(fov, asecpix, extrap, interpm)
+        X, Y, x, y = cached['X'], cached['Y'], cached['x'], cached['y']
+        if extrap:
+            data_beam_bf = np.hstack(
+                (data_beam, np.ones(36)*np.median(data_beam)))-np.min(data_beam)
+        else:
             data_beam_bf = data_beam-np.min(data_beam)
-        data_bf = griddata((bf_xb, bf_yb), data_beam_bf,
-                           (X, Y), method=method, fill_value=np.median(data_beam)-np.min(data_beam))
+        data_bf = beam_interp_apply(cached['weights'], data_beam_bf,
+                                    fill_value=np.median(data_beam)-np.min(data_beam))
         Ibeam = data_beam
         return X, Y, data_bf, x, y, Ibeam
 
@@ -118,6 +532,83 @@ class BFcube:
             f_idx_select, t_idx_select, fov=fov, asecpix=asecpix, extrap=extrap, interpm=interpm)
         return [X, Y, data_bf, x, y, Ibeam]
 
+    def bf_image_cube(self, f_idx, t_idx, fov=3000, asecpix=20, extrap=True, interpm='cubic',
+                      out=None, chunk_size=64, workers=1, dtype=np.float32):
+        """images of all the (freq, time) pairs of f_idx x t_idx, as bf_image_by_idx,
+        each chunk of images is one sparse matrix product with the beam values
+
+        Args:
+            f_idx, t_idx (int, slice or array): indices of the frequencies and of the times
+            fov, asecpix, extrap, interpm: as in bf_image_by_idx
+            out (str, optional): .npy, .h5/.hdf5 or .fits file to write the cube to,
+                chunk by chunk, None to return the cube. Defaults to None.
+            chunk_size (int, optional): number of images per chunk. Defaults to 64.
+            workers (int, optional): number of processes to estimate the gradients
+                of the chunks for the 'cubic' method. Defaults to 1.
+            dtype (optional): data type of the images. Defaults to np.float32.
+
+        Returns:
+            list: [x, y, cube [freq, time, y, x]], or [x, y, out] when written to out
+        """
+        f_list = np.atleast_1d(np.arange(self.data_cube.shape[0])[f_idx])
+        t_list = np.atleast_1d(np.arange(self.data_cube.shape[1])[t_idx])
+        cached = self.bf_image_weights(fov, asecpix, extrap, interpm)
+        weights, x, y = cached['weights'], cached['x'], cached['y']
+        shape = (len(f_list), len(t_list)) + tuple(weights['shape'])
+
+        frames = np.arange(len(f_list) * len(t_list))
+        chunks = [frames[idx:idx + chunk_size] for idx in range(0, len(frames), chunk_size)]
+
+        def chunk_values(chunk):
+            data_beam = self.data_cube[f_list[chunk // len(t_list)], t_list[chunk % len(t_list)], :].T
+            beam_median = np.median(data_beam, axis=0)
+            beam_min = np.min(data_beam, axis=0)
+            if extrap:
+                data_beam = np.vstack((data_beam, np.ones((36, data_beam.shape[1]))*beam_median))
+            return data_beam - beam_min, beam_median - beam_min
+
+        if out is None:
+            cube = np.zeros(shape, dtype=dtype)
+            writer = None
+        else:
+            writer = _ImageCubeWriter(out, shape, dtype, x, y, self.freqs_ds[f_list],
+                                      self.time_ds[t_list], self.xb, self.yb, self.title)
+
+        pool = None
+        try:
+            # the gradients are only used with the cached cubic matrix
+            if interpm == 'cubic' and weights['matrix'] is not None and workers > 1 and len(chunks) > 1:
+                from concurrent.futures import ProcessPoolExecutor
+                pool = ProcessPoolExecutor(max_workers=workers,
+                                           mp_context=multiprocessing.get_context('spawn'))
+
+                def chunk_grads():
+                    # a few chunks ahead of the product, not the values of the whole cube at once
+                    pending = deque()
+                    for chunk in chunks:
+                        pending.append(pool.submit(beam_interp_gradients, weights['tri'].points,
+                                                   chunk_values(chunk)[0]))
+                        if len(pending) > 2 * workers:
+                            yield pending.popleft().result()
+                    while pending:
+                        yield pending.popleft().result()
+                grads = chunk_grads()
+            else:
+                grads = [None] * len(chunks)
+            for chunk, grad in zip(chunks, grads):
+                values, fill_value = chunk_values(chunk)
+                images = beam_interp_apply(weights, values, fill_value, grad=grad).astype(dtype)
+                if writer is None:
+                    cube.reshape((-1,) + shape[2:])[chunk] = images
+                else:
+                    writer.write(images)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            if writer is not None:
+                writer.close()
+        return [x, y, cube if out is None else out]
+
     def bf_time_to_idx(self, time):
         return (np.abs(self.time_ds - time)).argmin()
 
@@ -133,11 +624,11 @@ class BFcube:
         x_peak = X[np.where(data_bf == np.max(data_bf))]
         y_peak = Y[np.where(data_bf == np.max(data_bf))]
         rg_id = bw_lb[np.where(data_bf == np.max(data_bf))]
-        area_peak = rg_lb[int(rg_id)-1].area
+        area_peak = rg_lb[int(rg_id[0])-1].area
 
         return x_peak, y_peak, area_peak
 
-    def bf_fit_gauss_source_by_idx(self, f_idx, t_idx, drawfig=True, verb=True):
+    def bf_fit_gauss_source_by_idx(self, f_idx, t_idx, drawfig=True, verb=True, fname_fig='test.pdf'):
         X, Y, data_bf, x, y, Ibeam = self.bf_image_by_idx(f_idx, t_idx)
         # np.min(data_bf)+(np.max(data_bf)-np.min(data_bf))/2.0
         FWHM_thresh = np.max(data_bf)*0.7
@@ -147,7 +638,7 @@ class BFcube:
         x_peak = X[np.where(data_bf == np.max(data_bf))]
         y_peak = Y[np.where(data_bf == np.max(data_bf))]
         rg_id = bw_lb[np.where(data_bf == np.max(data_bf))]
-        area_peak = rg_lb[int(rg_id)-1].area
+        area_peak = rg_lb[int(rg_id[0])-1].area
         bw_peak_area = (np.array(abs(bw_lb-rg_id) < 0.1)*255).astype(np.uint8)
 
         dilate_size = int(x.size/30)
@@ -157,9 +648,10 @@ class BFcube:
             bw_peak_area, structure=kernel, iterations=1)
         # imdilate = cv2.dilate(bw_peak_area,kernel,iterations = 1)
 
-        fbeams = interp2d(x, y, imdilate, kind='linear')
-        peaks_in = np.array([fbeams(self.xb[tmp_id], self.yb[tmp_id])
-                            for tmp_id in range(len(self.xb))]).reshape(-1)
+        # the dilated region at the beams, linear interpolation on the image grid
+        fbeams = RegularGridInterpolator((y, x), imdilate.astype(float),
+                                         bounds_error=False, fill_value=None)
+        peaks_in = fbeams(np.column_stack((self.yb, self.xb)))
 
         fit_xb = self.xb[peaks_in > 0.5]
         fit_yb = self.yb[peaks_in > 0.5]
@@ -209,13 +701,66 @@ class BFcube:
             ax.plot(fit_xb, fit_yb, 'b+')
             ax.plot(tmp_x, tmp_y, 'k-')
             ax.plot(bf_res["x_cent"], bf_res["y_cent"], "k+")
-            plt.savefig('test.pdf')
+            if fname_fig is not None:
+                plt.savefig(fname_fig)
         if verb:
             print(mdates.num2date(self.time_ds[t_idx]))
             print(self.freqs_ds[f_idx])
 
         return bf_res, bf_err
 
+    def bf_fit_gauss_sources(self, f_idx, t_idx, thresh=0.7, dilate=1, workers=1, chunk_size=256):
+        """fit a 2D Gaussian source for every (freq, time) pair of f_idx x t_idx,
+        on the beam intensities of the peak region, see fit_gauss_beams
+
+        Args:
+            f_idx, t_idx (int, slice or array): indices of the frequencies and of the times
+            thresh (float, optional): relative threshold of the peak region. Defaults to 0.7.
+            dilate (int, optional): rings of neighbor beams added to the peak region. Defaults to 1.
+            workers (int, optional): number of processes. Defaults to 1.
+            chunk_size (int, optional): number of fits processed at once, and per task
+                of the pool. Defaults to 256.
+
+        Returns:
+            structured array: gauss_fit_dtype records [freq, time]
+        """
+        f_list = np.atleast_1d(np.arange(self.data_cube.shape[0])[f_idx])
+        t_list = np.atleast_1d(np.arange(self.data_cube.shape[1])[t_idx])
+        f_grid, t_grid = np.meshgrid(f_list, t_list, indexing='ij')
+        Ibeams = self.data_cube[f_grid.ravel(), t_grid.ravel(), :]
+
+        res = fit_gauss_beams(self.xb, self.yb, Ibeams, thresh, dilate,
+                              chunk_size=chunk_size, workers=workers)
+        res['f_idx'] = f_grid.ravel()
+        res['t_idx'] = t_grid.ravel()
+        return res.reshape(f_grid.shape)
+
+    def bf_localise(self, f_idx, t_idx, thresh=0.7, dilate=1, workers=1, chunk_size=1024):
+        """peak, FWHM area and 2D Gaussian fit of the source for every (freq, time)
+        pair of f_idx x t_idx, on the beam intensities without the image,
+        see bflocalisation.localise_beams
+
+        Args:
+            f_idx, t_idx (int, slice or array): indices of the frequencies and of the times
+            thresh (float, optional): relative threshold of the peak region of the fit. Defaults to 0.7.
+            dilate (int, optional): rings of neighbor beams added to the peak region. Defaults to 1.
+            workers (int, optional): number of processes. Defaults to 1.
+            chunk_size (int, optional): number of pixels per task. Defaults to 1024.
+
+        Returns:
+            structured array: localise_dtype records [freq, time], e.g. res['x_cent'][f, :]
+            is the centroid track of the source at the frequency f
+        """
+        f_list = np.atleast_1d(np.arange(self.data_cube.shape[0])[f_idx])
+        t_list = np.atleast_1d(np.arange(self.data_cube.shape[1])[t_idx])
+        f_grid, t_grid = np.meshgrid(f_list, t_list, indexing='ij')
+        Ibeams = self.data_cube[f_grid.ravel(), t_grid.ravel(), :]
+
+        res = localise_beams(self.xb, self.yb, Ibeams, thresh, dilate, chunk_size, workers=workers)
+        res['f_idx'] = f_grid.ravel()
+        res['t_idx'] = t_grid.ravel()
+        return res.reshape(f_grid.shape)
+
     def plot_bf_image_by_idx(self, f_idx, t_idx):
         if True:
             X, Y, data_bf = self.bf_image_by_idx(
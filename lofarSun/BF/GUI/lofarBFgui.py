@@ -150,7 +150,7 @@ class MatplotlibWidget(QMainWindow):
         if self.dataset.fname:
             print(self.dataset.fname)
             if len(self.dataset.fname):        
-                self.dataset.load_fits(self.dataset.fname)
+                self.dataset.load_fits(self.dataset.fname, memmap=True)
                 self.mplw.canvas.axes.clear()
                 self.draw_ds_after_load()
                 self.beamSet.clear()
@@ -159,7 +159,6 @@ class MatplotlibWidget(QMainWindow):
 
 
     def draw_ds_after_load(self,idx_cur=0,conn_click=True):
-        data_ds = np.array(self.dataset.data_cube[:, :, idx_cur])
         #print(self.dataset.time_ds)
         ax_cur = self.mplw.canvas.axes
         self.dataset.plot_bf_dyspec(idx_cur,ax_cur)
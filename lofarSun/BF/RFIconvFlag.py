@@ -106,3 +106,29 @@ def init_RFIconv(net, aggressive_factor=[1.6, 1.65, 0.5, 0.5], device='cpu'):
     net.load_state_dict(state_dict)
 
     return net.to(device)
+
+
+# initialised networks, one per (aggressive_factor, device)
+_RFIconv_cache = {}
+
+
+def get_RFIconv(aggressive_factor=[1.6, 1.65, 0.5, 0.5], device='cpu'):
+    """get an initialised RFIconv flagger, the kernels are built only once
+    for each set of aggressive factors and device, and reused afterwards
+
+    Args:
+        aggressive_factor (list, optional): factor for flagging. Defaults to [1.6, 1.65, 0.5, 0.5].
+        device (str or device, optional): GPU or CPU. Defaults to 'cpu'.
+
+    Returns:
+        RFIconv: network with the flagging kernels loaded, in eval mode
+    """
+    key = (tuple(float(af) for af in aggressive_factor), str(device))
+    if key not in _RFIconv_cache:
+        net = init_RFIconv(RFIconv(device=device),
+                           aggressive_factor=aggressive_factor, device=device)
+        net.eval()
+        for param in net.parameters():
+            param.requires_grad_(False)
+        _RFIconv_cache[key] = net
+    return _RFIconv_cache[key]
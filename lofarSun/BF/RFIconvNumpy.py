@@ -0,0 +1,134 @@
+import numpy as np
+from scipy.ndimage import correlate, correlate1d
+
+
+# NumPy/SciPy version of the RFIconv flagger in RFIconvFlag,
+# same kernels and same boolean logic, without torch
+
+def _heaviside(x):
+    # torch.heaviside(x, 0), which gives 0 for NaN
+    return (x > 0).astype(np.float64)
+
+
+def _separate(kernel):
+    # [weights along axis 0, weights along axis 1] of a kernel made of identical
+    # rows or identical columns, as all the RFIconv kernels are, None otherwise
+    kernel = np.asarray(kernel, dtype=np.float64)
+    if np.all(kernel == kernel[:1, :]):
+        return [np.ones(kernel.shape[0]), kernel[0, :]]
+    if np.all(kernel == kernel[:, :1]):
+        return [kernel[:, 0], np.ones(kernel.shape[1])]
+    return None
+
+
+def _correlate_axis0(x, weights):
+    # correlate1d along axis 0 with zero padding, as a sum of shifted rows,
+    # faster than scipy along the non-contiguous axis
+    res = np.zeros(x.shape, dtype=np.float64)
+    half, num = len(weights) // 2, x.shape[0]
+    for idx, weight in enumerate(weights):
+        shift = idx - half
+        if weight == 0 or abs(shift) >= num:
+            continue
+        src = x[max(shift, 0):num + min(shift, 0)]
+        dst = res[max(-shift, 0):num - max(shift, 0)]
+        if weight == 1:
+            dst += src
+        else:
+            dst += weight * src
+    return res
+
+
+def _conv(x, kernel):
+    # same as a torch conv2d with 'same' zero padding (cross-correlation),
+    # all the RFIconv kernels are rank-1 and done as two 1D passes
+    weights = _separate(kernel)
+    if weights is None:
+        return correlate(x, kernel, mode='constant', cval=0.0, output=np.float64)
+    res = _correlate_axis0(x, weights[0])
+    return correlate1d(res, weights[1], axis=1, mode='constant', cval=0.0, output=np.float64)
+
+
+def RFIconv_kernels(aggressive_factor=[1.6, 1.65, 0.5, 0.5]):
+    """kernels of the RFIconv flagger, as in init_RFIconv
+
+    Args:
+        aggressive_factor (list, optional): factor for flagging. Defaults to [1.6, 1.65, 0.5, 0.5].
+
+    Returns:
+        list: [3x3 kernels (transient, narrow band), 5x5 kernels (left, right, upper, lower edge)]
+    """
+    af = aggressive_factor
+    # for lines
+    kernel_vertical = np.array([
+        [-1, af[0], -1],
+        [-1, af[0], -1],
+        [-1, af[0], -1]], dtype=np.float32).T  # transient
+
+    kernel_horizontal = np.array([
+        [-1, -1, -1],
+        [af[1], af[1], af[1]],
+        [-1, -1, -1]], dtype=np.float32).T  # narrow band
+
+    kernel_left_mask = np.array([
+        [af[2], af[2], af[2], -1, -1, ],
+        [af[2], af[2], af[2], -1, -1, ],
+        [af[2], af[2], af[2], -1, -1, ],
+        [af[2], af[2], af[2], -1, -1, ],
+        [af[2], af[2], af[2], -1, -1, ]], dtype=np.float32).T  # edge
+
+    kernel_upper_mask = np.array([
+        [af[3], af[3], af[3], af[3], af[3]],
+        [af[3], af[3], af[3], af[3], af[3]],
+        [af[3], af[3], af[3], af[3], af[3]],
+        [-1, -1, -1, -1, -1, ],
+        [-1, -1, -1, -1, -1, ]], dtype=np.float32).T  # edge
+
+    kernel_right_mask = np.flipud(kernel_left_mask)  # edge
+    kernel_lower_mask = np.fliplr(kernel_upper_mask)  # edge
+
+    return ([kernel_vertical, kernel_horizontal],
+            [kernel_left_mask, kernel_right_mask, kernel_upper_mask, kernel_lower_mask])
+
+
+class RFIconvNumpy(object):
+    """RFIconv flagger with NumPy/SciPy, called on a 2D dynamic spectrum [t,f]
+    returns the boolean mask of the flagged pixels, as RFIconv does for x[None,None,:,:]
+    """
+
+    def __init__(self, aggressive_factor=[1.6, 1.65, 0.5, 0.5]):
+        kernel3, kernel5 = RFIconv_kernels(aggressive_factor)
+        self.kernel3 = kernel3
+        self.kernel5 = kernel5
+        self.kernel3_bool = [(kernel > 0) * 1.0 for kernel in kernel3]
+        self.kernel5_bool = [(kernel > 0) * 1.0 for kernel in kernel5]
+        self.kernel_extend = np.ones([5, 5])
+
+    def __call__(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        c3 = [_heaviside(_conv(x, kernel)) for kernel in self.kernel3]
+        # the 3x3 detections extended to 5x5, one for each pair of edge kernels
+        c3_extend = [_heaviside(_conv(c3_mask, self.kernel_extend)) for c3_mask in c3]
+        y = (sum(_conv(c3_mask, kernel) for c3_mask, kernel in zip(c3, self.kernel3_bool))
+             + sum(_conv(_heaviside(_heaviside(_conv(x, kernel)) - c3_extend[idx // 2]), kernel_bool)
+                   for idx, (kernel, kernel_bool) in enumerate(zip(self.kernel5, self.kernel5_bool))))
+        return y > 1e-7
+
+
+# initialised flaggers, one per aggressive_factor
+_RFIconvNumpy_cache = {}
+
+
+def get_RFIconv_numpy(aggressive_factor=[1.6, 1.65, 0.5, 0.5]):
+    """get a RFIconvNumpy flagger, the kernels are built only once for each set of aggressive factors
+
+    Args:
+        aggressive_factor (list, optional): factor for flagging. Defaults to [1.6, 1.65, 0.5, 0.5].
+
+    Returns:
+        RFIconvNumpy: flagger
+    """
+    key = tuple(float(af) for af in aggressive_factor)
+    if key not in _RFIconvNumpy_cache:
+        _RFIconvNumpy_cache[key] = RFIconvNumpy(aggressive_factor)
+    return _RFIconvNumpy_cache[key]
@@ -1,4 +1,20 @@
-from .BFdata import BFcube
-from . import GUI
-from . import bftools
-from . import RFIconvFlag
\ No newline at end of file
+import importlib as _importlib
+
+# the submodules pull in heavy dependencies (sunpy, skimage, h5py, PyQt5, torch),
+# they are imported on first access only, e.g. lofarSun.BF.bftools
+_submodules = ['BFdata', 'GUI', 'bftools', 'RFIconvFlag', 'RFIconvNumpy', 'lofarJ2000xySun',
+               'bflocalisation']
+_attributes = {'BFcube': 'BFdata'}
+__all__ = _submodules + list(_attributes)
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return _importlib.import_module('.' + name, __name__)
+    if name in _attributes:
+        return getattr(_importlib.import_module('.' + _attributes[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + _submodules + list(_attributes))
@@ -0,0 +1,501 @@
+"""
+Source localisation on the tied-array beam samples
+
+The peak, the FWHM area and the 2D Gaussian fit are computed directly on the
+scattered beam samples (xb, yb, I), without interpolating an image, and are
+vectorised over many (freq, time) pixels: the beam intensities are given as
+Ibeams [pixel, beam].
+
+The neighbors of the beams come from the Delaunay triangulation of the beam
+positions, which stands in for the image grid: the peak region is the set of
+beams above the threshold connected to the brightest beam, the FWHM area is
+the area of the triangles (linear interpolation) above half of the maximum
+connected to the brightest beam, in arcsec^2.
+"""
+
+import numpy as np
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import Delaunay
+
+
+gauss_fit_dtype = np.dtype([('f_idx', int), ('t_idx', int), ('n_beam', int), ('success', bool),
+                            ('s0', float), ('x_cent', float), ('y_cent', float),
+                            ('tile', float), ('x_sig', float), ('y_sig', float),
+                            ('s0_err', float), ('x_cent_err', float), ('y_cent_err', float),
+                            ('tile_err', float), ('x_sig_err', float), ('y_sig_err', float)])
+gauss_fit_params = ['s0', 'x_cent', 'y_cent', 'tile', 'x_sig', 'y_sig']
+
+localise_dtype = np.dtype([('f_idx', int), ('t_idx', int),
+                           ('peak_x', float), ('peak_y', float), ('peak_I', float),
+                           ('peak_beam', int), ('fwhm_area', float)]
+                          + [(name, gauss_fit_dtype[name]) for name in gauss_fit_dtype.names[2:]])
+
+
+def gauss2d_beam(params, xb, yb):
+    """2D Gaussian [s0, x_cent, y_cent, tile, x_sig, y_sig] at the beams (xb, yb),
+    as func_gaussian in BFcube.bf_fit_gauss_source_by_idx, params can be [6, pixel, 1]
+    for many pixels"""
+    s0, x_cent, y_cent, tile, x_sig, y_sig = params
+    xp = (xb-x_cent) * np.cos(tile) - (yb-y_cent) * np.sin(tile)
+    yp = (xb-x_cent) * np.sin(tile) + (yb-y_cent) * np.cos(tile)
+    return s0 * np.exp(-(xp**2)/(2*x_sig**2) - (yp**2)/(2*y_sig**2))
+
+
+def gauss2d_beam_jac(params, xb, yb):
+    """analytic Jacobian [beam, param] of gauss2d_beam, [pixel, beam, param] for many pixels"""
+    s0, x_cent, y_cent, tile, x_sig, y_sig = params
+    cos_t, sin_t = np.cos(tile), np.sin(tile)
+    xp = (xb-x_cent) * cos_t - (yb-y_cent) * sin_t
+    yp = (xb-x_cent) * sin_t + (yb-y_cent) * cos_t
+    expo = np.exp(-(xp**2)/(2*x_sig**2) - (yp**2)/(2*y_sig**2))
+    flux = s0 * expo
+    ax, ay = xp / x_sig**2, yp / y_sig**2
+    return np.stack((expo,
+                     flux * (ax*cos_t + ay*sin_t),
+                     flux * (-ax*sin_t + ay*cos_t),
+                     flux * xp * yp * (1/x_sig**2 - 1/y_sig**2),
+                     flux * xp**2 / x_sig**3,
+                     flux * yp**2 / y_sig**3), axis=-1)
+
+
+class BeamGeometry:
+    """triangulation and neighbors of the beams, shared by all the localisation functions
+
+    Args:
+        xb, yb (array): beam positions (arcsec)
+    """
+
+    def __init__(self, xb, yb):
+        self.xb = np.asarray(xb, dtype=np.float64).ravel()
+        self.yb = np.asarray(yb, dtype=np.float64).ravel()
+        self.n_beam = len(self.xb)
+        self.tri = Delaunay(np.column_stack((self.xb, self.yb)))
+        indptr, indices = self.tri.vertex_neighbor_vertices
+        self.neighbors = (indptr, indices)
+        self.adjacency = scipy.sparse.csr_matrix(
+            (np.ones(len(indices)), indices, indptr), shape=(self.n_beam, self.n_beam))
+        # triangle areas and adjacency
+        corners = self.tri.points[self.tri.simplices]
+        self.tri_area = 0.5 * np.abs(
+            (corners[:, 1, 0] - corners[:, 0, 0]) * (corners[:, 2, 1] - corners[:, 0, 1])
+            - (corners[:, 2, 0] - corners[:, 0, 0]) * (corners[:, 1, 1] - corners[:, 0, 1]))
+        n_tri = len(self.tri.simplices)
+        rows = np.repeat(np.arange(n_tri), 3)
+        cols = self.tri.neighbors.ravel()
+        self.tri_adjacency = scipy.sparse.csr_matrix(
+            (np.ones(np.sum(cols >= 0)), (rows[cols >= 0], cols[cols >= 0])), shape=(n_tri, n_tri))
+        self._quad = None
+
+    def quad_fit_matrices(self):
+        # per beam: the beams around it and the least squares matrix of a quadratic
+        # surface through them, in coordinates relative to the beam
+        if self._quad is None:
+            indptr, indices = self.neighbors
+            self._quad = []
+            for idx in range(self.n_beam):
+                local = np.concatenate(([idx], indices[indptr[idx]:indptr[idx + 1]]))
+                if len(local) < 6:
+                    # not enough neighbors, add the second ring
+                    ring2 = np.concatenate([indices[indptr[nb]:indptr[nb + 1]] for nb in local])
+                    local = np.unique(np.concatenate((local, ring2)))
+                    local = np.concatenate(([idx], local[local != idx]))
+                dx, dy = self.xb[local] - self.xb[idx], self.yb[local] - self.yb[idx]
+                scale = max(np.max(np.hypot(dx, dy)), 1e-12)
+                u, v = dx / scale, dy / scale
+                design = np.column_stack((np.ones_like(u), u, v, u**2, u*v, v**2))
+                self._quad.append((local, np.linalg.pinv(design), scale))
+        return self._quad
+
+
+def _peak_component(active, adjacency, seed):
+    # mask [pixel, node] of the connected component of the active nodes containing
+    # the seed node of each pixel, the graph of every pixel is adjacency
+    n_pix, n_node = active.shape
+    adj = adjacency.tocoo()
+    pix = np.repeat(np.arange(n_pix), len(adj.row))
+    rows = np.tile(adj.row, n_pix)
+    cols = np.tile(adj.col, n_pix)
+    keep = active[pix, rows] & active[pix, cols]
+    graph = scipy.sparse.csr_matrix(
+        (np.ones(np.sum(keep), dtype=np.int8),
+         (pix[keep] * n_node + rows[keep], pix[keep] * n_node + cols[keep])),
+        shape=(n_pix * n_node, n_pix * n_node))
+    labels = connected_components(graph, directed=False)[1].reshape(n_pix, n_node)
+    return (labels == labels[np.arange(n_pix), seed][:, None]) & active
+
+
+def beam_peak_regions(geometry, Ibeams, thresh=0.7, dilate=1):
+    """beams of the peak region of many pixels: the beams above thresh of the
+    (min subtracted) maximum connected to the brightest beam, extended by dilate
+    rings of neighbors, as the labeled and dilated region of the image
+
+    Args:
+        geometry (BeamGeometry): beams
+        Ibeams (array): beam intensities [pixel, beam]
+        thresh (float, optional): relative threshold. Defaults to 0.7.
+        dilate (int, optional): number of rings of neighbors added. Defaults to 1.
+
+    Returns:
+        array: boolean mask [pixel, beam]
+    """
+    Ibeams = np.atleast_2d(Ibeams)
+    data_beam = Ibeams - np.min(Ibeams, axis=1, keepdims=True)
+    above = data_beam > np.max(data_beam, axis=1, keepdims=True) * thresh
+    seed = np.argmax(data_beam, axis=1)
+    above[np.arange(len(seed)), seed] = True
+    region = _peak_component(above, geometry.adjacency, seed)
+    for idx_ring in range(dilate):
+        region = region | ((region.astype(np.float64) @ geometry.adjacency.T) > 0)
+    return region
+
+
+def beam_neighbors(xb, yb):
+    """neighbors of every beam in the Delaunay triangulation of the beams, as (indptr, indices)"""
+    return Delaunay(np.column_stack((xb, yb))).vertex_neighbor_vertices
+
+
+def beam_peak_region(Ibeam, neighbors, thresh=0.7, dilate=1):
+    """beams of the peak region of one frame, see beam_peak_regions
+
+    Args:
+        Ibeam (array): intensity of each beam
+        neighbors (tuple): output of beam_neighbors
+        thresh (float, optional): relative threshold. Defaults to 0.7.
+        dilate (int, optional): number of rings of neighbors added. Defaults to 1.
+
+    Returns:
+        array: boolean mask of the beams
+    """
+    indptr, indices = neighbors
+    data_beam = Ibeam - np.min(Ibeam)
+    above = data_beam > np.max(data_beam)*thresh
+    region = np.zeros(len(Ibeam), dtype=bool)
+    stack = [int(np.argmax(data_beam))]
+    region[stack[0]] = True
+    while stack:
+        idx = stack.pop()
+        for idx_nb in indices[indptr[idx]:indptr[idx + 1]]:
+            if above[idx_nb] and not region[idx_nb]:
+                region[idx_nb] = True
+                stack.append(idx_nb)
+    for idx_ring in range(dilate):
+        ring = np.zeros_like(region)
+        for idx in np.where(region)[0]:
+            ring[indices[indptr[idx]:indptr[idx + 1]]] = True
+        region |= ring
+    return region
+
+
+def beam_peaks(geometry, Ibeams):
+    """peak position of many pixels, the brightest beam refined by the maximum of a
+    quadratic surface fitted to the beam and its neighbors, the beam position is
+    kept when the surface has no maximum close to the beam
+
+    Args:
+        geometry (BeamGeometry): beams
+        Ibeams (array): beam intensities [pixel, beam]
+
+    Returns:
+        tuple: peak_x, peak_y, peak_I, peak_beam [pixel]
+    """
+    Ibeams = np.atleast_2d(np.asarray(Ibeams, dtype=np.float64))
+    peak_beam = np.argmax(Ibeams, axis=1)
+    peak_x = geometry.xb[peak_beam].copy()
+    peak_y = geometry.yb[peak_beam].copy()
+    peak_I = Ibeams[np.arange(len(peak_beam)), peak_beam].copy()
+    quad = geometry.quad_fit_matrices()
+    for beam in np.unique(peak_beam):
+        pix = np.where(peak_beam == beam)[0]
+        local, pinv, scale = quad[beam]
+        coef = Ibeams[np.ix_(pix, local)] @ pinv.T  # [pixel, 6]
+        c0, c1, c2, c3, c4, c5 = coef.T
+        det = 4 * c3 * c5 - c4**2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            u = (-2 * c5 * c1 + c4 * c2) / det
+            v = (c4 * c1 - 2 * c3 * c2) / det
+        # a maximum within the neighbors
+        ok = (det > 0) & (c3 < 0) & (np.hypot(u, v) <= 1)
+        peak_x[pix[ok]] += u[ok] * scale
+        peak_y[pix[ok]] += v[ok] * scale
+        peak_I[pix[ok]] = (c0 + c1 * u + c2 * v + c3 * u**2 + c4 * u * v + c5 * v**2)[ok]
+    return peak_x, peak_y, peak_I, peak_beam
+
+
+def beam_fwhm_areas(geometry, Ibeams):
+    """FWHM area (arcsec^2) of many pixels: area where the linear interpolation of
+    the (min subtracted) beams is above half of the maximum, connected to the brightest beam
+
+    Args:
+        geometry (BeamGeometry): beams
+        Ibeams (array): beam intensities [pixel, beam]
+
+    Returns:
+        array: area [pixel]
+    """
+    Ibeams = np.atleast_2d(np.asarray(Ibeams, dtype=np.float64))
+    data_beam = Ibeams - np.min(Ibeams, axis=1, keepdims=True)
+    half = np.max(data_beam, axis=1) / 2
+    vals = np.sort(data_beam[:, geometry.tri.simplices], axis=2)  # [pixel, tri, 3]
+    v1, v2, v3 = vals[..., 0], vals[..., 1], vals[..., 2]
+    h = half[:, None]
+    # fraction of each triangle above h, for a linear function on the triangle
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = np.where(h <= v1, 1.,
+                        np.where(h >= v3, 0.,
+                                 np.where(h >= v2, (v3 - h)**2 / ((v3 - v1) * (v3 - v2)),
+                                          1 - (h - v1)**2 / ((v2 - v1) * (v3 - v1)))))
+    frac = np.nan_to_num(frac, nan=0.)
+    seed = geometry.tri.vertex_to_simplex[np.argmax(data_beam, axis=1)]
+    active = frac > 0
+    active[np.arange(len(seed)), seed] = True
+    region = _peak_component(active, geometry.tri_adjacency, seed)
+    return np.sum(frac * region * geometry.tri_area[None, :], axis=1)
+
+
+def fit_gauss_beams_batch(geometry, Ibeams, region, max_iter=200, ftol=1e-12):
+    """fit a 2D Gaussian to the beams of region for many pixels at once,
+    Levenberg-Marquardt with the analytic Jacobian, vectorised over the pixels
+
+    Args:
+        geometry (BeamGeometry): beams
+        Ibeams (array): beam intensities [pixel, beam]
+        region (array): beams to fit [pixel, beam]
+        max_iter (int, optional): maximum number of iterations. Defaults to 200.
+        ftol (float, optional): relative change of the cost to stop. Defaults to 1e-12.
+
+    Returns:
+        structured array: gauss_fit_dtype [pixel], see fit_gauss_beams
+    """
+    xb, yb = geometry.xb, geometry.yb
+    Ibeams = np.atleast_2d(np.asarray(Ibeams, dtype=np.float64))
+    weight = region.astype(np.float64)
+    n_pix, n_param = Ibeams.shape[0], len(gauss_fit_params)
+    n_fit = region.sum(axis=1)
+
+    res = np.zeros(n_pix, dtype=gauss_fit_dtype)
+    res['n_beam'] = n_fit
+    for name in gauss_fit_params:
+        res[name] = np.nan
+        res[name + '_err'] = np.nan
+
+    # initial guess as in bf_fit_gauss_source_by_idx
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_mean = (weight @ xb) / n_fit
+        y_mean = (weight @ yb) / n_fit
+        x_std = np.sqrt((weight @ xb**2) / n_fit - x_mean**2)
+        y_std = np.sqrt((weight @ yb**2) / n_fit - y_mean**2)
+    params = np.column_stack((np.max(np.where(region, Ibeams, -np.inf), axis=1),
+                              x_mean, y_mean, np.full(n_pix, np.pi), x_std, y_std))
+
+    fit = np.where((n_fit >= n_param) & np.all(np.isfinite(params), axis=1)
+                   & (params[:, 4] > 0) & (params[:, 5] > 0))[0]
+    if len(fit) == 0:
+        return res
+    # only the beams of the regions, padded with zero weight to the largest region
+    order = np.argsort(~region, axis=1, kind='stable')[:, :np.max(n_fit[fit])]
+    fit_xb, fit_yb = xb[order], yb[order]
+    fit_Ib = np.take_along_axis(Ibeams, order, axis=1)
+    fit_w = np.take_along_axis(weight, order, axis=1)
+
+    def residual(params, sel):
+        return fit_w[sel] * (gauss2d_beam(params.T[:, :, None], fit_xb[sel], fit_yb[sel]) - fit_Ib[sel])
+
+    def jacobian(params, sel):
+        return fit_w[sel][:, :, None] * gauss2d_beam_jac(params.T[:, :, None], fit_xb[sel], fit_yb[sel])
+
+    resid = residual(params[fit], fit)
+    cost = 0.5 * np.sum(resid**2, axis=1)
+    lam = np.full(len(fit), 1e-3)
+    converged = np.zeros(len(fit), dtype=bool)
+    stalled = np.zeros(len(fit), dtype=bool)
+    for idx_iter in range(max_iter):
+        act = np.where(~converged & ~stalled)[0]
+        if len(act) == 0:
+            break
+        sel = fit[act]
+        jac = jacobian(params[sel], sel)
+        jtj = np.einsum('nbi,nbj->nij', jac, jac)
+        grad = np.einsum('nbi,nb->ni', jac, resid[act])
+        diag = np.einsum('nii->ni', jtj)
+        damped = jtj + (lam[act][:, None] * np.maximum(diag, 1e-12))[:, :, None] * np.eye(n_param)
+        try:
+            step = -np.linalg.solve(damped, grad[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            step = -np.einsum('nij,nj->ni', np.linalg.pinv(damped), grad)
+        params_new = params[sel] + step
+        with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+            resid_new = residual(params_new, sel)
+            cost_new = 0.5 * np.sum(resid_new**2, axis=1)
+        better = np.isfinite(cost_new) & (cost_new < cost[act])
+        decrease = cost[act] - cost_new
+        params[sel[better]] = params_new[better]
+        resid[act[better]] = resid_new[better]
+        cost[act[better]] = cost_new[better]
+        lam[act[better]] /= 10
+        lam[act[~better]] *= 10
+        # at the minimum the cost changes by rounding only, whether the step is taken or not;
+        # a rejected step also gets small when the damping grows, so the size of the step
+        # counts for the accepted ones only, and a fit damped without a better step is stuck
+        with np.errstate(invalid='ignore'):
+            converged[act] = ((np.abs(decrease) <= ftol * cost[act])
+                              | (better & (np.max(np.abs(step) / (np.abs(params[sel]) + 1e-12), axis=1)
+                                           < 1e-12)))
+        stalled[act] = ~converged[act] & (lam[act] > 1e16)
+
+    # covariance as in curve_fit, scaled by the reduced chi square
+    sel = fit
+    jac = jacobian(params[sel], sel)
+    jtj = np.einsum('nbi,nbj->nij', jac, jac)
+    n_dof = n_fit[sel] - n_param
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pcov = np.linalg.pinv(jtj) * (2 * cost / n_dof)[:, None, None]
+        err = np.sqrt(np.einsum('nii->ni', pcov))
+    err[n_dof <= 0] = np.nan
+    # the stalled fits and the ones out of iterations are failed, their parameters stay nan
+    ok = np.all(np.isfinite(params[sel]), axis=1) & converged
+    res['success'][sel] = ok
+    for idx, name in enumerate(gauss_fit_params):
+        res[name][sel[ok]] = params[sel[ok], idx]
+        res[name + '_err'][sel[ok]] = err[ok, idx]
+    return res
+
+
+def fit_gauss_beams_lsq(xb, yb, Ibeams, thresh=0.7, dilate=1, neighbors=None):
+    """fit a 2D Gaussian to the peak region of the beams frame by frame with
+    scipy least_squares, the reference of fit_gauss_beams_batch, see fit_gauss_beams"""
+    from scipy.optimize import least_squares
+
+    xb = np.asarray(xb, dtype=np.float64)
+    yb = np.asarray(yb, dtype=np.float64)
+    Ibeams = np.atleast_2d(np.asarray(Ibeams, dtype=np.float64))
+    if neighbors is None:
+        neighbors = beam_neighbors(xb, yb)
+    res = np.zeros(Ibeams.shape[0], dtype=gauss_fit_dtype)
+    for name in gauss_fit_params:
+        res[name] = np.nan
+        res[name + '_err'] = np.nan
+
+    for idx, Ibeam in enumerate(Ibeams):
+        region = beam_peak_region(Ibeam, neighbors, thresh, dilate)
+        fit_xb, fit_yb, fit_Ib = xb[region], yb[region], Ibeam[region]
+        res['n_beam'][idx] = len(fit_Ib)
+        if len(fit_Ib) < len(gauss_fit_params):
+            continue
+        p0 = [np.max(fit_Ib), np.mean(fit_xb), np.mean(fit_yb), np.pi, np.std(fit_xb), np.std(fit_yb)]
+        try:
+            fit = least_squares(lambda p: gauss2d_beam(p, fit_xb, fit_yb) - fit_Ib, p0,
+                                jac=lambda p: gauss2d_beam_jac(p, fit_xb, fit_yb), method='lm')
+        except (ValueError, np.linalg.LinAlgError):
+            continue
+        if not fit.success:
+            continue
+        res['success'][idx] = True
+        for name, value in zip(gauss_fit_params, fit.x):
+            res[name][idx] = value
+        # covariance as in curve_fit, scaled by the reduced chi square
+        n_dof = len(fit_Ib) - len(gauss_fit_params)
+        if n_dof > 0:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                pcov = np.linalg.pinv(fit.jac.T @ fit.jac) * (2 * fit.cost / n_dof)
+            for name, value in zip(gauss_fit_params, np.diag(pcov)):
+                res[name + '_err'][idx] = np.sqrt(value) if value >= 0 else np.nan
+    return res
+
+
+def fit_gauss_beams(xb, yb, Ibeams, thresh=0.7, dilate=1, neighbors=None, geometry=None, method='batch',
+                    chunk_size=256, workers=1):
+    """fit a 2D Gaussian to the peak region of the beams for many frames,
+    least squares with the analytic Jacobian, no image is made
+
+    Args:
+        xb, yb (array): beam positions (arcsec)
+        Ibeams (array): beam intensities [frame, beam]
+        thresh, dilate: selection of the beams, see beam_peak_regions
+        neighbors (tuple, optional): output of beam_neighbors, for method 'lsq'
+        geometry (BeamGeometry, optional): beams, made from xb, yb if None,
+            and by every process of the pool
+        method (str, optional): 'batch' for fit_gauss_beams_batch, chunk_size frames
+            at once, or 'lsq' for fit_gauss_beams_lsq. Defaults to 'batch'.
+        chunk_size (int, optional): number of frames fitted at once, and per task
+            of the pool. Defaults to 256.
+        workers (int, optional): number of processes for method 'batch'. Defaults to 1.
+
+    Returns:
+        structured array: one gauss_fit_dtype record per frame, the *_err fields are
+        the standard errors (sqrt of the diagonal of the covariance, as from curve_fit),
+        success is False and the parameters nan if the fit failed
+    """
+    if method == 'lsq':
+        return fit_gauss_beams_lsq(xb, yb, Ibeams, thresh, dilate, neighbors)
+    if method != 'batch':
+        raise ValueError('unknown method ' + str(method))
+    Ibeams = np.atleast_2d(np.asarray(Ibeams, dtype=np.float64))
+    if workers > 1 and Ibeams.shape[0] > chunk_size:
+        return _map_chunks(_fit_gauss_beams_worker, xb, yb, Ibeams, thresh, dilate, chunk_size, workers)
+    if geometry is None:
+        geometry = BeamGeometry(xb, yb)
+    res = np.zeros(Ibeams.shape[0], dtype=gauss_fit_dtype)
+    for start in range(0, Ibeams.shape[0], chunk_size):
+        chunk = Ibeams[start:start + chunk_size]
+        res[start:start + chunk_size] = fit_gauss_beams_batch(
+            geometry, chunk, beam_peak_regions(geometry, chunk, thresh, dilate))
+    return res
+
+
+def _map_chunks(worker, xb, yb, Ibeams, thresh, dilate, chunk_size, workers):
+    # the chunks of pixels in a process pool, spawned as the other pools of lofarSun,
+    # every task makes its own BeamGeometry
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    tasks = [(xb, yb, Ibeams[idx:idx + chunk_size], thresh, dilate, chunk_size)
+             for idx in range(0, Ibeams.shape[0], chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return np.concatenate(list(pool.map(worker, tasks)))
+
+
+def _fit_gauss_beams_worker(args):
+    # process pool entry of fit_gauss_beams
+    xb, yb, Ibeams, thresh, dilate, chunk_size = args
+    return fit_gauss_beams(xb, yb, Ibeams, thresh, dilate, chunk_size=chunk_size)
+
+
+def localise_beams(xb, yb, Ibeams, thresh=0.7, dilate=1, chunk_size=1024, geometry=None, workers=1):
+    """peak, FWHM area and 2D Gaussian fit of many pixels, on the beam samples
+
+    Args:
+        xb, yb (array): beam positions (arcsec)
+        Ibeams (array): beam intensities [pixel, beam]
+        thresh, dilate: selection of the beams of the Gaussian fit, see beam_peak_regions
+        chunk_size (int, optional): number of pixels processed at once, and per task
+            of the pool. Defaults to 1024.
+        geometry (BeamGeometry, optional): beams, made from xb, yb if None,
+            and by every process of the pool
+        workers (int, optional): number of processes. Defaults to 1.
+
+    Returns:
+        structured array: localise_dtype [pixel]
+    """
+    Ibeams = np.atleast_2d(np.asarray(Ibeams, dtype=np.float64))
+    if workers > 1 and Ibeams.shape[0] > chunk_size:
+        return _map_chunks(_localise_beams_worker, xb, yb, Ibeams, thresh, dilate, chunk_size, workers)
+    if geometry is None:
+        geometry = BeamGeometry(xb, yb)
+    res = np.zeros(Ibeams.shape[0], dtype=localise_dtype)
+    for start in range(0, Ibeams.shape[0], chunk_size):
+        chunk = Ibeams[start:start + chunk_size]
+        res_chunk = res[start:start + chunk_size]
+        (res_chunk['peak_x'], res_chunk['peak_y'],
+         res_chunk['peak_I'], res_chunk['peak_beam']) = beam_peaks(geometry, chunk)
+        res_chunk['fwhm_area'] = beam_fwhm_areas(geometry, chunk)
+        res_gauss = fit_gauss_beams(geometry.xb, geometry.yb, chunk, thresh, dilate, geometry=geometry)
+        for name in gauss_fit_dtype.names[2:]:
+            res_chunk[name] = res_gauss[name]
+    return res
+
+
+def _localise_beams_worker(args):
+    # process pool entry of localise_beams
+    xb, yb, Ibeams, thresh, dilate, chunk_size = args
+    return localise_beams(xb, yb, Ibeams, thresh, dilate, chunk_size)
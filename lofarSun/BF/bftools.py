@@ -1,25 +1,132 @@
 import numpy as np
 import os
+import importlib.util
 import re
 import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from astropy.io import fits as fits
 import matplotlib.dates as mdates
 import h5py
-import matplotlib.pyplot as plt
-from scipy import interpolate
+import scipy.ndimage
 from tqdm import tqdm
-import torch
-from lofarSun.BF.RFIconvFlag import *
+from lofarSun.BF.RFIconvNumpy import get_RFIconv_numpy
 
-device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+# torch is imported only when the 'torch' backend is used, see resolve_backend
 
 
-def h5_fetch_meta(f, SAP="000"):
+def torch_device(device=None):
+    """torch device to run the flagging and averaging on
+
+    Args:
+        device (str or device, optional): e.g. "cuda:0" or "cpu", None for the GPU
+            if there is one, the CPU otherwise. Defaults to None.
+
+    Returns:
+        torch.device: the device
+    """
+    import torch
+    if device is None:
+        return torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    return torch.device(device)
+
+
+def __getattr__(name):
+    # bftools.device, the default torch device, resolved on first use
+    if name == 'device':
+        return torch_device()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def resolve_backend(backend='auto', device=None):
+    """choose the backend of the flagging and averaging
+
+    'auto' gives 'numpy' if torch is not installed or the device is the CPU,
+    'torch' otherwise. When torch is installed and device is None, torch is
+    imported to look for a GPU, use backend='numpy' to avoid it on CPU nodes.
+
+    Args:
+        backend (str, optional): 'auto', 'numpy' or 'torch'. Defaults to 'auto'.
+        device (str or device, optional): torch device, see torch_device. Defaults to None.
+
+    Returns:
+        str: 'numpy' or 'torch'
+    """
+    if backend not in ('auto', 'numpy', 'torch'):
+        raise ValueError(f"Invalid backend: {backend}")
+    if backend != 'auto':
+        return backend
+    if importlib.util.find_spec('torch') is None:
+        return 'numpy'
+    if device is not None:
+        return 'numpy' if str(device).split(':')[0] == 'cpu' else 'torch'
+    return 'numpy' if torch_device().type == 'cpu' else 'torch'
+
+
+def get_flagger(agg_factor=[1.66, 1.66, 0.45, 0.45], backend='auto', device=None):
+    """RFIconv flagger of the backend, built once and cached
+
+    Args:
+        agg_factor (list, optional): factor for flagging. Defaults to [1.66, 1.66, 0.45, 0.45].
+        backend (str, optional): 'auto', 'numpy' or 'torch', see resolve_backend. Defaults to 'auto'.
+        device (str or device, optional): torch device, see torch_device. Defaults to None.
+
+    Returns:
+        RFIconv or RFIconvNumpy: the flagger
+    """
+    if resolve_backend(backend, device) == 'torch':
+        from lofarSun.BF.RFIconvFlag import get_RFIconv
+        return get_RFIconv(agg_factor, torch_device(device))
+    return get_RFIconv_numpy(agg_factor)
+
+
+def h5_list_datasets(f):
+    """all the dynamic spectra of the h5 file
+
+    Args:
+        f (h5 file): target h5 file
+
+    Returns:
+        list: (SAP, beam_key, stokes_key) of every STOKES dataset, sorted,
+            e.g. ("000", "BEAM_000", "STOKES_0"), to give to h5_fetch_meta
+    """
+    datasets = []
+    for sap_key in sorted(filter(lambda x: x.startswith('SUB_ARRAY_POINTING_'), f['/'].keys())):
+        for beam_key in sorted(filter(lambda x: 'BEAM' in x, f[sap_key].keys())):
+            for stokes_key in sorted(filter(lambda x: 'STOKES' in x, f[sap_key][beam_key].keys())):
+                datasets.append((sap_key[len('SUB_ARRAY_POINTING_'):], beam_key, stokes_key))
+    return datasets
+
+
+def h5_stokes_files(fname):
+    """h5 files of all the Stokes of the beam, LOFAR writes every Stokes in its own file,
+    e.g. L123_SAP000_B000_S0_P000_bf.h5 to L123_SAP000_B000_S3_P000_bf.h5
+
+    Args:
+        fname (str): h5 file of one of the Stokes
+
+    Returns:
+        list: absolute paths of the files of the Stokes next to fname, sorted,
+            only fname if its name has no _S<n>_ part
+    """
+    path = os.path.abspath(fname)
+    h5_dir, h5_fname = os.path.split(path)
+    match = re.search(r'_S[0-9]_', h5_fname)
+    if match is None:
+        return [path]
+    pattern = re.compile(re.escape(h5_fname[:match.start()]) + r'_S[0-9]_'
+                         + re.escape(h5_fname[match.end():]) + '$')
+    return sorted(os.path.join(h5_dir, name) for name in os.listdir(h5_dir) if pattern.match(name))
+
+
+def h5_fetch_meta(f, SAP="000", beam_key=None, stokes_key=None):
     """get info from the h5 file
 
     Args:
         f (h5 file): target h5 file
         SAP (str, optional): Sub-Array-Pointing. Defaults to "000".
+        beam_key (str, optional): beam, e.g. "BEAM_001", the first beam if None. Defaults to None.
+        stokes_key (str, optional): Stokes, e.g. "STOKES_1", the first Stokes if None. Defaults to None.
 
     Returns:
         list: metadata of the h5 file
@@ -28,10 +135,12 @@ def h5_fetch_meta(f, SAP="000"):
     root_group = f["/"]
 
     sap_key = 'SUB_ARRAY_POINTING_'+SAP
-    beam_key, *_ = filter(lambda x: 'BEAM' in x,
-                          f[sap_key].keys())
-    stokes_key, *_ = filter(lambda x: 'STOKES' in x,
-                            f[sap_key][beam_key].keys())
+    if beam_key is None:
+        beam_key, *_ = filter(lambda x: 'BEAM' in x,
+                              f[sap_key].keys())
+    if stokes_key is None:
+        stokes_key, *_ = filter(lambda x: 'STOKES' in x,
+                                f[sap_key][beam_key].keys())
 
     project_id= root_group.attrs['PROJECT_ID'], 
     obs_id= root_group.attrs['OBSERVATION_ID'],
@@ -62,57 +171,143 @@ def h5_fetch_meta(f, SAP="000"):
             project_id, obs_id, antenna_set_name, telescop_name, target_name, t_idx_count, f_idx_count,
             t_start_bf, t_end_bf, freq, t_all)
 
+def h5_memmap_dataset(dset):
+    """map a h5 dataset to memory, when it is stored contiguously and uncompressed
+
+    The data is then read by the OS page cache, slicing the returned array
+    gives views on the file without copy.
+
+    Args:
+        dset (h5py dataset): dataset in a file opened read-only
+
+    Returns:
+        numpy.memmap: read-only array of the dataset, None if the dataset is chunked,
+            compressed, external or not allocated, to be read with h5py instead
+    """
+    if (dset.chunks is not None or dset.external is not None
+            or dset.file.driver not in ('sec2', 'stdio') or dset.dtype.hasobject):
+        return None
+    offset = dset.id.get_offset()
+    if offset is None:
+        return None
+    return np.memmap(dset.file.filename, mode='r', dtype=dset.dtype,
+                     shape=dset.shape, offset=offset, order='C')
+
+
+def h5_data_reader(dset, memmap=False):
+    """array to read the data of a h5 dataset with
+
+    Args:
+        dset (h5py dataset): dataset, e.g. f[dataset_uri] from h5_fetch_meta
+        memmap (bool, optional): use the memory map of the dataset if possible. Defaults to False.
+
+    Returns:
+        numpy.memmap or h5py dataset: the memory map, or the dataset itself
+            if memmap is False or the dataset can not be mapped
+    """
+    if memmap and isinstance(dset, h5py.Dataset):
+        dset_memmap = h5_memmap_dataset(dset)
+        if dset_memmap is not None:
+            return dset_memmap
+    return dset
+
+
+def _read_slab(data_array_uri, slab):
+    return data_array_uri[slab, :]
+
+
+def prefetch_h5_slabs(data_array_uri, slabs, n_prefetch=2, n_workers=1):
+    """ Read time slabs of a dataset ahead of use in background threads
+
+    The slab N+1 (up to N+n_prefetch) is read while slab N is being processed,
+    so that the disk I/O overlaps with the computation, at most n_prefetch
+    buffers are in flight at the same time.
+
+    Args:
+        data_array_uri (h5py dataset or array): dynamic spectrum [t,f]
+        slabs (iterable): slices along the time axis, e.g. [slice(0,256), slice(256,512)]
+        n_prefetch (int, optional): number of slabs read ahead. Defaults to 2.
+        n_workers (int, optional): number of reading threads. Defaults to 1.
+
+    Yields:
+        array: data_array_uri[slab, :] for each slab, in order
+    """
+    slabs = iter(slabs)
+    if n_prefetch < 1:
+        for slab in slabs:
+            yield _read_slab(data_array_uri, slab)
+        return
+
+    with ThreadPoolExecutor(max_workers=max(int(n_workers), 1)) as pool:
+        pending = deque()
+        for slab in slabs:
+            pending.append(pool.submit(_read_slab, data_array_uri, slab))
+            if len(pending) >= n_prefetch:
+                break
+        while pending:
+            slab_data = pending.popleft().result()
+            slab = next(slabs, None)
+            if slab is not None:
+                pending.append(pool.submit(_read_slab, data_array_uri, slab))
+            yield slab_data
+
+
 # data_array_uri=f[dataset_uri]
-def downsample_h5_seg_by_time_ratio(data_array_uri, t_all, t_ratio_start, t_ratio_end, t_idx_count,  
+def iter_downsample_h5_seg_by_time_ratio(data_array_uri, t_all, t_ratio_start, t_ratio_end, t_idx_count,
                     t_c_ratio, f_c_ratio, averaging=True, flagging=False, t_idx_cut=256,
-                    agg_factor=[1.66, 1.66, 0.45, 0.45], subband_edge=False, subband_ch=16, device=device):
-    """ Downsample the h5 file by time ratio
+                    agg_factor=[1.66, 1.66, 0.45, 0.45], subband_edge=False, subband_ch=16, device=None,
+                    net=None, n_prefetch=2, memmap=False, backend='auto'):
+    """ Downsample the h5 file by time ratio, block by block
+
+    Same as downsample_h5_seg_by_time_ratio, but the downsampled dynamic spectrum
+    is yielded one segment (at most t_idx_cut time stamps) at a time, so that the
+    memory used does not grow with the length of the chunk.
 
     Args:
-        data_array_uri (array): dynamic spectrum
-        t_all (1d array): all time stamps
-        t_ratio_start (float): start time ratio (0-1)
-        t_ratio_end (float): end time ratio (0-1)
-        t_idx_count (int): number of total time stamps
-        t_c_ratio (int): time compression ratio
-        f_c_ratio (int): frequency compression ratio
-        averaging (bool, optional): averaging or direct sample. Defaults to True.
-        flagging (bool, optional): flagging or not. Defaults to False.
-        t_idx_cut (int, optional): factor to contour segment length for processing, to make use of the memory. Defaults to 256.
-        agg_factor (list, optional): factor for flagging. Defaults to [1.66, 1.66, 0.45, 0.45].
-        subband_edge (bool, optional): remove one channel every [subband num] channels. Defaults to False.
-        subband_ch (int, optional): number of subbands per channel. Defaults to 16.
-        device (device, optional): GPU or CPU, should be something like torch.device("cuda:0") . Defaults to device.
+        same as downsample_h5_seg_by_time_ratio
 
-    Returns:
-        list: [averaged dynamic spectrum, time stamps]
-    """    
+    Yields:
+        list: [downsampled block of the dynamic spectrum [t,f], time stamps of the block]
+    """
 
     idx_start = int(t_ratio_start * (t_idx_count - 1))
     idx_end = int(t_ratio_end * (t_idx_count - 1))
     time_window = t_c_ratio
     freq_window = f_c_ratio
+    data_array_uri = h5_data_reader(data_array_uri, memmap)
 
     if averaging:
         segment_len = t_idx_cut * t_c_ratio
         num_segments = int((idx_end - idx_start) * (1.0 / segment_len))+1
-        stokes_list = []
-        t_list = []
-        for idx_segment in np.arange(num_segments):
-            stokes_tmp = data_array_uri[(idx_start + idx_segment * segment_len):np.min([
-                idx_start + (idx_segment + 1) * segment_len, idx_end]), :]
-            t_tmp = t_all[(idx_start + idx_segment * segment_len):np.min([
-                idx_start + (idx_segment + 1) * segment_len, idx_end])]
-            
+        # build the flagger and the averaging kernel once for all segments
+        backend = resolve_backend(backend, device)
+        if flagging and net is None:
+            net = get_flagger(agg_factor, backend, device)
+        if backend == 'torch':
+            import torch
+            import torch.nn.functional as F
+            device = torch_device(device)
+            kernel_avg = torch.ones([1, 1, time_window, freq_window]) / freq_window / time_window
+        slabs = [slice(idx_start + idx_segment * segment_len,
+                       min(idx_start + (idx_segment + 1) * segment_len, idx_end))
+                 for idx_segment in range(num_segments)]
+        for slab, stokes_tmp in zip(slabs, prefetch_h5_slabs(data_array_uri, slabs, n_prefetch)):
+            t_tmp = t_all[slab]
+
             if subband_edge:
+                if not stokes_tmp.flags.writeable:
+                    # view on the read-only memory map
+                    stokes_tmp = np.array(stokes_tmp)
                 # copy the n*16-1 channel to n*16 channel
                 stokes_tmp[:, 0::subband_ch] = stokes_tmp[:, 1::subband_ch]
 
-            if t_tmp.shape[0] >= t_c_ratio - 1:
-                if flagging:
-                    net = RFIconv(device=device)
-                    net = init_RFIconv(
-                        net, aggressive_factor=agg_factor, device=device).to(device)
+            # a segment shorter than the time window gives no averaged sample
+            if t_tmp.shape[0] >= t_c_ratio:
+                if backend == 'numpy':
+                    small_arr = box_average_2d(stokes_tmp, time_window, freq_window,
+                                               flag=net(stokes_tmp) if flagging else None)
+
+                elif flagging:
                     with torch.no_grad():
                         output = net(
                             torch.tensor(stokes_tmp.squeeze()[None, None, :, :]).to(device)).squeeze().cpu().numpy()
@@ -120,12 +315,10 @@ def downsample_h5_seg_by_time_ratio(data_array_uri, t_all, t_ratio_start, t_rati
                     conv_down_after_flag = F.conv2d(
                         torch.tensor(
                             stokes_tmp[None, None, :, :] * (~output[None, None, :, :])),
-                        torch.ones([1, 1, time_window, freq_window]
-                                   ) / freq_window / time_window,
+                        kernel_avg,
                         stride=(time_window, freq_window), padding=(0, 0)).squeeze().numpy()
                     conv_down_weight_after_flag = F.conv2d(torch.tensor(1 - output[None, None, :, :]) * 1.0,
-                                                           torch.ones([1, 1, time_window,
-                                                                       freq_window]) / freq_window / time_window,
+                                                           kernel_avg,
                                                            stride=(
                                                                time_window, freq_window),
                                                            padding=(0, 0)).squeeze().numpy()
@@ -133,79 +326,293 @@ def downsample_h5_seg_by_time_ratio(data_array_uri, t_all, t_ratio_start, t_rati
 
                 else:
                     small_arr = F.conv2d(torch.tensor(stokes_tmp[None, None, :, :]),
-                                         torch.ones(
-                                             [1, 1, time_window, freq_window]) / freq_window / time_window,
+                                         kernel_avg,
                                          stride=(time_window, freq_window), padding=(0, 0)).squeeze().numpy()
 
-                stokes_list.append(small_arr)
-                t_list.append(avg_1d(t_tmp, t_c_ratio).ravel())
-        stokes = np.concatenate(stokes_list, axis=0)
-        t_fits = np.concatenate(t_list, axis=0)
+                # squeeze() drops the time axis of a single-sample segment
+                yield (small_arr.reshape(-1, stokes_tmp.shape[1] // freq_window),
+                       avg_1d(t_tmp, t_c_ratio).ravel())
 
     else:
-        stokes = data_array_uri[
-            idx_start:idx_end:t_c_ratio, ::f_c_ratio]  # sampling the data
-        t_fits = t_all[idx_start:idx_end:t_c_ratio]
+        # sampling the data, t_idx_cut samples per block
+        segment_len = t_idx_cut * t_c_ratio
+        for idx_block_start in range(idx_start, idx_end, segment_len):
+            slab = slice(idx_block_start, min(idx_block_start + segment_len, idx_end), t_c_ratio)
+            yield np.asarray(data_array_uri[slab, ::f_c_ratio]), t_all[slab]
+
+
+def downsample_h5_seg_shape(t_ratio_start, t_ratio_end, t_idx_count, f_idx_count,
+                            t_c_ratio, f_c_ratio, averaging=True, t_idx_cut=256):
+    """ Shape of the output of downsample_h5_seg_by_time_ratio, without reading the data
+
+    Args:
+        f_idx_count (int): number of channels of the raw data
+        the others are the same as downsample_h5_seg_by_time_ratio
+
+    Returns:
+        tuple: (number of time stamps, number of channels)
+    """
+    idx_start = int(t_ratio_start * (t_idx_count - 1))
+    idx_end = int(t_ratio_end * (t_idx_count - 1))
+    if averaging:
+        segment_len = t_idx_cut * t_c_ratio
+        num_segments = int((idx_end - idx_start) * (1.0 / segment_len))+1
+        n_t = 0
+        for idx_segment in range(num_segments):
+            len_seg = (min(idx_start + (idx_segment + 1) * segment_len, idx_end)
+                       - (idx_start + idx_segment * segment_len))
+            if len_seg >= t_c_ratio:
+                n_t += len_seg // t_c_ratio
+        return n_t, f_idx_count // f_c_ratio
+    return len(range(idx_start, idx_end, t_c_ratio)), len(range(0, f_idx_count, f_c_ratio))
+
+
+def downsample_h5_seg_by_time_ratio(data_array_uri, t_all, t_ratio_start, t_ratio_end, t_idx_count,  
+                    t_c_ratio, f_c_ratio, averaging=True, flagging=False, t_idx_cut=256,
+                    agg_factor=[1.66, 1.66, 0.45, 0.45], subband_edge=False, subband_ch=16, device=None,
+                    net=None, n_prefetch=2, memmap=False, backend='auto'):
+    """ Downsample the h5 file by time ratio
+
+    Args:
+        data_array_uri (array): dynamic spectrum
+        t_all (1d array): all time stamps
+        t_ratio_start (float): start time ratio (0-1)
+        t_ratio_end (float): end time ratio (0-1)
+        t_idx_count (int): number of total time stamps
+        t_c_ratio (int): time compression ratio
+        f_c_ratio (int): frequency compression ratio
+        averaging (bool, optional): averaging or direct sample. Defaults to True.
+        flagging (bool, optional): flagging or not. Defaults to False.
+        t_idx_cut (int, optional): factor to contour segment length for processing, to make use of the memory. Defaults to 256.
+        agg_factor (list, optional): factor for flagging. Defaults to [1.66, 1.66, 0.45, 0.45].
+        subband_edge (bool, optional): remove one channel every [subband num] channels. Defaults to False.
+        subband_ch (int, optional): number of subbands per channel. Defaults to 16.
+        device (device, optional): GPU or CPU for the torch backend, should be something like
+            torch.device("cuda:0"), None for the GPU if there is one. Defaults to None.
+        net (RFIconv or RFIconvNumpy, optional): initialised flagger of the backend to reuse for
+            all segments, built with get_flagger(agg_factor, backend, device) if not given. Defaults to None.
+        n_prefetch (int, optional): number of segments read ahead in background, 0 to read
+            on the main thread. Defaults to 2.
+        memmap (bool, optional): read the dataset through a memory map when it is stored
+            contiguously and uncompressed, with h5py otherwise. Defaults to False.
+        backend (str, optional): 'numpy' (SciPy convolutions and reshape-mean) or 'torch' (conv2d)
+            for the flagging and averaging, 'auto' for numpy when torch is missing or the
+            device is the CPU, see resolve_backend. Defaults to 'auto'.
+
+    Returns:
+        list: [averaged dynamic spectrum, time stamps]
+    """    
 
-    data_fits = stokes
+    stokes_list = []
+    t_list = []
+    for small_arr, t_block in iter_downsample_h5_seg_by_time_ratio(
+            data_array_uri, t_all, t_ratio_start, t_ratio_end, t_idx_count,
+            t_c_ratio, f_c_ratio, averaging=averaging, flagging=flagging, t_idx_cut=t_idx_cut,
+            agg_factor=agg_factor, subband_edge=subband_edge, subband_ch=subband_ch, device=device,
+            net=net, n_prefetch=n_prefetch, memmap=memmap, backend=backend):
+        stokes_list.append(small_arr)
+        t_list.append(t_block)
+    data_fits = np.concatenate(stokes_list, axis=0)
+    t_fits = np.concatenate(t_list, axis=0)
 
     return data_fits, t_fits
 
 
+def cook_fits_spectr_header(header, data_shape, data_min, data_max, t_start_fits, t_end_fits, stokes_key,
+                            antenna_set_name, telescop_name, target_name,
+                            pointing_ra, pointing_dec, pointing_x, pointing_y):
+    """fill the primary header of the dynamic spectrum fits file
+
+    Args:
+        header (fits.Header): header to fill
+        data_shape (tuple): shape of the dynamic spectrum [t,f]
+        data_min (float): minimum of the data
+        data_max (float): maximum of the data
+        the others are the same as cook_fits_spectr_hdu
+
+    Returns:
+        fits.Header: the filled header
+    """
+    header['SIMPLE'] = True
+    header['BITPIX'] = 8
+    header['NAXIS '] = 2
+    header['NAXIS1'] = data_shape[0]
+    header['NAXIS2'] = data_shape[1]
+    header['EXTEND'] = True
+    header['DATE'] = t_start_fits.strftime("%Y-%m-%d")
+    header['CONTENT'] = t_start_fits.strftime("%Y/%m/%d") + ' LOFAR ' + \
+        antenna_set_name + ' ' + stokes_key
+    header['ORIGIN'] = 'ASTRON Netherlands'
+    header['TELESCOP'] = telescop_name
+    header['INSTRUME'] = antenna_set_name
+    header['OBJECT'] = target_name
+    header['DATE-OBS'] = t_start_fits.strftime("%Y/%m/%d")
+    header['TIME-OBS'] = t_start_fits.strftime("%H:%M:%S.%f")
+    header['DATE-END'] = t_end_fits.strftime("%Y/%m/%d")
+    header['TIME-END'] = t_end_fits.strftime("%H:%M:%S.%f")
+    header['BZERO'] = 0.
+    header['BSCALE'] = 1.
+    header['BUNIT'] = 'digits  '
+    header['DATAMIN'] = max(data_min, 1.e-10)
+    header['DATAMAX'] = min(data_max, 1.e20)
+    header['CRVAL1'] = 74700.
+    header['CRPIX1'] = 0
+    header['CTYPE1'] = 'Time [UT]'
+    header['CDELT1'] = 0.25
+    header['CRVAL2'] = 200.
+    header['CRPIX2'] = 0
+    header['CTYPE2'] = 'Frequency [MHz]'
+    header['CDELT2'] = -1.
+    header['RA'] = pointing_ra
+    header['DEC'] = pointing_dec
+    header['X'] = pointing_x
+    header['Y'] = pointing_y
+
+    header['HISTORY'] = '        '
+    header['STOKES'] = stokes_key
+    return header
+
+
+def cook_fits_spectr_axes_hdu(t_fits, f_fits):
+    col_freq = fits.Column(name='FREQ', format='PD',
+                           array=[np.array(f_fits)])
+    col_time = fits.Column(name='TIME', format='PD',
+                           array=[np.array(t_fits)])
+    return fits.BinTableHDU.from_columns([col_freq, col_time])
+
+
 def cook_fits_spectr_hdu(data_fits, t_fits, f_fits, t_start_fits, t_end_fits, stokes_key,
                          antenna_set_name, telescop_name, target_name,
                          pointing_ra, pointing_dec, pointing_x, pointing_y):
     # create fits hdu
     hdu_lofar = fits.PrimaryHDU()
     hdu_lofar.data = data_fits
-    hdu_lofar.header['SIMPLE'] = True
-    hdu_lofar.header['BITPIX'] = 8
-    hdu_lofar.header['NAXIS '] = 2
-    hdu_lofar.header['NAXIS1'] = data_fits.shape[0]
-    hdu_lofar.header['NAXIS2'] = data_fits.shape[1]
-    hdu_lofar.header['EXTEND'] = True
-    hdu_lofar.header['DATE'] = t_start_fits.strftime("%Y-%m-%d")
-    hdu_lofar.header['CONTENT'] = t_start_fits.strftime("%Y/%m/%d") + ' LOFAR ' + \
-        antenna_set_name + ' ' + stokes_key
-    hdu_lofar.header['ORIGIN'] = 'ASTRON Netherlands'
-    hdu_lofar.header['TELESCOP'] = telescop_name
-    hdu_lofar.header['INSTRUME'] = antenna_set_name
-    hdu_lofar.header['OBJECT'] = target_name
-    hdu_lofar.header['DATE-OBS'] = t_start_fits.strftime("%Y/%m/%d")
-    hdu_lofar.header['TIME-OBS'] = t_start_fits.strftime("%H:%M:%S.%f")
-    hdu_lofar.header['DATE-END'] = t_end_fits.strftime("%Y/%m/%d")
-    hdu_lofar.header['TIME-END'] = t_end_fits.strftime("%H:%M:%S.%f")
-    hdu_lofar.header['BZERO'] = 0.
-    hdu_lofar.header['BSCALE'] = 1.
-    hdu_lofar.header['BUNIT'] = 'digits  '
-    hdu_lofar.header['DATAMIN'] = max(np.nanmin(data_fits), 1.e-10)
-    hdu_lofar.header['DATAMAX'] = min(np.nanmax(data_fits), 1.e20)
-    hdu_lofar.header['CRVAL1'] = 74700.
-    hdu_lofar.header['CRPIX1'] = 0
-    hdu_lofar.header['CTYPE1'] = 'Time [UT]'
-    hdu_lofar.header['CDELT1'] = 0.25
-    hdu_lofar.header['CRVAL2'] = 200.
-    hdu_lofar.header['CRPIX2'] = 0
-    hdu_lofar.header['CTYPE2'] = 'Frequency [MHz]'
-    hdu_lofar.header['CDELT2'] = -1.
-    hdu_lofar.header['RA'] = pointing_ra
-    hdu_lofar.header['DEC'] = pointing_dec
-    hdu_lofar.header['X'] = pointing_x
-    hdu_lofar.header['Y'] = pointing_y
-
-    hdu_lofar.header['HISTORY'] = '        '
-    hdu_lofar.header['STOKES'] = stokes_key
+    cook_fits_spectr_header(hdu_lofar.header, data_fits.shape, np.nanmin(data_fits), np.nanmax(data_fits),
+                            t_start_fits, t_end_fits, stokes_key,
+                            antenna_set_name, telescop_name, target_name,
+                            pointing_ra, pointing_dec, pointing_x, pointing_y)
 
-    col_freq = fits.Column(name='FREQ', format='PD',
-                           array=[np.array(f_fits)])
-    col_time = fits.Column(name='TIME', format='PD',
-                           array=[np.array(t_fits)])
-    hdu_lofar_axes = fits.BinTableHDU.from_columns([col_freq, col_time])
+    hdu_lofar_axes = cook_fits_spectr_axes_hdu(t_fits, f_fits)
     full_hdu = fits.HDUList([hdu_lofar, hdu_lofar_axes])
 
     return full_hdu
 
 
+def write_fits_spectr_stream(out_path, blocks, data_shape, f_fits, t_start_fits, t_end_fits, stokes_key,
+                             antenna_set_name, telescop_name, target_name,
+                             pointing_ra, pointing_dec, pointing_x, pointing_y, overwrite=True):
+    """write the dynamic spectrum fits file block by block
+
+    The primary HDU is preallocated with the final shape and the blocks are
+    appended to it on disk as they come, the time axis is kept and the axes
+    table is written at the end, DATAMIN and DATAMAX are updated in place.
+    The file has the same layout as the one from cook_fits_spectr_hdu.
+    It is written as out_path + '.part' and renamed to out_path only when
+    complete, the partial file is removed if the blocks raise.
+
+    Args:
+        out_path (str): output fits file
+        blocks (iterable): [block [t,f], time stamps] e.g. from iter_downsample_h5_seg_by_time_ratio
+        data_shape (tuple): shape of the full dynamic spectrum [t,f], from downsample_h5_seg_shape
+        f_fits (1d array): frequency of the channels
+        overwrite (bool, optional): overwrite existing file. Defaults to True.
+        the others are the same as cook_fits_spectr_hdu
+
+    Returns:
+        1d array: time stamps of the dynamic spectrum
+    """
+    if os.path.exists(out_path) and not overwrite:
+        raise OSError('File ' + out_path + ' already exists.')
+
+    header = fits.PrimaryHDU().header
+    cook_fits_spectr_header(header, data_shape, 0., 0., t_start_fits, t_end_fits, stokes_key,
+                            antenna_set_name, telescop_name, target_name,
+                            pointing_ra, pointing_dec, pointing_x, pointing_y)
+    # the real data layout, fits axes are in reversed order
+    header['BITPIX'] = -32
+    header['NAXIS1'] = data_shape[1]
+    header['NAXIS2'] = data_shape[0]
+
+    data_min, data_max = np.inf, -np.inf
+    t_list = []
+    n_t = 0
+    part_path = out_path + '.part'
+    if os.path.exists(part_path):
+        os.remove(part_path)
+    try:
+        stream = fits.StreamingHDU(part_path, header)
+        try:
+            for block, t_block in blocks:
+                block = np.asarray(block, dtype='>f4')
+                if block.shape[0] == 0:
+                    continue
+                if n_t + block.shape[0] > data_shape[0] or block.shape[1] != data_shape[1]:
+                    raise ValueError('block of shape ' + str(block.shape) +
+                                     ' does not fit in data of shape ' + str(data_shape))
+                with np.errstate(invalid='ignore'):
+                    if np.any(np.isfinite(block)):
+                        data_min = min(data_min, np.nanmin(block))
+                        data_max = max(data_max, np.nanmax(block))
+                stream.write(block)
+                t_list.append(t_block)
+                n_t += block.shape[0]
+        finally:
+            stream.close()
+        if n_t != data_shape[0]:
+            raise ValueError('got ' + str(n_t) + ' time stamps, expected ' + str(data_shape[0]))
+
+        t_fits = np.concatenate(t_list, axis=0)
+        hdu_lofar_axes = cook_fits_spectr_axes_hdu(t_fits, f_fits)
+        fits.append(part_path, hdu_lofar_axes.data, hdu_lofar_axes.header)
+        with fits.open(part_path, mode='update') as hdul:
+            hdul[0].header['DATAMIN'] = max(data_min, 1.e-10)
+            hdul[0].header['DATAMAX'] = min(data_max, 1.e20)
+    except BaseException:
+        # no header-only or truncated fits is left behind
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    os.replace(part_path, out_path)
+
+    return t_fits
+
+
+def combine_fits_spectr_stokes(fits_paths, out_path, overwrite=True):
+    """combine the dynamic spectrum fits files of the Stokes of one chunk into
+    one multi-extension fits file: the primary HDU of the first file, one image
+    extension per other Stokes (EXTNAME is the STOKES keyword), and the axes
+    table of the first file, the time and frequency axes are shared
+
+    Args:
+        fits_paths (list): fits files from cook_fits_spectr_hdu or write_fits_spectr_stream,
+            of the same chunk and beam
+        out_path (str): output fits file
+        overwrite (bool, optional): overwrite existing file. Defaults to True.
+
+    Returns:
+        str: out_path
+    """
+    hdul_list = [fits.open(fits_path, memmap=True) for fits_path in fits_paths]
+    try:
+        shape = hdul_list[0][0].data.shape
+        combined = [fits.PrimaryHDU(hdul_list[0][0].data, hdul_list[0][0].header)]
+        for hdul in hdul_list[1:]:
+            if hdul[0].data.shape != shape:
+                raise ValueError('Stokes of shape ' + str(hdul[0].data.shape) + ' and ' + str(shape)
+                                 + ' can not be combined')
+            header = hdul[0].header.copy()
+            for key in ['SIMPLE', 'EXTEND']:
+                header.remove(key, ignore_missing=True)
+            combined.append(fits.ImageHDU(hdul[0].data, header, name=header.get('STOKES', None)))
+        combined.append(fits.BinTableHDU(hdul_list[0][1].data, hdul_list[0][1].header))
+        combined[0].header['NSTOKES'] = len(fits_paths)
+        fits.HDUList(combined).writeto(out_path, overwrite=overwrite)
+    finally:
+        for hdul in hdul_list:
+            hdul.close()
+    return out_path
+
+
 ####################
 # for averaging
 
@@ -224,13 +631,134 @@ def avg_1d(x, N):
     return (cumsum[N::N] - cumsum[:-N:N]) / float(N)
 
 
+def block_reduce(arr_query, n_point, axis=0, start_idx=-1, end_idx=-1,
+                 nan_policy='propagate', weights=None, partial=False):
+    """
+    Average consecutive blocks of n_point samples along one axis of an array.
+
+    The selected range is reshaped to (..., out_size, n_point, ...) and averaged
+    over the block axis, the only array allocated for a plain mean is the output.
+
+    Parameters
+    ----------
+    arr_query : numpy.ndarray
+        The array to be downsampled, of any dimension.
+    n_point : int
+        Number of points in each block over which the averaging is performed.
+    axis : int, optional
+        The axis along which to average. Default is 0.
+    start_idx : int, optional
+        The starting index for averaging. Default is the first index of the array.
+    end_idx : int, optional
+        The ending index for averaging. Default is the last index of the array.
+    nan_policy : str, optional
+        'propagate' for the plain mean, 'omit' to ignore the NaN values (nanmean).
+        Default is 'propagate'.
+    weights : numpy.ndarray, optional
+        Weights of the samples, of the same shape as arr_query or 1D along axis,
+        the blocks are then weighted means. Default is None.
+    partial : bool, optional
+        Average the trailing samples that do not fill a block into one more
+        output sample, otherwise they are dropped. Default is False.
+
+    Returns
+    -------
+    numpy.ndarray
+        The resulting downsampled array.
+
+    Examples
+    --------
+    >>> arr = np.arange(10.).reshape(5, 2)
+    >>> block_reduce(arr, 2, axis=0)
+    array([[1., 2.],
+           [5., 6.]])
+    >>> block_reduce(arr, 2, axis=0, partial=True)
+    array([[1., 2.],
+           [5., 6.],
+           [8., 9.]])
+    """
+    if nan_policy not in ('propagate', 'omit'):
+        raise ValueError(f"Invalid nan_policy: {nan_policy}")
+    arr_query = np.asarray(arr_query)
+    axis = axis % arr_query.ndim
+    start_idx = 0 if start_idx < 0 else start_idx
+    end_idx = arr_query.shape[axis] if end_idx < 0 else end_idx
+    out_size = ((end_idx-start_idx) // n_point)
+    full_end = start_idx + out_size * n_point
+
+    if weights is not None:
+        weights = np.asarray(weights)
+        if weights.ndim == 1 and arr_query.ndim > 1:
+            weights = weights.reshape((-1,) + (1,) * (arr_query.ndim - axis - 1))
+        weights = np.broadcast_to(weights, arr_query.shape)
+
+    def select(arr, idx_start, idx_end, n_block, n_len):
+        # [idx_start, idx_end) along axis, with the axis split into (n_block, n_len)
+        arr = arr[(slice(None),) * axis + (slice(idx_start, idx_end),)]
+        return arr.reshape(arr.shape[:axis] + (n_block, n_len) + arr.shape[axis + 1:])
+
+    def reduce(idx_start, idx_end, n_block, n_len):
+        blocks = select(arr_query, idx_start, idx_end, n_block, n_len)
+        if weights is None:
+            if nan_policy == 'omit':
+                return np.nanmean(blocks, axis=axis + 1)
+            return np.mean(blocks, axis=axis + 1)
+        w_blocks = select(weights, idx_start, idx_end, n_block, n_len)
+        if nan_policy == 'omit':
+            w_blocks = np.where(np.isnan(blocks), 0, w_blocks)
+            blocks = np.where(np.isnan(blocks), 0, blocks)
+        return np.sum(blocks * w_blocks, axis=axis + 1) / np.sum(w_blocks, axis=axis + 1)
+
+    res = reduce(start_idx, full_end, out_size, n_point)
+    if partial and end_idx > full_end:
+        res = np.concatenate([res, reduce(full_end, end_idx, 1, end_idx - full_end)], axis=axis)
+    return res
+
+
+def box_average_2d(arr_query, t_window, f_window, flag=None):
+    """
+    Average a 2D array over non-overlapping t_window x f_window boxes.
+
+    Same as the strided conv2d with a box kernel, the trailing rows and columns
+    that do not fill a box are dropped.
+
+    Parameters
+    ----------
+    arr_query : numpy.ndarray
+        The 2D array [t,f] to be downsampled.
+    t_window : int
+        Size of the boxes along axis 0.
+    f_window : int
+        Size of the boxes along axis 1.
+    flag : numpy.ndarray, optional
+        Boolean mask of the pixels excluded from the average, a box with all
+        its pixels flagged gives NaN. Default is None.
+
+    Returns
+    -------
+    numpy.ndarray
+        The downsampled array, float32.
+    """
+    n_t, n_f = arr_query.shape[0] // t_window, arr_query.shape[1] // f_window
+
+    def box_sum(arr):
+        # sum the rows of each box first, they are contiguous
+        boxes = arr[:n_t * t_window, :n_f * f_window].reshape(n_t, t_window, n_f, f_window)
+        return boxes.sum(axis=1, dtype=np.float32).sum(axis=-1, dtype=np.float32)
+
+    arr_query = np.asarray(arr_query)
+    if flag is None:
+        return box_sum(arr_query) / np.float32(t_window * f_window)
+    keep = ~np.asarray(flag, dtype=bool)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return box_sum(arr_query * keep) / box_sum(keep)
+
+
 def averaging_stride(arr_query, n_point, axis=0, start_idx=-1, end_idx=-1):
     """
     Perform downsampling of a 2D array by averaging over strided subarrays.
     
-    This function is designed for scenarios where the 2D array is large but the
-    number of points to average (n_point) is small. The resulting array is not
-    significantly smaller than the original.
+    Kept for compatibility, the averaging is done by block_reduce.
 
     Parameters
     ----------
@@ -255,23 +783,8 @@ def averaging_stride(arr_query, n_point, axis=0, start_idx=-1, end_idx=-1):
     >>> arr = np.array([[1, 2, 3], [4, 5, 6], [7, 8, 9], [10, 11, 12]])
     >>> averaging_stride(arr, 2, axis=0)
     Output will be the downsampled array along axis 0.
-
-    Notes
-    -----
-    This function is optimized for small downsampling ratios where n_point is small.
     """
-    start_idx = 0 if start_idx < 0 else start_idx
-    end_idx = arr_query.shape[axis] if end_idx < 0 else end_idx
-    out_size = ((end_idx-start_idx) // n_point)
-
-    res = 0
-    if axis == 1:
-        res = np.mean(np.array(([arr_query[:, (start_idx+idx):(start_idx+(out_size)*n_point+idx):n_point]
-                                 for idx in range(n_point)])), axis=0)
-    else:
-        res = np.mean(np.array(([arr_query[(start_idx+idx):(start_idx+(out_size)*n_point+idx):n_point, :]
-                                 for idx in range(n_point)])), axis=0)
-    return res
+    return block_reduce(arr_query, n_point, axis, start_idx, end_idx)
 
 
 
@@ -279,9 +792,7 @@ def averaging_walk(arr_query, n_point, axis=0, start_idx=-1, end_idx=-1):
     """
     Perform downsampling of a 2D array by averaging over contiguous subarrays.
 
-    This function is designed for scenarios where the 2D array is large and the
-    number of points to average (n_point) is also large. The result is a much
-    smaller array.
+    Kept for compatibility, the averaging is done by block_reduce.
 
     Parameters
     ----------
@@ -306,24 +817,38 @@ def averaging_walk(arr_query, n_point, axis=0, start_idx=-1, end_idx=-1):
     >>> arr = np.array([[1, 2, 3], [4, 5, 6], [7, 8, 9], [10, 11, 12]])
     >>> averaging_walk(arr, 2, axis=0)
     Output will be the downsampled array along axis 0.
-
-    Notes
-    -----
-    This function is optimized for large downsampling ratios where n_point is large.
     """
-    
-    start_idx = 0 if start_idx < 0 else start_idx
-    end_idx = arr_query.shape[axis] if end_idx < 0 else end_idx
-    out_size = ((end_idx-start_idx) // n_point)
-
-    res = 0
-    if axis == 1:
-        res = np.mean(np.stack(
-            ([(arr_query[:, (start_idx+idx*n_point):(start_idx+(idx+1)*n_point)]) for idx in range(out_size)]), axis=2), axis=axis)
-    else:
-        res = np.mean(np.stack(
-            ([(arr_query[(start_idx+idx*n_point):(start_idx+(idx+1)*n_point), :]) for idx in range(out_size)]), axis=2).swapaxes(1, 2), axis=axis)
-    return res
+    return block_reduce(arr_query, n_point, axis, start_idx, end_idx)
+
+
+# log-polynomial flux models of the calibrators, from https://arxiv.org/pdf/1609.05940.pdf
+# log10(S[Jy]) = sum_j p_j * log10(f[GHz])**j, coefficients padded with zeros to the highest order
+_cal_flux_params = {
+    'j0133-3629': [1.0440, -0.662, -0.225],
+    '3c48': [1.3253, -0.7553, -0.1914, 0.0498],
+    'fora': [2.218, -0.661],
+    '3c123': [1.8017, -0.7884, -0.1035, -0.0248, 0.0090],
+    'j0444-2809': [0.9710, -0.894, -0.118],
+    '3c138': [1.0088, -0.4981, -0.155, -0.010, 0.022],
+    'pica': [1.9380, -0.7470, -0.074],
+    'taua': [2.9516, -0.217, -0.047, -0.067],
+    '3c247': [1.4516, -0.6961, -0.201, 0.064, -0.046, 0.029],
+    '3c196': [1.2872, -0.8530, -0.153, -0.0200, 0.0201],
+    'hyda': [1.7795, -0.9176, -0.084, -0.0139, 0.030],
+    'vira': [2.4466, -0.8116, -0.048],
+    '3c286': [1.2481, -0.4507, -0.1798, 0.0357],
+    '3c295': [1.4701, -0.7658, -0.2780, -0.0347, 0.0399],
+    'hera': [1.8298, -1.0247, -0.0951],
+    '3c353': [1.8627, -0.6938, -0.100, -0.032],
+    '3c380': [1.2320, -0.791, 0.095, 0.098, -0.18, -0.16],
+    '3c444': [3.3498, -1.0022, -0.22, 0.023, 0.043],
+    'casa': [3.3584, -0.7518, -0.035, -0.071]
+}
+cal_flux_names = list(_cal_flux_params.keys())
+_cal_flux_index = {name: idx for idx, name in enumerate(cal_flux_names)}
+_cal_flux_coeffs = np.zeros((len(cal_flux_names), max(len(p) for p in _cal_flux_params.values())))
+for _idx, _params in enumerate(_cal_flux_params.values()):
+    _cal_flux_coeffs[_idx, :len(_params)] = _params
 
 
 def model_flux(calibrator, frequency):
@@ -332,89 +857,100 @@ def model_flux(calibrator, frequency):
     
     Parameters
     -----------
-    calibrator : str
-        Name of the calibrator source.
-    frequency : float
+    calibrator : str or array of str
+        Name of the calibrator source (case insensitive, see cal_flux_names),
+        an array of names is broadcast against frequency.
+    frequency : float or ndarray
         Frequency in MHz for which to calculate the flux.
         
     Returns
     --------
-    float
-        Model flux in sfu (solar flux units).
+    float or ndarray
+        Model flux in sfu (solar flux units), of the broadcast shape of
+        calibrator and frequency.
         
     Notes
     ------
     The parameters for each calibrator source are sourced from https://arxiv.org/pdf/1609.05940.pdf.
+
+    Examples
+    ---------
+    >>> model_flux('CasA', freq_sun)
+    >>> model_flux(np.array(['CasA', 'TauA'])[:, None], freq_sun)
     '''
     
-    cal_params = {
-        'j0133-3629': [1.0440, -0.662, -0.225],
-        '3c48': [1.3253, -0.7553, -0.1914, 0.0498],
-        'fora': [2.218, -0.661],
-        '3c123': [1.8017, -0.7884, -0.1035, -0.0248, 0.0090],
-        'j0444-2809': [0.9710, -0.894, -0.118],
-        '3c138': [1.0088, -0.4981, -0.155, -0.010, 0.022],
-        'pica': [1.9380, -0.7470, -0.074],
-        'taua': [2.9516, -0.217, -0.047, -0.067],
-        '3c247': [1.4516, -0.6961, -0.201, 0.064, -0.046, 0.029],
-        '3c196': [1.2872, -0.8530, -0.153, -0.0200, 0.0201],
-        'hyda': [1.7795, -0.9176, -0.084, -0.0139, 0.030],
-        'vira': [2.4466, -0.8116, -0.048],
-        '3c286': [1.2481, -0.4507, -0.1798, 0.0357],
-        '3c295': [1.4701, -0.7658, -0.2780, -0.0347, 0.0399],
-        'hera': [1.8298, -1.0247, -0.0951],
-        '3c353': [1.8627, -0.6938, -0.100, -0.032],
-        '3c380': [1.2320, -0.791, 0.095, 0.098, -0.18, -0.16],
-        '3c444': [3.3498, -1.0022, -0.22, 0.023, 0.043],
-        'casa': [3.3584, -0.7518, -0.035, -0.071]
-    }
     # Fetch the parameters
-    params = cal_params.get(calibrator.lower())
-    
-    # Check if the calibrator exists
-    if params is None:
-        raise ValueError(f"Invalid calibrator: {calibrator}")
-        
+    names = np.char.lower(np.asarray(calibrator, dtype=str))
+    idx = np.empty(names.shape, dtype=int)
+    for pos, name in np.ndenumerate(names):
+        # Check if the calibrator exists
+        if name not in _cal_flux_index:
+            raise ValueError(f"Invalid calibrator: {name}")
+        idx[pos] = _cal_flux_index[name]
+    coeffs = np.moveaxis(_cal_flux_coeffs[idx], -1, 0)
+
     # Calculate the flux model
-    freq_GHz = frequency / 1e3
-    flux_model = sum(p * np.log10(freq_GHz) ** j for j, p in enumerate(params))
+    freq_GHz = np.asarray(frequency, dtype=np.float64) / 1e3
+    flux_model = np.polynomial.polynomial.polyval(np.log10(freq_GHz), coeffs, tensor=False)
     return 10 ** flux_model * 1e-4
 
 
-def partition_avg(arr, ratio_range):
+def partition_avg(arr, ratio_range, axis=None):
     #  average in a given ratio range to exclude extreme value
-    arr_sort = np.sort(arr.ravel())
-    nums = arr_sort[int(ratio_range[0]*arr_sort.shape[0]) 
-                    :int(ratio_range[1]*arr_sort.shape[0])]
-    return np.mean(nums)
+    #  along axis, or of the flattened array if axis is None
+    if axis is None:
+        arr, axis = np.ravel(arr), 0
+    arr = np.moveaxis(np.asarray(arr), axis, 0)
+    num = arr.shape[0]
+    idx_lower, idx_upper = int(ratio_range[0]*num), int(ratio_range[1]*num)
+    if idx_upper > idx_lower:
+        # only the two ends of the range need to be in place, not a full sort
+        arr = np.partition(arr, sorted({idx_lower, idx_upper - 1}), axis=0)
+    return np.mean(arr[idx_lower:idx_upper], axis=0)
 
 
-def get_cal_bandpass(freq_idx, h5dir, h5name, ratio_range=[0.2, 0.8]):
-    fname_DS = h5name
-    this_dir = os.getcwd()
-    os.chdir(h5dir)
-    m = re.search('B[0-9]{3}', fname_DS)
+def get_cal_bandpass(freq_idx, h5dir, h5name, ratio_range=[0.2, 0.8], n_sample=1000, slab_len=128):
+    """ Bandpass of the calibrator, trimmed mean of every channel over time
+
+    About n_sample time samples evenly spaced over the observation are read
+    for all the channels at once, in slabs of slab_len samples.
+
+    Args:
+        freq_idx (1d array): index of the channels
+        h5dir (str): directory of the h5 file
+        h5name (str): name of the h5 file, e.g. L123456_SAP000_B000_S0_P000_bf.h5
+        ratio_range (list, optional): range of the sorted samples to average. Defaults to [0.2, 0.8].
+        n_sample (int, optional): number of time samples to use. Defaults to 1000.
+        slab_len (int, optional): number of time samples read at once. Defaults to 128.
+
+    Returns:
+        1d array: bandpass of the calibrator for the channels freq_idx
+    """
+    fname_DS = os.path.abspath(os.path.join(h5dir, h5name))
+    m = re.search('B[0-9]{3}', h5name)
     beam_this = m.group(0)[1:4]
-    m = re.search('SAP[0-9]{3}', fname_DS)
+    m = re.search('SAP[0-9]{3}', h5name)
     SAP = m.group(0)[3:6]
 
-    f = h5py.File(fname_DS, 'r')
-    data_shape = f['SUB_ARRAY_POINTING_'+SAP +
-                   '/BEAM_'+beam_this+'/STOKES_0'].shape
+    with h5py.File(fname_DS, 'r') as f:
+        data_array = f['SUB_ARRAY_POINTING_'+SAP +
+                       '/BEAM_'+beam_this+'/STOKES_0']
+        data_shape = data_array.shape
 
-    if data_shape[0] > 1e3:
-        sampling = int(data_shape[0]/1e3)
-    else:
-        sampling = 1
+        if data_shape[0] > n_sample:
+            sampling = int(data_shape[0]/n_sample)
+        else:
+            sampling = 1
 
-    bandpass_cal = []
-    for this_freq_idx in tqdm(freq_idx, ascii=True, desc='Bulding Cal-bandpass'):
-        data_lightcurve_cal = f['SUB_ARRAY_POINTING_'+SAP +
-                                '/BEAM_'+beam_this+'/STOKES_0'][::sampling, this_freq_idx]
-        bandpass_cal.append(partition_avg(data_lightcurve_cal, ratio_range))
+        slab_step = slab_len * sampling
+        slabs = [slice(idx, min(idx + slab_step, data_shape[0]), sampling)
+                 for idx in range(0, data_shape[0], slab_step)]
+        data_lightcurve_cal = np.concatenate(
+            [slab_data[:, freq_idx] for slab_data in tqdm(
+                prefetch_h5_slabs(data_array, slabs), total=len(slabs),
+                ascii=True, desc='Bulding Cal-bandpass')], axis=0)
 
-    os.chdir(this_dir)
-    return bandpass_cal
+    return partition_avg(data_lightcurve_cal, ratio_range, axis=0)
 
 
 def avg_with_lightening_flag(array_dirty, idx_start, idx_end, f_avg_range=[1600, 3500],
@@ -531,19 +1067,20 @@ def mask_extend_xy_npix(mask, n_pix_x, n_pix_y):
     
     # Initialize an output mask of the same shape as the input, filled with 'True'
     mask_extend = np.ones_like(mask)
-    # Loop through each row in the mask
-    for i in range(mask.shape[0]):        
-        # Find indices in the row where the mask is 'False'
-        idx = np.where(1 - mask[i, :])[0]
-        # Extend the mask in both x and y directions for each found index
-        for j in idx:
-            mask_extend[max(i - n_pix_y + 1, 0):min(i + n_pix_y, mask.shape[0]),
-                        max(j - n_pix_x + 1, 0):min(j + n_pix_x, mask.shape[1])] = 0            
+    # each 'False' pixel masks the box of (2*n_pix_y-1) x (2*n_pix_x-1) pixels centered on it,
+    # which is a binary dilation of the 'False' pixels, done separably along y then x
+    if n_pix_x < 1 or n_pix_y < 1 or mask.size == 0:
+        return mask_extend
+    masked = ((1 - mask) != 0).view(np.uint8)
+    masked = scipy.ndimage.maximum_filter1d(masked, 2 * n_pix_y - 1, axis=0, mode='constant', cval=0)
+    masked = scipy.ndimage.maximum_filter1d(masked, 2 * n_pix_x - 1, axis=1, mode='constant', cval=0)
+    mask_extend[masked.view(bool)] = 0
     return mask_extend
 
 
 
-def flag_frequency_slices(dynspec_cal, mask_cal, ratio_flag=1.5, lower_perc=15, upper_perc=40):
+def flag_frequency_slices(dynspec_cal, mask_cal, ratio_flag=1.5, lower_perc=15, upper_perc=40,
+                          chunk_size=256):
     """
     Flag individual pixels in each frequency slice of the calibration dynamic spectrum.
 
@@ -556,22 +1093,28 @@ def flag_frequency_slices(dynspec_cal, mask_cal, ratio_flag=1.5, lower_perc=15,
         The calibration dynamic spectrum.
     mask_cal : ndarray
         The existing mask for the calibration dynamic spectrum.
+    chunk_size : int, optional
+        Number of frequency slices processed at once, None for all of them,
+        default is 256.
     
     Returns
     -------------
     mask_cal: ndarray
         Updated mask for the calibration dynamic spectrum.
     """
-    for freq_idx in np.arange(dynspec_cal.shape[1]):
-        mask_freq = mask_cal[:, freq_idx]
-        dyspec_freq = dynspec_cal[:, freq_idx]
-        
-        idx = np.where(dyspec_freq > ratio_flag * np.mean(dyspec_freq[np.where(
-            (dyspec_freq > np.percentile(dyspec_freq, lower_perc)) & 
-            (dyspec_freq < np.percentile(dyspec_freq, upper_perc)))[0]]))[0]
-        
-        mask_freq[idx] = 0
-        mask_cal[:, freq_idx] = mask_freq
+    num_freq = dynspec_cal.shape[1]
+    chunk_size = num_freq if chunk_size is None else max(int(chunk_size), 1)
+    for freq_start in range(0, num_freq, chunk_size):
+        dyspec_chunk = dynspec_cal[:, freq_start:freq_start + chunk_size]
+
+        perc_lower, perc_upper = np.percentile(dyspec_chunk, [lower_perc, upper_perc], axis=0)
+        in_range = (dyspec_chunk > perc_lower) & (dyspec_chunk < perc_upper)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_in_range = (np.where(in_range, dyspec_chunk, 0).sum(axis=0)
+                             / in_range.sum(axis=0))
+            flagged = dyspec_chunk > ratio_flag * mean_in_range
+
+        mask_cal[:, freq_start:freq_start + chunk_size][flagged] = 0
     
     return mask_cal
 
@@ -600,9 +1143,12 @@ def perform_linear_interpolation(dynspec_cal_copy, mask_cal, t_cal):
     """
     
     robust_fill_value = 0
-    for freq_idx in np.arange(dynspec_cal_copy.shape[1]):
-        mask_freq = mask_cal[:, freq_idx]
-        dyspec_freq = dynspec_cal_copy[:, freq_idx]
+    # one contiguous row per frequency slice, the columns of the [t,f] array are strided
+    dyspec_T = np.ascontiguousarray(dynspec_cal_copy.T)
+    mask_T = np.ascontiguousarray(mask_cal.T)
+    for freq_idx in np.arange(dyspec_T.shape[0]):
+        mask_freq = mask_T[freq_idx]
+        dyspec_freq = dyspec_T[freq_idx]
         try:
             res_interp = np.interp(t_cal[~mask_freq], t_cal[mask_freq], dyspec_freq[mask_freq])
             robust_fill_value = np.nanmean(res_interp)
@@ -610,12 +1156,85 @@ def perform_linear_interpolation(dynspec_cal_copy, mask_cal, t_cal):
             res_interp = np.full_like(t_cal[~mask_freq], robust_fill_value)
             # print error message if interpolation fails
             print("Warning: interpolation failed for frequency slice", freq_idx)
-        dynspec_cal_copy[~mask_freq, freq_idx] = res_interp.ravel()
-        
+        dyspec_freq[~mask_freq] = res_interp.ravel()
+    dynspec_cal_copy[...] = dyspec_T.T
     
     return dynspec_cal_copy
 
 
+def interp_columns(x, xp, fp):
+    """
+    Linear interpolation of every column of a 2D array, as np.interp does for each of them.
+
+    Parameters
+    -------------
+    x : ndarray (1D)
+        Coordinates at which to evaluate the interpolated values.
+    xp : ndarray (1D)
+        Increasing coordinates of the rows of fp.
+    fp : ndarray (2D)
+        Values to interpolate, of shape (len(xp), N).
+
+    Returns
+    -------------
+    res : ndarray (2D)
+        Interpolated values, of shape (len(x), N), the values outside of xp
+        take the first (last) row of fp.
+    """
+    x = np.asarray(x, dtype=np.float64).ravel()
+    xp = np.asarray(xp, dtype=np.float64).ravel()
+    fp = np.asarray(fp, dtype=np.float64)
+    if xp.shape[0] == 1:
+        return np.repeat(fp[:1, :], x.shape[0], axis=0)
+
+    idx = np.clip(np.searchsorted(xp, x, side='right') - 1, 0, xp.shape[0] - 2)
+    x_step = (xp[idx + 1] - xp[idx])[:, None]
+    x_offset = (x - xp[idx])[:, None]
+
+    # same arithmetic as np.interp, in blocks of rows small enough to stay in cache
+    res = np.empty((x.shape[0], fp.shape[1]))
+    block = max(1, 2 ** 16 // max(fp.shape[1], 1))
+    for start in range(0, x.shape[0], block):
+        rows = slice(start, start + block)
+        res_block = res[rows]
+        np.subtract(fp[idx[rows] + 1, :], fp[idx[rows], :], out=res_block)
+        res_block /= x_step[rows]
+        res_block *= x_offset[rows]
+        res_block += fp[idx[rows], :]
+    res[x < xp[0], :] = fp[0, :]
+    res[x >= xp[-1], :] = fp[-1, :]
+    return res
+
+
+def regrid_bilinear(x_src, y_src, data_src, x_dst, y_dst):
+    """
+    Separable bilinear regrid of a 2D array, first along y then along x.
+
+    Gives the same result as np.interp of every row onto y_dst followed by
+    np.interp of every column onto x_dst.
+
+    Parameters
+    -------------
+    x_src, y_src : ndarray (1D)
+        Increasing coordinates of the two axes of data_src.
+    data_src : ndarray (2D)
+        Values on the source grid, of shape (len(x_src), len(y_src)).
+    x_dst, y_dst : ndarray (1D)
+        Coordinates of the destination grid.
+
+    Returns
+    -------------
+    data_dst : ndarray (2D)
+        Values on the destination grid, of shape (len(x_dst), len(y_dst)).
+
+    Examples
+    -------------
+    >>> calib_bandpass = regrid_bilinear(t_cal, f_cal, dynspec_cal, time_sun, freq_sun)
+    """
+    data_y = interp_columns(y_dst, y_src, np.asarray(data_src).T).T
+    return interp_columns(x_dst, x_src, data_y)
+
+
 def proc_calib_dynspec(dynspec_sun, dynspec_cal, time_sun, freq_sun, 
                        t_cal, f_cal, abs_thresh=1e14):
     """
@@ -698,16 +1317,10 @@ def proc_calib_dynspec(dynspec_sun, dynspec_cal, time_sun, freq_sun,
     t_cal_averaging = averaging_stride(t_cal[:, None], 16, 0)
 
     # Step 8: Calibrating the dynamic spectrum
-    calib_bandpass = np.zeros_like(dynspec_sun)
-    tmp_calib_lst = []
-    for time_idx, time in enumerate(t_cal_averaging):
-        tmp_calib_lst.append(np.interp(freq_sun, f_cal, dynspec_cal_copy_averaging[time_idx, :]))
-    tmp_calib_arr = np.array(tmp_calib_lst)
-    for freq_idx, freq in enumerate(freq_sun):
-        calib_bandpass[:, freq_idx] = np.interp(time_sun, t_cal_averaging[:, 0], tmp_calib_arr[:, freq_idx])
-    model_arr = np.array([model_flux('CasA', freq) for freq in freq_sun])
-    model_final = np.repeat(model_arr[:, None], calib_bandpass.shape[0], axis=1).T
-    calibrated_dynspec = dynspec_sun / calib_bandpass * model_final
+    calib_bandpass = regrid_bilinear(t_cal_averaging[:, 0], f_cal, dynspec_cal_copy_averaging,
+                                     time_sun, freq_sun).astype(dynspec_sun.dtype, copy=False)
+    model_arr = model_flux('CasA', np.asarray(freq_sun))
+    calibrated_dynspec = dynspec_sun / calib_bandpass * model_arr[None, :]
 
     return calibrated_dynspec, dynspec_cal, dynspec_cal_copy, mask_cal, mask_cal_2nd
 
@@ -800,13 +1413,8 @@ def proc_selfcalib_dynspec(dynspec_sun, time_sun, freq_sun, abs_thresh = 2e14):
     dynspec_cal_bp  = averaging_stride(dynspec_cal_copy_averaging, 16, 0)
     t_cal_bp = averaging_stride(t_cal_averaging[:, None], 16, 0).ravel()
 
-    # Initializing arrays for the calibrated bandpass and dynamic spectrum
-    calib_bp = np.zeros_like(dynspec_sun)
-    calibrated_dynspec = np.zeros_like(dynspec_sun)
-
-    # Calibrating each frequency slice
-    for freq_idx, freq in enumerate(freq_sun):
-        calib_bp[:, freq_idx] = np.interp(time_sun, t_cal_bp, dynspec_cal_bp[:, freq_idx])
-        calibrated_dynspec[:, freq_idx] = dynspec_sun[:, freq_idx] / calib_bp[:, freq_idx]
+    # Calibrating all the frequency slices
+    calib_bp = interp_columns(time_sun, t_cal_bp, dynspec_cal_bp).astype(dynspec_sun.dtype, copy=False)
+    calibrated_dynspec = dynspec_sun / calib_bp
 
     return calibrated_dynspec, mask_cal, dynspec_cal_bp
\ No newline at end of file
@@ -3,21 +3,40 @@
 A script to convert between the J2000 and the sun.
 """
 
-from sunpy.coordinates.sun import sky_position, P
 import numpy as np
+from lofarSun.sun_ephem import sun_ephem
 
 
-def j2000xy(RA, DEC, t_sun):
-    [RA_sun, DEC_sun] = sky_position(t_sun, False)
-    rotate_angel = P(t_sun)
+def j2000xy(RA, DEC, t_sun, exact=False):
+    """convert J2000 RA, DEC (degree) to solar x, y (arcsec)
+
+    RA, DEC and t_sun are broadcast against each other, e.g. the track of
+    all the beams over the observation with RA[:, None], DEC[:, None] and
+    t_sun[None, :], the ephemerides of all the times are computed at once
+
+    Args:
+        RA (float or array): right ascension (degree)
+        DEC (float or array): declination (degree)
+        t_sun (datetime, datetime64, astropy Time or array of these): UTC time(s)
+        exact (bool, optional): sunpy ephemeris at every time instead of the
+            interpolated cached ephemeris, see lofarSun.sun_ephem. Defaults to False.
+
+    Returns:
+        list: [x, y] in arcsec, of the broadcast shape of RA, DEC and t_sun
+    """
+    # solar RA, DEC and P angle in degree, from the cached ephemeris
+    [RA_sun, DEC_sun, P_sun] = sun_ephem(t_sun, exact=exact)
+    rotate_angel = np.deg2rad(P_sun)
+    RA = np.asarray(RA, dtype=np.float64) if not np.isscalar(RA) else RA
+    DEC = np.asarray(DEC, dtype=np.float64) if not np.isscalar(DEC) else DEC
 
     # shift the center and transfer into arcsec
-    x_shift = -(RA - RA_sun.degree) * 3600
-    y_shift = (DEC - DEC_sun.degree) * 3600
+    x_shift = -(RA - RA_sun) * 3600
+    y_shift = (DEC - DEC_sun) * 3600
 
     # rotate xy according to the position angle
-    xx = x_shift * np.cos(-rotate_angel.rad) - y_shift * \
-        np.sin(-rotate_angel.rad)
-    yy = x_shift * np.sin(-rotate_angel.rad) + y_shift * \
-        np.cos(-rotate_angel.rad)
+    xx = x_shift * np.cos(-rotate_angel) - y_shift * \
+        np.sin(-rotate_angel)
+    yy = x_shift * np.sin(-rotate_angel) + y_shift * \
+        np.cos(-rotate_angel)
     return [xx, yy]
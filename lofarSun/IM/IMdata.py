@@ -13,8 +13,9 @@ import matplotlib.pyplot as plt
 
 import sunpy
 import sunpy.map
-from sunpy.coordinates.sun import sky_position, P, earth_distance
+from sunpy.coordinates.sun import earth_distance
 from sunpy.coordinates import frames
+from lofarSun.sun_ephem import sun_radec, sun_P
 from scipy.optimize import curve_fit
 from scipy.ndimage import gaussian_filter
 import scipy.ndimage
@@ -69,8 +70,8 @@ class IMdata:
 
     def get_cur_solar_centroid(self, t_obs):
         # use the observation time to get the solar center
-        [RA, DEC] = sky_position(t=t_obs, equinox_of_date=False)
-        return [RA.degree % 360, DEC.degree % 360]
+        [RA, DEC] = sun_radec(t_obs)
+        return [RA % 360, DEC % 360]
 
     def get_obs_image_centroid(self, header):
         # get the RA DEC center of the image from the solar center
@@ -111,7 +112,7 @@ class IMdata:
             if act_s == False:
                 x_shift_pix = 0
                 y_shift_pix = 0
-            rotate_angel = P(self.t_obs).degree
+            rotate_angel = sun_P(self.t_obs)
             if act_r == False:
                 rotate_angel = 0
             data_tmp = scipy.ndimage.shift(data, (x_shift_pix, y_shift_pix))
@@ -123,7 +124,7 @@ class IMdata:
 
     def get_beam(self):
         if self.havedata:
-            solar_PA = P(self.t_obs).degree
+            solar_PA = sun_P(self.t_obs)
             b_maj = self.header['BMAJ']
             b_min = self.header['BMIN']
             # should consider the beam for the data
@@ -157,7 +158,7 @@ class IMdata:
             frames.Helioprojective(observer=lofar_coord))
         cdelt1 = (np.abs(header['cdelt1'])*u.deg).to(u.arcsec)
         cdelt2 = (np.abs(header['cdelt2'])*u.deg).to(u.arcsec)
-        P1 = P(obstime)
+        P1 = sun_P(obstime)*u.deg
         new_header = sunpy.map.make_fitswcs_header(data, reference_coord_arcsec,
                                                    reference_pixel=u.Quantity(
                                                        [header['crpix1']-1, header['crpix2']-1]*u.pixel),
@@ -180,7 +181,7 @@ class IMdata:
                    ax_plt=None, **kwargs):
         if self.havedata:
             t_cur_datetime = self.t_obs
-            solar_PA = P(self.t_obs).degree
+            solar_PA = sun_P(self.t_obs)
             freq_cur = self.freq
             [b_maj, b_min, b_angel] = self.get_beam()
             b_maj = b_maj*3600
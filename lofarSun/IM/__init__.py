@@ -1,2 +1,23 @@
-from .IMdata import *
-from .MSinspect import *
\ No newline at end of file
+import importlib as _importlib
+
+# IMdata pulls in sunpy.map and astropy, the names of the submodules
+# are imported on first access only, as "from .IMdata import *" did
+_submodules = ['IMdata', 'MSinspect']
+
+
+def _load():
+    for module_name in _submodules:
+        module = _importlib.import_module('.' + module_name, __name__)
+        globals().update({key: value for key, value in vars(module).items()
+                          if not key.startswith('_')})
+
+
+def __getattr__(name):
+    if name.startswith('__') and name != '__all__':
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    _load()
+    if name == '__all__':
+        return [key for key in globals() if not key.startswith('_')]
+    if name in globals():
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+import os
+import glob
+import time
+import multiprocessing
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import h5py
+import matplotlib.dates as mdates
+from astropy.io import fits as fits
+
+import lofarSun.BF.bftools as bftools
+
+DESCRIPTION = '''
+Build the multi-beam data cube [freq, time, beam] of a LOFAR tied array
+beam formed observation, for BFcube.load_fits
+
+Input  :  hdf5 files of the beams of the observation (one beam per file)
+Output :  fits cube of the averaged dynamic spectra of all the beams
+
+(by Peijin.Zhang & Pietro Zucca 2019.10)
+'''
+
+# a spawned worker takes about a second to start and import, while one process
+# averages a few hundred MB of h5 per second, so a worker gets at least this much to read
+MIN_BYTES_PER_WORKER = 512 * 2**20
+
+
+def find_beam_files(inputs, pattern='*SAP000*.h5'):
+    """h5 files of the beams, sorted by name
+
+    Args:
+        inputs (str or list): h5 files and directories, the directories are
+            searched for pattern
+        pattern (str, optional): glob pattern of the beam files in the directories.
+            Defaults to '*SAP000*.h5'.
+
+    Returns:
+        list: absolute names of the h5 files
+    """
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    fnames = []
+    for item in inputs:
+        if os.path.isdir(item):
+            fnames += glob.glob(os.path.join(item, pattern))
+        else:
+            fnames.append(item)
+    return sorted(set(os.path.abspath(fname) for fname in fnames))
+
+
+def cube_time_bins(t_idx_count, tsamp, t_bin, t_start_ratio=0., t_end_ratio=1.):
+    """time bins of the cube, n_point consecutive samples each
+
+    Args:
+        t_idx_count (int): number of time samples of the beam
+        tsamp (float): sampling time (s)
+        t_bin (float): length of the time bins (s)
+        t_start_ratio, t_end_ratio (float, optional): part of the observation (0-1).
+            Defaults to 0. and 1.
+
+    Returns:
+        tuple: index of the first sample, samples per bin, number of bins
+    """
+    idx_start = int(t_start_ratio * (t_idx_count - 1))
+    idx_end = int(t_end_ratio * (t_idx_count - 1))
+    n_point = max(int(round(t_bin / tsamp)), 1)
+    return idx_start, n_point, (idx_end - idx_start) // n_point
+
+
+def ingest_beam(fname, t_bin, f_c_ratio, t_start_ratio=0., t_end_ratio=1.,
+                samples_per_slab=4096, n_prefetch=2, memmap=False):
+    """average the dynamic spectrum of one beam in time bins of t_bin seconds
+    and blocks of f_c_ratio channels, with bftools.block_reduce
+
+    Args:
+        fname (str): h5 file of the beam
+        t_bin (float): length of the time bins (s)
+        f_c_ratio (int): number of channels averaged
+        t_start_ratio, t_end_ratio (float, optional): part of the observation (0-1).
+            Defaults to 0. and 1.
+        samples_per_slab (int, optional): time samples read from the h5 at once,
+            rounded to whole bins. Defaults to 4096.
+        n_prefetch (int, optional): number of slabs read ahead in background. Defaults to 2.
+        memmap (bool, optional): read the h5 through a memory map when the dataset is
+            contiguous and uncompressed. Defaults to False.
+
+    Returns:
+        dict: data [time, freq] (float32), t_fits (mean time of the bins, matplotlib
+            dates), f_fits (MHz), ra, dec (pointing, deg), and the metadata of the beam
+    """
+    with h5py.File(fname, 'r') as f:
+        (dataset_uri, coordinates_uri, beam_key, stokes_key, pointing_ra, pointing_dec, tsamp,
+            project_id, obs_id, antenna_set_name, telescop_name, target_name, t_idx_count, f_idx_count,
+            t_start_bf, t_end_bf, freq, t_all) = bftools.h5_fetch_meta(f)
+        idx_start, n_point, n_bin = cube_time_bins(t_idx_count, tsamp, t_bin,
+                                                   t_start_ratio, t_end_ratio)
+        n_bin_slab = max(samples_per_slab // n_point, 1)
+        slabs = [slice(idx_start + idx_bin * n_point, idx_start + min(idx_bin + n_bin_slab, n_bin) * n_point)
+                 for idx_bin in range(0, n_bin, n_bin_slab)]
+        data = np.zeros((n_bin, f_idx_count // f_c_ratio), dtype=np.float32)
+        n_written = 0
+        reader = bftools.h5_data_reader(f[dataset_uri], memmap)
+        for stokes in bftools.prefetch_h5_slabs(reader, slabs, n_prefetch):
+            stokes = np.abs(stokes) + 1e-7
+            block = bftools.block_reduce(bftools.block_reduce(stokes, n_point, axis=0), f_c_ratio, axis=1)
+            data[n_written:n_written + block.shape[0]] = block
+            n_written += block.shape[0]
+
+    return {'data': data,
+            't_fits': bftools.block_reduce(t_all[idx_start:idx_start + n_bin * n_point], n_point),
+            'f_fits': bftools.block_reduce(freq, f_c_ratio),
+            'ra': float(pointing_ra), 'dec': float(pointing_dec),
+            'beam_key': beam_key, 'stokes_key': stokes_key,
+            'antenna_set_name': antenna_set_name, 'telescop_name': telescop_name,
+            'target_name': target_name, 't_start_bf': t_start_bf, 't_end_bf': t_end_bf}
+
+
+def _ingest_beam_worker(idx_beam, fname, settings):
+    return idx_beam, ingest_beam(fname, **settings)
+
+
+def cook_fits_cube_header(header, data_shape, t_fits, f_fits, beam):
+    """fill the primary header of the cube fits file
+
+    Args:
+        header (fits.Header): header to fill
+        data_shape (tuple): shape of the cube [freq, time, beam]
+        t_fits (1d array): time of the bins (matplotlib dates)
+        f_fits (1d array): frequency of the channels (MHz)
+        beam (dict): output of ingest_beam for one of the beams
+
+    Returns:
+        fits.Header: the filled header
+    """
+    t_start_bf, t_end_bf = beam['t_start_bf'], beam['t_end_bf']
+    header['SIMPLE'] = True
+    header['BITPIX'] = -32
+    header['NAXIS'] = 3
+    # fits axes are in reversed order
+    header['NAXIS1'] = data_shape[2]
+    header['NAXIS2'] = data_shape[1]
+    header['NAXIS3'] = data_shape[0]
+    header['EXTEND'] = True
+    header['DATE'] = t_start_bf.strftime("%Y-%m-%d")
+    header['CONTENT'] = t_start_bf.strftime("%Y/%m/%d") + ' LOFAR Beamform observation '
+    header['ORIGIN'] = 'ASTRON Netherlands'
+    header['TELESCOP'] = beam['telescop_name']
+    header['INSTRUME'] = beam['antenna_set_name']
+    header['OBJECT'] = beam['target_name']
+    header['DATE-OBS'] = t_start_bf.strftime("%Y/%m/%d")
+    header['TIME-OBS'] = t_start_bf.strftime("%H:%M:%S.%f")
+    header['DATE-END'] = t_end_bf.strftime("%Y/%m/%d")
+    header['TIME-END'] = t_end_bf.strftime("%H:%M:%S.%f")
+    header['BUNIT'] = 'digits  '
+    header['DATAMIN'] = 0.
+    header['DATAMAX'] = 0.
+    header['CRVAL1'] = 0
+    header['CRPIX1'] = 0
+    header['CTYPE1'] = 'BEAM'
+    header['CDELT1'] = 1
+    header['CRVAL2'] = t_fits[0]
+    header['CRPIX2'] = 0
+    header['CTYPE2'] = 'TIME'
+    header['CDELT2'] = np.mean(np.diff(t_fits)) if len(t_fits) > 1 else 0.
+    header['CRVAL3'] = f_fits[0]
+    header['CRPIX3'] = 0
+    header['CTYPE3'] = 'FREQ'
+    header['CDELT3'] = np.mean(np.diff(f_fits)) if len(f_fits) > 1 else 0.
+    header['STOKES'] = beam['stokes_key']
+    header['TITLE'] = "Lofar Solar beamformed"
+    header['HISTORY'] = '        '
+    return header
+
+
+def build_bf_cube(fnames, out_fname, t_bin=2.0, f_c_ratio=2, t_start_ratio=0., t_end_ratio=1.,
+                  workers=1, samples_per_slab=4096, n_prefetch=2, memmap=False, f_block=64):
+    """build the fits cube [freq, time, beam] of the beams, readable by BFcube.load_fits
+
+    The beams are averaged in a process pool (ingest_beam), each beam is written
+    as it comes into a preallocated beam-major cube on disk next to out_fname,
+    which is then streamed into the fits file f_block channels at a time,
+    the cube is never held in memory.
+
+    Args:
+        fnames (list): h5 files of the beams, see find_beam_files
+        out_fname (str): output fits file
+        t_bin (float, optional): length of the time bins (s). Defaults to 2.0.
+        f_c_ratio (int, optional): number of channels averaged. Defaults to 2.
+        t_start_ratio, t_end_ratio (float, optional): part of the observation (0-1).
+            Defaults to 0. and 1.
+        workers (int, optional): largest number of processes, each reads its beams by itself,
+            at most one per beam and per MIN_BYTES_PER_WORKER of h5 read in the time range,
+            small jobs run serially.
+            Defaults to 1.
+        samples_per_slab, n_prefetch, memmap: reading of the h5, see ingest_beam
+        f_block (int, optional): channels written to the fits at once. Defaults to 64.
+
+    Returns:
+        str: out_fname
+    """
+    from lofarSun.BF.lofarJ2000xySun import j2000xy
+
+    if len(fnames) == 0:
+        raise ValueError('no beam file')
+    settings = dict(t_bin=t_bin, f_c_ratio=f_c_ratio, t_start_ratio=t_start_ratio,
+                    t_end_ratio=t_end_ratio, samples_per_slab=samples_per_slab,
+                    n_prefetch=n_prefetch, memmap=memmap)
+    n_beam = len(fnames)
+    # only the part of the observation in t_start_ratio-t_end_ratio is read
+    n_bytes = sum(os.path.getsize(fname) for fname in fnames) * max(t_end_ratio - t_start_ratio, 0.)
+    workers = max(1, min(workers, n_beam, int(n_bytes // MIN_BYTES_PER_WORKER)))
+    out_fname = os.path.abspath(out_fname)
+    tmp_fname = out_fname + '.beams.npy'
+    ra_all, dec_all = np.zeros(n_beam), np.zeros(n_beam)
+    cube_beam, first = None, None
+    data_min, data_max = np.inf, -np.inf
+
+    def store(idx_beam, beam):
+        nonlocal cube_beam, first, data_min, data_max
+        if cube_beam is None:
+            first = beam
+            cube_beam = np.lib.format.open_memmap(tmp_fname, mode='w+', dtype=np.float32,
+                                                  shape=(n_beam,) + beam['data'].shape)
+        elif beam['data'].shape != cube_beam.shape[1:]:
+            raise ValueError('beam ' + fnames[idx_beam] + ' has the shape ' + str(beam['data'].shape)
+                             + ', expected ' + str(cube_beam.shape[1:]))
+        cube_beam[idx_beam] = beam['data']
+        ra_all[idx_beam], dec_all[idx_beam] = beam['ra'], beam['dec']
+        if beam['data'].size:
+            data_min = min(data_min, float(np.min(beam['data'])))
+            data_max = max(data_max, float(np.max(beam['data'])))
+        print('B' + str(idx_beam) + ' | ', end='', flush=True)
+
+    start_time = time.time()
+    try:
+        if workers > 1:
+            # spawn the workers, a forked h5py state is not safe to reuse
+            with ProcessPoolExecutor(max_workers=workers,
+                                     mp_context=multiprocessing.get_context('spawn')) as pool:
+                futures = [pool.submit(_ingest_beam_worker, idx_beam, fname, settings)
+                           for idx_beam, fname in enumerate(fnames)]
+                for future in as_completed(futures):
+                    store(*future.result())
+        else:
+            for idx_beam, fname in enumerate(fnames):
+                store(idx_beam, ingest_beam(fname, **settings))
+        print()
+
+        t_fits, f_fits = first['t_fits'], first['f_fits']
+        n_t, n_f = cube_beam.shape[1:]
+        [xx, yy] = j2000xy(ra_all, dec_all, mdates.num2date(t_fits[0]) if n_t else first['t_start_bf'])
+
+        if os.path.exists(out_fname):
+            os.remove(out_fname)
+        header = cook_fits_cube_header(fits.PrimaryHDU().header, (n_f, n_t, n_beam), t_fits, f_fits, first)
+        stream = fits.StreamingHDU(out_fname, header)
+        try:
+            for f_start in range(0, n_f, f_block):
+                block = cube_beam[:, :, f_start:f_start + f_block]
+                stream.write(np.ascontiguousarray(np.transpose(block, (2, 1, 0)), dtype='>f4'))
+        finally:
+            stream.close()
+    finally:
+        if cube_beam is not None:
+            del cube_beam
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+
+    col_f = fits.Column(name='FREQ', array=f_fits, format="D")
+    col_t = fits.Column(name='TIME', array=t_fits, format="D")
+    col_x = fits.Column(name='X', array=np.ravel(xx), format="D")
+    col_y = fits.Column(name='Y', array=np.ravel(yy), format="D")
+    for hdu in [fits.BinTableHDU.from_columns([col_f], name="FREQ"),
+                fits.BinTableHDU.from_columns([col_t], name="TIME"),
+                fits.BinTableHDU.from_columns([col_x, col_y], name="BeamXY")]:
+        fits.append(out_fname, hdu.data, hdu.header)
+    if np.isfinite(data_min):
+        with fits.open(out_fname, mode='update') as hdul:
+            hdul[0].header['DATAMIN'] = data_min
+            hdul[0].header['DATAMAX'] = data_max
+
+    print('Data shape [freq, time, beam]:', (n_f, n_t, n_beam))
+    print("--- %s seconds ---" % (time.time() - start_time))
+    return out_fname
+
+
+def parse_args():
+    parser = ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('inputs', nargs='+',
+                        help='h5 files of the beams, or directories containing them')
+    parser.add_argument('-o', '--output', help='output fits cube', required=True)
+    parser.add_argument('--pattern', help='glob pattern of the beam files in the directories',
+                        default='*SAP000*.h5')
+    parser.add_argument('--t_bin', help='length of the time bins in seconds', type=float, default=2.0)
+    parser.add_argument('--f_c_ratio', help='compression ratio of the frequency', type=int, default=2)
+    parser.add_argument('--t_start_ratio', help='start of the cube in the observation (0-1)',
+                        type=float, default=0.)
+    parser.add_argument('--t_end_ratio', help='end of the cube in the observation (0-1)',
+                        type=float, default=1.)
+    parser.add_argument('--workers', help='largest number of processes to read the beams in parallel, \
+        at most one per beam and per 512MB of h5 read, small jobs run serially', type=int, default=1)
+    parser.add_argument('--samples_per_slab', help='time samples read from the h5 at once, \
+        4096 means about 105MB for 6400 channels', type=int, default=4096)
+    parser.add_argument('--n_prefetch', help='number of slabs read ahead from the h5 in background, \
+        0 to disable', type=int, default=2)
+    parser.add_argument('--memmap', help='read the h5 through a memory map when the dataset is stored \
+        contiguously and uncompressed', default=False, action='store_true')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    fnames = find_beam_files(args.inputs, args.pattern)
+    print('Beams:', len(fnames))
+    build_bf_cube(fnames, args.output, t_bin=args.t_bin, f_c_ratio=args.f_c_ratio,
+                  t_start_ratio=args.t_start_ratio, t_end_ratio=args.t_end_ratio,
+                  workers=args.workers, samples_per_slab=args.samples_per_slab,
+                  n_prefetch=args.n_prefetch, memmap=args.memmap)
+
+
+if __name__ == '__main__':
+    main()
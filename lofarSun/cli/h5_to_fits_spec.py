@@ -2,20 +2,20 @@
 
 import time
 import lofarSun.BF.bftools as bftools
-from lofarSun.BF.lofarJ2000xySun import j2000xy
-from lofarSun.BF.RFIconvFlag import *
 import gc
 import matplotlib.pyplot as plt
 from astropy.io import fits as fits
-import torch
 import numpy as np
 import matplotlib.dates as mdates
 import matplotlib
 import h5py
 import matplotlib.image as mpimg
 import io,os,json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
 import base64
-from argparse import ArgumentParser
+from argparse import ArgumentParser, BooleanOptionalAction
 import datetime
 DESCRIPTION = '''
 Split and down sample the dynamic spectrum of LOFAR observation
@@ -26,8 +26,6 @@ Output :  Small fits file with json and png quickview
 (by Peijin.Zhang & Pietro Zucca 2019.08)
 '''
 
-device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-
 matplotlib.use('agg')
 
 lofar_logo_base64 = 'iVBORw0KGgoAAAANSUhEUgAAAEAAAABACAIAAAAlC+aJAAAURklEQVR4nLx6CXRcZfn3733vMlsmy2RfmrXpkhRo0i0tXUEE2gKloqiAyidLLShyPi0qKggeFzzfUT9BAY8i8BeqgEilKxQotWu6pk26ZN8nyWSZzH6393/eOzNJppRS6HLPnHbyzr33fX7P/jzvIzLGcJkvppn/URB64S8jFxUAAwi0UYSboY3wLyzCl6kNYiokF0QX5NzEJzQTxmdHIl441ROoMUAEjHyAY7eAmHCizCHmh8oQnLCVIWkm/6ReA/tUEJMApvM7PpNALghAVHqEkIRVORdanOiJ0mUKyCBCgxjez3+SHXBUIXM1Mm6FtTiOH59WGp9VhRjDBLrjSExua8Po/wukdMipIBL/2QhDHULEDV89Rg8j3AktHFU3E0kaMlYjfy2c1YhKg4uCXBIAsZsZI5Qyxnw+nyRJNptt7NeoNPThYWOkm0UC0CKcFMlKLE7qzKTJaURiMHrh3Y2+DfBsRcQTE5RkQebtKPoR16uYNM5LFJ8GABvnS3DUf+DwIXefmxDicrmys7NLSkocDocpGfheXBM5/B9iccDQERUNFYlso84smlEq5lVKU64RJ1US0QfPBrT/f3j3x94rpaLw+yh8hNsSF4VwEQDE1MOko6ujy6+FhA6/erindM21Pp+vsfF0a1sbY8zpdJaXl1dUTAdI4K2fh3e/RByuGAAwDt7QYWhMU2CoRJRpWoFUcb2l+jYxrwTezWh8DN5aCIABpC3G1D/CXmn6qE+w0nMCSFT07hNtJ7uafFQZfW6/oy08/bVvVhSWg6Czs7O2tlYURUEQkp1JVy9aoux5OfDmE8SRGgcQ2yvKBv5OZkBTmBIkFps0eZF12YNSUSXcf0bjI9yEuCjSMe15bhufZBLC448/fnbiDUYoCQQCDcfruwbdLb/eIgri3FuWTSstt0Nuf+Z9dxnt9vZlpLmyc3KysrKam5tzcnL8Pl9KZl4yVYKH3yaClOiGEJeGuSiIRLYDgu4+FTn0ujHQJlasIWX3cUMPNIGE0PdPHjpS5p/bHj4GADdTEhry19fX93sHPS09A+u2eErFXlvQTi1F8yu6X9qrNA5qS/JaTzSlp2dkZmUmJycfO3Zs+vRp6ZmZItMiB9+awHoCasbdM+iIKqdsI1TUOo8oh9+gznKx6gkQHUMfQqDwbAYVkbo0LofzAxDl/UhdR9Oftlfddd2U8vLi3IKOp3dAFnxXJrUcP6XLpHhBZcdTmzLTs7RZGS0nG3OzcrJzc4aHhn0+X/nkMkNTIntfZWqIUIGzXNeYEoIShK5wNRIkjoedAcMONaIc3cD8Hmn+k8RRhv63QAmG3oNgQerieMw+HwlwzSd77nxWHQkV37lAVzRLsr1v5yn/7tPVa1YGRK2loZGVJBcUF3f+8u0kwR6enjLgGyotKklKcTY3NU+ZMoVKVjF/hmXuF201X7HMXi1fuVyetljImUJtqdBVw+eBEiKCCEFMgEEFItu1lv1aa60078ckYx7XIkow+C6shXDOOqscPgKAxSLrsR+9AYKye5dSgT9jyXQ2/HVTStC2YN1tI4PDnU3t4qyc4isrun/zjvrfzoDFsGYlJwk2ySZnZWczKggZRUJavun7s4S0fCG7XCqbZ7lquWXWLWLJHCJKxlAnC4wQUTZpYuOqa03S+5q0xvfluT8grivRux6CAM8WpC2Dtci0B3JOAGZ01Alrfm3PyKEWY16O4LI5rHbn5OzQqZFj6ze4nNlz7vr88NBQZ0u7ZVZezdpVSkN/8JV6979r7SnJFTctIMRkgWHEkyHzw4yYqkhWIaNIrvycZcb1POr2nuS+SLJizBkyg8gOY6hTa91lWfAYsbnQvwlEg3cHcu6CYE2IR2cCMH/Sg0rP6baA1z+683h/z3BLbtjT6Xalu8puntP39omGv292ZmbNuv1az/BQe0OzPCl1/sOrHcundLgiM++53u5wsGh2dOYnasSEE8oMjsSeKk9bIpVfbQy06v1NHMMYa6MYPK16/wnLoiehdmD0CNRhaAPIWHWGU0oAwHMBkNpv/TU1J73irmtOP/MBax3MvnragC1yuu5kakHmlXdc4950vOHljWJImHH7Eo/i62pqy0rPyJ9aemq4syAnz+l0niW9S5AwmYiEpuRYqldB19TmvdztTsRgceiddYRapLlPoH899CH4jnCvai+faAwTbMJ0nepIsPXFXcFur+C0TF+3IhQZ1Z89evXU6qTMlPc2bes0hm/Y8XjJdQv2PfW33Qt/7aoPEYYTPa2RcLggNcvlcn0C9WcgoUJUp+03/t+k1U/wID1RxXWNOFzB7b9X2xsw4wUeoQG0/gBMnWg2H7UB0vj0uyG3t/juhTkLpg192Nq+v1ZsVmoeWjUU8J44VJc1uWDm2hWOlPSujYfd/9pNt/QEatuEoH7VTQtlu/W8SD9TIIBhiAVXCK4C9fg2jmpMxSkluq53HbZcvY6obfAegeKGrQRJVWOKNBEAV1ZfKNBX1zqw9VBvqiaWuSq/cHX/hhNt+2r1eu/s+5YPhL2tDY2FxUX5Syon378sc/ZUKoqDYrD0G4szi/OYYZwv+xNBcFIMTcybTixJSsN2ItsQT3shWY3BNmJPl2beh64/wdAQaULO3aBSFGcMANMNQknn6/tHD3VMu+eapj++GzrW11VohJ20+svXDr/T1LZ3f3hXb/E1V3YTnxII5WflCknW1Ir87FurTjtHcwvz01NdIOetP2dBQWHoYlGVMdKjtR8exwBGiKi7661z1xDSj5H9UAeQXAV7RdQSEuJC03Pvdb1Wmzw5p/KRW5WuHtf6Tnd719FQ+5LN64rmz2nds7d+1Z/tb3d0t3ZELHExG4ZDFzNdGeddgZwDA7dsx4ofCBnFTA3HzDQmhM5w7WsoeohHcUbQ+wLiBVRMAvw71/7t/ftOlt61qOCWat+Rvq6NO7O11IFcGNm2hQ/eiiDp++/J0MFGsqNfGfBZ7FZlxD98onvS9NKMnCzEq5kLA2DwssGRptRtJpJlTAgg1PB2WmoeJIFdPNXT+pB1O0QXYMRVyAzAvZvr+o6fUDsDRV+uyVs5c/R4f/u/d9hOK/32cO68qWUr5+bfXA0meo909H1wqOmF991b6wtvrMqdVR5Nny5YBKYiMUPILtea9+pDnTxOm96GCJLh7RVLFwvZeXD/C0YE9slIngemx41Y5xT4Gt0DH5wcbuhgfi3/pqri2+frXr13w351W3O4ezS1MMtVXZyxdBpbmDfzmytKvrzoikdvTZtZxNhFoj56McNMiiymEOIRmlJE/MTikKu+hK5noGuQnMj8IreQaEHDjVigg3ubtsz/SdrUotHG3sLb58776/2CVRzY03js8Tc6tx0QIDnyXWX/Z9mMR1dRixjf7qJSH1cGFvZ5n77NGO6BKJsrlKkhIbs85cHXybElGNwNRyFm10FMGa/Iol/eXfDkaHvP7Ke+dvjRV3VNm/G9W/KWzxwN+SPegNgVInYxf8VMKotMM0zvR3CBen/WyzBAqf+Nn0T2rSf2CWWdHkn+9jZR+wtOPgZJwKxaJFUlRmJCqn/7VV9vX+v63TfW/mLK/dc1Pf/e7jufkYaU0iVXFd5RM+nW2VTmOTARKRHoJaEe0ZyMyVMXIVpORC8qMCWk9zfCOcMEqSPUlNDY4i7VYOk1kxc9+9DRX/3z1B+2XvnkbVf8dDV0AwJlhsGDOYFJ96Uhe5wU7hOF3KnEmgw9IXHQB5oxtZonQAYQPP2Rzhzlnrjs/qWl9yxRvUE9pAg22aSecXgXoRV7vgg4LUnpNCnNGOqBJMdblFT3tEBaCSkJET8infFkjum8YDOzXG6VmkYok112wSoyXYNhXGQz/WT6ze6FxUGcmSzaNo0Zt8BG3SBOyBkcktm/MCUwsX9EhfFkmxAiXD62J1ymL6JRCx7rsXIz8IOJEJL4n3rABKANo/dvUEeRtoA5lkYO/MN8hkQBMDUiFc8Si6rO6BFdBgSc8TyQIaEpZKg8lYi2XM1zBhHaCFp/CH8EZV9j+QuCG3/JwgFQkb+Cisw/aFv+fROAcT6Nvot3mUTrWhzM2LIAwmJHJCY9IqgNlhyo3WAKRJmm5BnUA1GKtgn4bbp6GekeI5QDYKFRM0GKL5qlJqBBD/I/qd00YjEFNIljCndSWSJWJ9MVHkoMnX8Y032esTderstMDtSw4fPEdCFKgKERRwYQgGr2tMVUEwC1Qcrgd0T6QVXiSOeCi1LLGATR8Lo5notxnnXe9JsA/EPMP0gSekeGkF4CtReql1NoKYi7UVsp/1ftBwLUVcirnjgCIsrGQKs+3Bl9/rIhMGNWixHyJgRjgGZNRrgNukm4vTwOwDqZE6x4EW6RCmeNGz2XgGQEhrSOo2OMuVz0Q2ncBU0ZlzwzIEpi5mQEGvgNlMI2BsBZHWvMD74jFs4aP5iIXoQoJ3fg8pkBdx5Mi6hNe8ZrGkKYpgjpJUJWPjzvmAdT2bCWxgEkz4Mli38ZfJ+6sml6MdMiMXK54du1xl3GcHesr3+pL4NvoTXv092nINliOxIKNSRMqiJyAN5aDsA5F1I6mEFN0aTBfhWnb2QXoR658gaoofGSVJAMnydS+xo3jMugRSbjwntfhcESlJlArlwO7w4oPr6SsigKN5rXAVlf5AFC9cPztnzFSmKxj2uRYRCLI7z/NWOkN1ryXULqTXenNu1RTn1IrI6oNDgkTaGuQrm8Bt0vcQOQHUhfYT5A44cOrhthSeW3djwj5hSKpTVMCcYNiEGUjdGB4LtPx1qCl+oyWa4rwS3/z9wlzn9CmeK3zPwCEXvh2cpT5pT5sE+LFvvmMT8zuE91reRL3oMI7LItXouxNNCsHogtOXLgX8qxrdyvGdoloZ/nYDS4/Vmt/Sh3JDFRE+gadbgsNXei60/QwpzI7LsRd+txHgPIfyCaO6DpMWlytTRlMQuPxlYQiwmBf/9Mdzfy6JhwendRqNdAReX4ttD7zxJb8vj7qcBCXsu8O4UUHe1/5CqQNAUZN0fZHwdAzCZrcg1cN/AfBrdj9B37jY8SQRjXeGYqUsjr+/tDxkiPKYeLh8GkXm07EHj9R+aRR3ydEKhhIWOSbdm30fxTnjKDoeAhnk4zA4mDCaYQSh6DIHJkJx4U80qti+9lgWG+EttGJ7JdH2gZ/dsaY6gzjuHCTIIx/hIqqs37/C9/m6kRLt4xMyOUqX77iscJ6tHxLNd+53Tk3D3G/gkAokJwzkHON/gX/2m0fM92/cNicRVPCccUydCJ1an3NY4+/3W1ZV+sk/wZRcFihQcVIgff9L34LSMcgGgZl7nAk3nLvDvkK5bh+NdNb8lQ8guevMXZf8ZBt8G5qQ7g4CxEerkLm7VF16tHn17BImFemBrxV1OBBwoq2Zbea11yD4mWHaYJnle0jh43mUwx/IOhbb8P7/8nkawm78e2EFnYK+VXONe+SdoeRtvvOMHZX0LlP844oUk8qY+OJ3jewrFV/CYhDTWH1HaP74W7QKWEDcyAwMI+sXCmbem98ozrxitXFnfeCd0LNt5jM9eZEoocfDO88wXd00bsKeaDEzookaCQ7Epeu5Eq/0HdnRAI5HzMruUZhJkJfQyAMQwt69D6G54gWaehZn+k/kDg7w9wDKI8QWEIKGWRAMCkompL1c3S1MU0NfcTBaD3NysN7ymHN2juUxAtnPcTlVAQWdhPHSnJ970u2Jpx4HOgZkdn5iakff6jEyAfnZWIs7B+Nfo3cGYlVWPOB8rJOv8rDzBV5QFSnxAHTGnyqKerNCVHLJgh5s8Q8iuEjCIi2cyTYAZDYyGf3t+kdTeYn+PcN0hW8xDASIiMVGShEcGV7/zmK4K9A7XXAiHoBqb8jjufs81+nHXYwzQR3Y+6FRjeyRccV2D2O5rb639lrT7QTuyp46oyBsMM+EwNc3aKMpFtRLRCMLmlqUyLsEiQu0tBHAd2xhvAWGBIKl+YdMdzVP8Qh1eDRKAZKHkEpb/6uMmVj5lWiRqKOoRjN2Fkt5m+5uOqNwx6VeDNdcrRjURyQLKcyb/oiWo052P6uFqfeczKEut0vs4iAQLDuvh++w0Pw/0MTn6H67lmoPi7KPvtOWZWzjFuY3Bb0YZR/xWegXBWSpj8FAq+GzmyNbT1V7qnnViSTMfHPibDI/HCDmcPF1HSlRDUoFhUZV/+U6m0DCceQM9Lsfqk5McoefLcEzfnHngyMRhhNH4X3c9xluhA+rWY/gfDKA3veTGy92VjqJtrs2Qz3QtLcCZn3zA+nWho3HIMTcyZall4v6V6BfFvRsODCHfwjYgdU36P3HviB68f650/cWLLiPmsnj+jeR3UEXOAUkL+GpT+0AinKnWbIgfW670NnJFUNPVePHtAiApKU3i1xHRic4rF8yyzvypPX0C0OjT+2Mw0TR45r8C053lqcx4DgOczM8eiRwwInEDT9zG0MYZLTEbeHSj8FqRKbaBXbdimtu0z+huNUTcn0dATtMaMuES20bRJQtZUqXyxNGWRkGqD/79o+y08W2I3CzLy1qL0CQjOizYzF0cRf13fq2j/OfwNUWicZyk1yF6FrFUQJzFF0If79ZFeFvRC8fPchhAi2Yg1idrTaFoeTUkhQhDherhfx8Am+Jti/KVmTVL8MyTPSdjuogFA3L3y5CcI9/+g53n4D2JsKIVHvUlIqkDaQtgKzUHjFBALf8oIct1TPVyGw7sRaIYyiLF0RpSRdh0KvgPX53Gp50YxkTdMw/B29L2MkQ8R6cRYcJs4bowJi2Pr0X9FCts0pK9E9leQNDN2E2OftoP22SZ3WUKvV/PCuxMjOxGoQ/AUNA/0gBkiJu5jmr6QDDkXjkokVSF1KaebWsyfjWj7/9NTckHT62N524SN1SEo3VD6eVarjYKFze6lHWIa5CyeilnyeT48/o7PPvYdvf43AAD//yvju0WgtYfMAAAAAElFTkSuQmCC'
@@ -60,8 +58,27 @@ def parse_args():
                         action='store_true')
     parser.add_argument('--flagging', help='flag data before averaging', default=False,
                         action='store_true')
+    parser.add_argument('--subband_edge', help='replace the first channel of every subband (16 channels) \
+        by the next one before averaging, on by default as in the earlier products, \
+        --no-subband_edge to keep the edge channels', default=True,
+                        action=BooleanOptionalAction)
     parser.add_argument('--t_idx_cut', help='length of t-index for convolution, \
         8192 means about 195MB for 6400 channels', type=int, default=256)
+    parser.add_argument('--n_prefetch', help='number of segments read ahead from the h5 in background, \
+        0 to disable', type=int, default=2)
+    parser.add_argument('--workers', help='number of processes to export the chunks in parallel', 
+                        type=int, default=1)
+    parser.add_argument('--stream', help='write the fits block by block instead of holding the chunk in memory, \
+        for small compression ratios', default=False, action='store_true')
+    parser.add_argument('--backend', help='flagging and averaging with numpy or torch, \
+        auto means numpy if torch is missing or there is no GPU', choices=['auto', 'numpy', 'torch'], default='auto')
+    parser.add_argument('--memmap', help='read the h5 through a memory map when the dataset is stored \
+        contiguously and uncompressed', default=False, action='store_true')
+    parser.add_argument('--all_stokes', help='export all the SAPs, beams and Stokes of the file, and of the \
+        files of the other Stokes next to it (..._S0_... to ..._S3_...), in one pass, \
+        otherwise only the first dynamic spectrum', default=False, action='store_true')
+    parser.add_argument('--combine_stokes', help='also write the Stokes of every beam into one multi-extension \
+        fits per chunk, implies --all_stokes', default=False, action='store_true')
 
     # file names and directory
     parser.add_argument('--target_directory', help='use long directory name, (e.g. out/sun/xxx.fits)',
@@ -78,6 +95,249 @@ def parse_args():
     return parser.parse_args()
 
 
+def export_chunk(f, t_start_fits, t_end_fits, t_ratio_start, t_ratio_end, fname_DS, out_dir,
+                 t_c_ratio, t_idx_cut, f_c_ratio, averaging, flagging, target_directory, date_directory,
+                 simple_fname, add_ksp_logo, add_idols_logo, flip_freq, n_prefetch=2, net=None,
+                 stream=False, memmap=False, backend='auto', pointing_xy=None,
+                 dataset=None, meta=None, name_beam=False, subband_edge=True):
+    """
+    downsample one time chunk of the opened h5 file f, 
+    and write the fits, png and json of the chunk to out_dir
+    stream: write the fits block by block, the memory is then bounded by t_idx_cut,
+            the png is made from the fits on disk, decimated in time
+    memmap: read the h5 dataset through a memory map if possible
+    backend: 'auto', 'numpy' or 'torch' for the flagging and averaging
+    pointing_xy: solar x, y (arcsec) of the pointing at t_start_fits, computed here if None
+    dataset: (SAP, beam_key, stokes_key) of the dynamic spectrum, from bftools.h5_list_datasets,
+             the first one of the file if None
+    meta: output of bftools.h5_fetch_meta for the dataset, read here if None
+    name_beam: add the SAP and the beam to the file names, for files with several beams
+    subband_edge: replace the first channel of every subband (16 channels) by the next one
+    returns the path of the fits file
+    """
+    if meta is None:
+        meta = bftools.h5_fetch_meta(f) if dataset is None else bftools.h5_fetch_meta(f, *dataset)
+    (dataset_uri, coordinates_uri, beam_key, stokes_key, pointing_ra, pointing_dec, tsamp, 
+        project_id, obs_id, antenna_set_name, telescop_name, target_name, t_idx_count, f_idx_count,
+        t_start_bf, t_end_bf, freq, t_all)= meta
+    f_fits = bftools.avg_1d(freq, f_c_ratio)
+    agg_factor = [1.66, 1.66, 0.45, 0.45]
+    backend = bftools.resolve_backend(backend)
+    if flagging and net is None:
+        net = bftools.get_flagger(agg_factor, backend)
+
+    # get pointing x y according to starting time,
+    # sunpy is imported here and not at the start of the command
+    if pointing_xy is None:
+        from lofarSun.BF.lofarJ2000xySun import j2000xy
+        pointing_xy = j2000xy(pointing_ra, pointing_dec, t_start_fits)
+    pointing_x, pointing_y = pointing_xy
+
+    beam_name = ''
+    if name_beam:
+        beam_name = '_SAP' + dataset_uri.split('/')[1][-3:] + '_B' + beam_key[-3:]
+    fname = t_start_fits.strftime(
+        r"LOFAR_%Y%m%d_%H%M%S_") + antenna_set_name+beam_name+"_S"+stokes_key.strip()[-1]  # + '.fits'
+
+    obj_name = "sun" if ('sun' in target_name) else "nts"
+
+    real_out_dir = out_dir
+    if target_directory:
+        real_out_dir = os.path.join(out_dir, obj_name)
+    if date_directory:
+        real_out_dir = os.path.join(
+            real_out_dir, t_start_fits.strftime(r"%Y/%m/%d"))
+
+    os.makedirs(real_out_dir, exist_ok=True)
+    if simple_fname:
+        fname = t_start_fits.strftime(
+            r"%Y%m%d_%H")+beam_name+"_S"+stokes_key.strip()[-1]  # + '.fits'
+
+    out_path_fits = os.path.join(real_out_dir, fname + '.fits')
+    out_path_png = os.path.join(real_out_dir, fname + '.png')
+    out_path_json = os.path.join(real_out_dir, fname + '.json')
+
+    # downsample by time ratio
+    downsample_args = (f[dataset_uri], t_all, t_ratio_start, t_ratio_end, t_idx_count,
+                       t_c_ratio, f_c_ratio)
+    downsample_kwargs = dict(averaging=averaging, flagging=flagging, t_idx_cut=t_idx_cut,
+                             agg_factor=agg_factor, subband_edge=subband_edge, net=net, n_prefetch=n_prefetch,
+                             memmap=memmap, backend=backend)
+    if stream:
+        data_shape = bftools.downsample_h5_seg_shape(t_ratio_start, t_ratio_end, t_idx_count, f_idx_count,
+                                                     t_c_ratio, f_c_ratio, averaging, t_idx_cut)
+        t_fits = bftools.write_fits_spectr_stream(
+            out_path_fits,
+            bftools.iter_downsample_h5_seg_by_time_ratio(*downsample_args, **downsample_kwargs),
+            data_shape, f_fits, t_start_fits, t_end_fits, stokes_key,
+            antenna_set_name, telescop_name, target_name,
+            pointing_ra, pointing_dec, pointing_x, pointing_y)
+        # quick-look from the file on disk, no more time samples than the png can show
+        with fits.open(out_path_fits, memmap=True) as hdul:
+            data_fits = np.array(hdul[0].data[::max(1, data_shape[0] // 2048)], dtype=np.float32)
+    else:
+        data_fits, t_fits = bftools.downsample_h5_seg_by_time_ratio(*downsample_args, **downsample_kwargs)
+
+        # t_fits = np.linspace(mdates.date2num(t_start_fits), mdates.date2num(t_end_fits), data_fits.shape[0])
+        full_hdu = bftools.cook_fits_spectr_hdu(data_fits, t_fits, f_fits, t_start_fits, t_end_fits, stokes_key,
+                                 antenna_set_name, telescop_name, target_name,
+                                 pointing_ra, pointing_dec, pointing_x, pointing_y)
+        full_hdu.writeto(out_path_fits, overwrite=True)
+    fig = plt.figure(figsize=(7, 4.5), dpi=160)
+
+    main_width, main_height = 0.81, 0.81
+    ax = fig.add_axes([0.08, 0.105, main_width, main_height])
+
+    if ('0' not in stokes_key.lower()):  # QUV
+        cmap = "bwr"
+        data_fits_new = (data_fits)/np.nanmax(np.abs(data_fits))
+        # scale vmax and vmin
+        freq_safe0, freq_safe1 = int(
+            0.27 * f_fits.shape[0]), int(0.99 * f_fits.shape[0])
+        data_safe_arr = data_fits_new[:, freq_safe0:freq_safe1].ravel()
+        data_safe = np.sort(data_safe_arr)[int(
+            data_safe_arr.shape[0] * 0.02):int(data_safe_arr.shape[0] * 0.98)]
+        vmin, vmax = [-0.9*np.nanmax(data_safe), 0.9*np.nanmax(data_safe)]
+
+    else: # stokes I
+        cmap = "inferno"
+        data_fits_new = (data_fits / np.nanmean(
+            np.sort(data_fits, 0)[
+                int(data_fits.shape[0] * 0.1):int(data_fits.shape[0] * 0.3), :], 0))-1
+        # scale vmax and vmin
+        freq_safe0, freq_safe1 = int(
+            0.27 * f_fits.shape[0]), int(0.99 * f_fits.shape[0])
+        data_safe_arr = data_fits_new[:, freq_safe0:freq_safe1].ravel()
+        data_safe = np.sort(data_safe_arr)[int(
+            data_safe_arr.shape[0] * 0.02):int(data_safe_arr.shape[0] * 0.98)]
+        vmin, vmax = [(np.nanmean(data_safe) - 2 * np.nanstd(data_safe)),
+                      (np.nanmean(data_safe) + 2 * np.nanstd(data_safe)+0.9*np.nanmax(data_safe))]
+
+    freq_origin = 'upper' if flip_freq else 'lower'
+    freq_range = [f_fits[-1],f_fits[0]] if flip_freq else [f_fits[0],f_fits[-1]]
+    im = ax.imshow(data_fits_new.T, aspect='auto', origin=freq_origin, vmax=vmax, vmin=vmin,
+                    extent=[mdates.date2num(t_start_fits), mdates.date2num(t_end_fits), 
+                    freq_range[0],freq_range[1]], cmap=cmap)
+
+    ax.xaxis_date()
+    ax.xaxis.set_major_formatter(mdates.DateFormatter("%H:%M"))
+    ax.set_xlabel('Time (UT)')
+    ax.set_ylabel('Frequency (MHz)')
+    ax.set_title(t_start_fits.strftime("%Y/%m/%d") + ' LOFAR ' +
+                 antenna_set_name + ' ' + stokes_key)
+
+    if add_idols_logo:
+        ax_logo1 = fig.add_axes([0.08, 0.92, 0.12, 0.07])
+        img1 = mpimg.imread(io.BytesIO(base64.b64decode(idols_logo_base64)), format='png')
+        ax_logo1.imshow(img1)
+        ax_logo1.axis('off')
+
+    if add_ksp_logo:
+        ax_logo2 = fig.add_axes([0.01, 0.915, 0.07, 0.08])
+        img2 = mpimg.imread(io.BytesIO(base64.b64decode(lofar_logo_base64)), format='png')
+        ax_logo2.imshow(img2)
+        ax_logo2.axis('off')
+
+    # add colorbar
+    ax_cbar = fig.add_axes([0.895, 0.105, 0.03, main_height])
+    cbar = plt.colorbar(im, cax=ax_cbar, orientation='vertical')
+    cbar.formatter.set_powerlimits((0, 0))
+    ax_cbar.text(0.4, 0.5, r'$\rm (I-I_{B0})/I_{B0}$', color='w', ha='center', va='center', rotation=270,
+                 transform=ax_cbar.transAxes, fontsize=12)
+
+    fig.savefig(out_path_png)
+    plt.close('all')
+
+    lofar_json_dict = {'telescope': telescop_name, 'instrume': antenna_set_name,
+                       'projectID': project_id, 'obsID': obs_id,
+                       'source': fname_DS, 'date': t_start_fits.strftime("%Y-%m-%d"),
+                       'ra': pointing_ra, 'dec': pointing_dec,
+                       'x': pointing_x,   'y': pointing_y,
+                       'time': t_start_fits.strftime("%H:%M:%S.%f"),
+                       'event': {"no_detection": True, "type": "none", "level": "none"}, 'n_freq': len(f_fits),
+                       'n_time': len(t_fits), 'freq_range': [np.nanmin(f_fits), np.nanmax(f_fits)],
+                       'time_range': [t_start_fits.strftime("%Y-%m-%d %H:%M:%S.%f"),
+                                      t_end_fits.strftime("%Y-%m-%d %H:%M:%S.%f")]}
+
+    with open(out_path_json, 'w') as fp:
+        json.dump(lofar_json_dict, fp)
+
+    gc.collect()
+
+    return out_path_fits
+
+
+def export_chunk_datasets(f, chunk, settings, datasets=(None,), metas=None, pointing_xy=None,
+                          combine_stokes=False, net=None, files=None):
+    """
+    export one time chunk of several dynamic spectra of the opened h5 file f,
+    one export_chunk per dataset
+    chunk: (t_start_fits, t_end_fits, t_ratio_start, t_ratio_end)
+    settings: keyword arguments of export_chunk
+    datasets: (SAP, beam_key, stokes_key) of the dynamic spectra, from bftools.h5_list_datasets,
+              None for the first one of the file
+    metas: {dataset: output of bftools.h5_fetch_meta}, read for every chunk if None
+    pointing_xy: {(SAP, beam_key): solar x, y of the beam at t_start_fits}, (None for the
+                 dataset None), computed for every dataset if None
+    combine_stokes: also write the Stokes of every beam into one multi-extension fits,
+                    named with all the Stokes, e.g. LOFAR_..._S0123.fits
+    files: {dataset: opened h5 file} for the datasets in other files than f,
+           e.g. the other Stokes of the beam, see bftools.h5_stokes_files
+    returns the paths of the fits files
+    """
+    files = {} if files is None else files
+    paths = []
+    beam_paths = {}
+    for dataset in datasets:
+        beam_id = None if dataset is None else dataset[:2]
+        out_path_fits = export_chunk(files.get(dataset, f), *chunk, **settings, net=net, dataset=dataset,
+                                     meta=None if metas is None else metas[dataset],
+                                     pointing_xy=None if pointing_xy is None else pointing_xy[beam_id])
+        paths.append(out_path_fits)
+        beam_paths.setdefault(beam_id, []).append(out_path_fits)
+    if combine_stokes:
+        for stokes_paths in beam_paths.values():
+            if len(stokes_paths) < 2:
+                continue
+            names = [os.path.splitext(path)[0].rsplit('_S', 1) for path in stokes_paths]
+            out_path_combined = names[0][0] + '_S' + ''.join(name[1] for name in names) + '.fits'
+            paths.append(bftools.combine_fits_spectr_stokes(stokes_paths, out_path_combined))
+    return paths
+
+
+# the h5 file opened by each worker process, reused for all its chunks,
+# and the metadata of its datasets
+_worker_h5 = {}
+_worker_meta = {}
+
+
+def _init_chunk_worker(n_threads, backend):
+    # share the cores between the workers instead of oversubscribing them
+    if backend == 'torch':
+        import torch
+        torch.set_num_threads(n_threads)
+
+
+def _worker_file(h5_path):
+    if h5_path not in _worker_h5:
+        _worker_h5[h5_path] = h5py.File(h5_path, 'r')
+    return _worker_h5[h5_path]
+
+
+def _export_chunk_worker(h5_absolute, chunk, settings, pointing_xy=None, datasets=(None,),
+                         combine_stokes=False, sources=None):
+    # sources: {dataset: h5 file} of the datasets in other files than h5_absolute
+    files = {dataset: _worker_file(h5_path) for dataset, h5_path in (sources or {}).items()}
+    if h5_absolute not in _worker_meta:
+        f = _worker_file(h5_absolute)
+        _worker_meta[h5_absolute] = {
+            dataset: bftools.h5_fetch_meta(f) if dataset is None
+            else bftools.h5_fetch_meta(files.get(dataset, f), *dataset)
+            for dataset in datasets}
+    return export_chunk_datasets(_worker_file(h5_absolute), chunk, settings, datasets,
+                                 _worker_meta[h5_absolute], pointing_xy, combine_stokes, files=files)
+
+
 def compress_h5(fname_DS,
                 out_dir,
                 t_c_ratio,
@@ -93,10 +353,33 @@ def compress_h5(fname_DS,
                 simple_fname,
                 add_ksp_logo,
                 add_idols_logo,
-                flip_freq):
+                flip_freq,
+                n_prefetch=2,
+                workers=1,
+                stream=False,
+                memmap=False,
+                backend='auto',
+                all_stokes=False,
+                combine_stokes=False,
+                subband_edge=True):
     """
     fname_DS: relative (or absolute) directory+fname to the .h5
     out_dir: relative (or absolute) directory+fname to the .h5
+    n_prefetch: number of segments read ahead from the h5 while averaging
+    workers: number of processes to export the chunks in parallel,
+             each worker opens the h5 file by itself
+    stream: write the fits block by block, for chunks larger than the memory
+    memmap: read the h5 through a memory map when the dataset is contiguous and uncompressed
+    backend: 'numpy' or 'torch' for the flagging and averaging, 
+             'auto' for numpy when torch is missing or there is no GPU
+    all_stokes: export all the dynamic spectra of the file (all SAPs, beams and Stokes),
+                and of the files of the other Stokes next to it (..._S0_... to ..._S3_...),
+                in one pass over the chunks, sharing the chunk plan and the pointings,
+                otherwise only the first one
+    combine_stokes: also write the Stokes of every beam and chunk into one multi-extension fits,
+                    implies all_stokes
+    subband_edge: replace the first channel of every subband (16 channels) by the next one
+                  before averaging, as the products have always been made
     """
     minutes_per_chunk = datetime.timedelta(minutes=minutes_per_chunk)
     h5_absolute = os.path.abspath(fname_DS)
@@ -106,13 +389,35 @@ def compress_h5(fname_DS,
     os.chdir(h5_dir)
     f = h5py.File(h5_fname, 'r')
 
+    # LOFAR writes every Stokes of a beam in its own file, with all_stokes the datasets
+    # of the files of the other Stokes are read from them, {dataset: path} in sources;
+    # the metadata of every dataset is read once, the first one gives the chunk plan
+    all_stokes = all_stokes or combine_stokes
+    sources, metas = {}, {}
+    if all_stokes:
+        for h5_path in bftools.h5_stokes_files(h5_absolute):
+            f_stokes = f if h5_path == h5_absolute else h5py.File(h5_path, 'r')
+            try:
+                for dataset in bftools.h5_list_datasets(f_stokes):
+                    if dataset not in metas:
+                        metas[dataset] = bftools.h5_fetch_meta(f_stokes, *dataset)
+                        if f_stokes is not f:
+                            sources[dataset] = h5_path
+            finally:
+                if f_stokes is not f:
+                    f_stokes.close()
+    else:
+        metas[None] = bftools.h5_fetch_meta(f)
+    datasets = sorted(metas)
     (dataset_uri, coordinates_uri, beam_key, stokes_key, pointing_ra, pointing_dec, tsamp, 
         project_id, obs_id, antenna_set_name, telescop_name, target_name, t_idx_count, f_idx_count,
-        t_start_bf, t_end_bf, freq, t_all)= bftools.h5_fetch_meta(f)
+        t_start_bf, t_end_bf, freq, t_all)= metas[datasets[0]]
 
-    print('Beam:', beam_key)
-    print('Stokes:', stokes_key)
-    print('data shape [t,f]:', t_idx_count, f_idx_count)
+    for dataset in datasets:
+        meta = metas[dataset]
+        print('Beam:', meta[2])
+        print('Stokes:', meta[3])
+        print('data shape [t,f]:', meta[12], meta[13])
     
     if chop_off:
         t_start_chunk = t_start_bf.replace(minute=int(np.ceil(t_start_bf.minute / 15.0) * 15),
@@ -126,13 +431,10 @@ def compress_h5(fname_DS,
     else:
         chunk_num = num_chunks
 
-    f_fits = bftools.avg_1d(freq, f_c_ratio)
     os.makedirs(out_dir, exist_ok=True)
 
-    net = RFIconv(device=device)
-    agg_factor = [1.66, 1.66, 0.45, 0.45]
-
-    start_time = time.time()
+    # plan the chunks, every chunk is exported independently
+    chunks = []
     for idx_cur in range(chunk_num):
         # select the time
         t_start_fits = t_start_chunk + idx_cur * 1.0 * minutes_per_chunk
@@ -145,126 +447,58 @@ def compress_h5(fname_DS,
         t_ratio_end = (mdates.date2num(t_end_fits)
                        - mdates.date2num(t_start_bf)) / (mdates.date2num(t_end_bf)
                                                          - mdates.date2num(t_start_bf))
+        chunks.append((t_start_fits, t_end_fits, t_ratio_start, t_ratio_end))
+
+    # pointing of all the beams and chunks in one call, shared by the Stokes of a beam
+    from lofarSun.BF.lofarJ2000xySun import j2000xy
+    beam_metas = {}
+    for dataset in datasets:
+        beam_metas.setdefault(None if dataset is None else dataset[:2], metas[dataset])
+    beam_ids, beam_meta = list(beam_metas.keys()), list(beam_metas.values())
+    chunk_x, chunk_y = j2000xy(np.array([[meta[4]] for meta in beam_meta]),
+                               np.array([[meta[5]] for meta in beam_meta]),
+                               np.array([chunk[0] for chunk in chunks])[None, :])
+    pointings = [{beam_id: (float(chunk_x[idx_beam, idx_cur]), float(chunk_y[idx_beam, idx_cur]))
+                  for idx_beam, beam_id in enumerate(beam_ids)}
+                 for idx_cur in range(chunk_num)]
+
+    settings = dict(fname_DS=fname_DS, out_dir=out_dir, t_c_ratio=t_c_ratio, t_idx_cut=t_idx_cut,
+                    f_c_ratio=f_c_ratio, averaging=averaging, flagging=flagging,
+                    target_directory=target_directory, date_directory=date_directory,
+                    simple_fname=simple_fname, add_ksp_logo=add_ksp_logo,
+                    add_idols_logo=add_idols_logo, flip_freq=flip_freq, n_prefetch=n_prefetch,
+                    stream=stream, memmap=memmap, backend=bftools.resolve_backend(backend),
+                    name_beam=len(beam_ids) > 1, subband_edge=subband_edge)
 
-        print('processing chunk', idx_cur + 1, 'of', chunk_num,
-              ', ratio range:', t_ratio_start, t_ratio_end)
-
-        # get pointing x y according to starting time
-        pointing_x, pointing_y = j2000xy(
-            pointing_ra, pointing_dec, t_start_fits)
-
-        # downsample by time ratio
-        data_fits, t_fits = bftools.downsample_h5_seg_by_time_ratio(
-            f[dataset_uri], t_all, t_ratio_start, t_ratio_end, t_idx_count,
-            t_c_ratio, f_c_ratio, averaging, flagging, t_idx_cut, agg_factor, device)
-
-        # t_fits = np.linspace(mdates.date2num(t_start_fits), mdates.date2num(t_end_fits), data_fits.shape[0])
-        full_hdu = bftools.cook_fits_spectr_hdu(data_fits, t_fits, f_fits, t_start_fits, t_end_fits, stokes_key,
-                                 antenna_set_name, telescop_name, target_name,
-                                 pointing_ra, pointing_dec, pointing_x, pointing_y)
-
-        fname = t_start_fits.strftime(
-            r"LOFAR_%Y%m%d_%H%M%S_") + antenna_set_name+"_S"+stokes_key.strip()[-1]  # + '.fits'
-
-        obj_name = "sun" if ('sun' in target_name) else "nts"
-
-        real_out_dir = out_dir
-        if target_directory:
-            real_out_dir = os.path.join(out_dir, obj_name)
-        if date_directory:
-            real_out_dir = os.path.join(
-                real_out_dir, t_start_fits.strftime(r"%Y/%m/%d"))
-
-        os.makedirs(real_out_dir, exist_ok=True)
-        if simple_fname:
-            fname = t_start_fits.strftime(
-                r"%Y%m%d_%H")+"_S"+stokes_key.strip()[-1]  # + '.fits'
-
-        out_path_fits = os.path.join(real_out_dir, fname + '.fits')
-        out_path_png = os.path.join(real_out_dir, fname + '.png')
-        out_path_json = os.path.join(real_out_dir, fname + '.json')
-
-        full_hdu.writeto(out_path_fits, overwrite=True)
-        fig = plt.figure(figsize=(7, 4.5), dpi=160)
-
-        main_width, main_height = 0.81, 0.81
-        ax = fig.add_axes([0.08, 0.105, main_width, main_height])
-
-        if ('0' not in stokes_key.lower()):  # QUV
-            cmap = "bwr"
-            data_fits_new = (data_fits)/np.nanmax(np.abs(data_fits))
-            # scale vmax and vmin
-            freq_safe0, freq_safe1 = int(
-                0.27 * f_fits.shape[0]), int(0.99 * f_fits.shape[0])
-            data_safe_arr = data_fits_new[:, freq_safe0:freq_safe1].ravel()
-            data_safe = np.sort(data_safe_arr)[int(
-                data_safe_arr.shape[0] * 0.02):int(data_safe_arr.shape[0] * 0.98)]
-            vmin, vmax = [-0.9*np.nanmax(data_safe), 0.9*np.nanmax(data_safe)]
-
-        else: # stokes I
-            cmap = "inferno"
-            data_fits_new = (data_fits / np.nanmean(
-                np.sort(data_fits, 0)[
-                    int(data_fits.shape[0] * 0.1):int(data_fits.shape[0] * 0.3), :], 0))-1
-            # scale vmax and vmin
-            freq_safe0, freq_safe1 = int(
-                0.27 * f_fits.shape[0]), int(0.99 * f_fits.shape[0])
-            data_safe_arr = data_fits_new[:, freq_safe0:freq_safe1].ravel()
-            data_safe = np.sort(data_safe_arr)[int(
-                data_safe_arr.shape[0] * 0.02):int(data_safe_arr.shape[0] * 0.98)]
-            vmin, vmax = [(np.nanmean(data_safe) - 2 * np.nanstd(data_safe)),
-                          (np.nanmean(data_safe) + 2 * np.nanstd(data_safe)+0.9*np.nanmax(data_safe))]
-
-        freq_origin = 'upper' if flip_freq else 'lower'
-        freq_range = [f_fits[-1],f_fits[0]] if flip_freq else [f_fits[0],f_fits[-1]]
-        im = ax.imshow(data_fits_new.T, aspect='auto', origin=freq_origin, vmax=vmax, vmin=vmin,
-                        extent=[mdates.date2num(t_start_fits), mdates.date2num(t_end_fits), 
-                        freq_range[0],freq_range[1]], cmap=cmap)
-
-        ax.xaxis_date()
-        ax.xaxis.set_major_formatter(mdates.DateFormatter("%H:%M"))
-        ax.set_xlabel('Time (UT)')
-        ax.set_ylabel('Frequency (MHz)')
-        ax.set_title(t_start_fits.strftime("%Y/%m/%d") + ' LOFAR ' +
-                     antenna_set_name + ' ' + stokes_key)
-
-        if add_idols_logo:
-            ax_logo1 = fig.add_axes([0.08, 0.92, 0.12, 0.07])
-            img1 = mpimg.imread(io.BytesIO(base64.b64decode(idols_logo_base64)), format='png')
-            ax_logo1.imshow(img1)
-            ax_logo1.axis('off')
-
-        if add_ksp_logo:
-            ax_logo2 = fig.add_axes([0.01, 0.915, 0.07, 0.08])
-            img2 = mpimg.imread(io.BytesIO(base64.b64decode(lofar_logo_base64)), format='png')
-            ax_logo2.imshow(img2)
-            ax_logo2.axis('off')
-
-        # add colorbar
-        ax_cbar = fig.add_axes([0.895, 0.105, 0.03, main_height])
-        cbar = plt.colorbar(im, cax=ax_cbar, orientation='vertical')
-        cbar.formatter.set_powerlimits((0, 0))
-        ax_cbar.text(0.4, 0.5, r'$\rm (I-I_{B0})/I_{B0}$', color='w', ha='center', va='center', rotation=270,
-                     transform=ax_cbar.transAxes, fontsize=12)
-
-        fig.savefig(out_path_png)
-        plt.close('all')
-
-        lofar_json_dict = {'telescope': telescop_name, 'instrume': antenna_set_name,
-                           'projectID': project_id, 'obsID': obs_id,
-                           'source': fname_DS, 'date': t_start_fits.strftime("%Y-%m-%d"),
-                           'ra': pointing_ra, 'dec': pointing_dec,
-                           'x': pointing_x,   'y': pointing_y,
-                           'time': t_start_fits.strftime("%H:%M:%S.%f"),
-                           'event': {"no_detection": True, "type": "none", "level": "none"}, 'n_freq': len(f_fits),
-                           'n_time': len(t_fits), 'freq_range': [np.nanmin(f_fits), np.nanmax(f_fits)],
-                           'time_range': [t_start_fits.strftime("%Y-%m-%d %H:%M:%S.%f"),
-                                          t_end_fits.strftime("%Y-%m-%d %H:%M:%S.%f")]}
-
-        with open(out_path_json, 'w') as fp:
-            json.dump(lofar_json_dict, fp)
-
-        gc.collect()
+    start_time = time.time()
+    if workers > 1:
+        # spawn the workers, a forked torch or h5py state is not safe to reuse
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_chunk_worker,
+                                 initargs=(max(1, os.cpu_count() // workers),
+                                           settings['backend'])) as pool:
+            results = pool.map(_export_chunk_worker, [h5_absolute] * chunk_num,
+                               chunks, [settings] * chunk_num, pointings,
+                               [datasets] * chunk_num, [combine_stokes] * chunk_num,
+                               [sources] * chunk_num)
+            for idx_cur, (chunk, out_paths) in enumerate(zip(chunks, results)):
+                print('chunk', idx_cur + 1, 'of', chunk_num,
+                      ', ratio range:', chunk[2], chunk[3], '->', ' '.join(out_paths))
+    else:
+        agg_factor = [1.66, 1.66, 0.45, 0.45]
+        # the flagger is built once and shared by all the chunks
+        net = bftools.get_flagger(agg_factor, settings['backend']) if flagging else None
+        with ExitStack() as stack:
+            # the files of the other Stokes stay open for all the chunks, closed after the last one
+            opened = {h5_path: stack.enter_context(h5py.File(h5_path, 'r'))
+                      for h5_path in set(sources.values())}
+            files = {dataset: opened[h5_path] for dataset, h5_path in sources.items()}
+            for idx_cur, chunk in enumerate(chunks):
+                print('processing chunk', idx_cur + 1, 'of', chunk_num,
+                      ', ratio range:', chunk[2], chunk[3])
+                export_chunk_datasets(f, chunk, settings, datasets, metas, pointings[idx_cur],
+                                      combine_stokes, net=net, files=files)
 
     print("--- %s seconds ---" % (time.time() - start_time))
 
@@ -286,7 +520,15 @@ def main():
                 args.simple_fname,
                 args.add_ksp_logo,
                 args.add_idols_logo,
-                args.flip_freq)
+                args.flip_freq,
+                args.n_prefetch,
+                args.workers,
+                args.stream,
+                args.memmap,
+                args.backend,
+                args.all_stokes,
+                args.combine_stokes,
+                args.subband_edge)
 
 
 #if __name__ == '__main__':
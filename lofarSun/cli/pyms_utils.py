@@ -6,10 +6,12 @@ by Peijin Zhang
 version 0.1 2022-5-23 00:24:52: Initial version
 """
 
-import casacore.tables as pt
 import datetime
+import hashlib
+import json
+import os
+import sys
 
-from astropy.time import Time
 import numpy as np
 
 from argparse import ArgumentParser
@@ -35,6 +37,150 @@ def human_format(number):
     return (number / k**magnitude, units[magnitude])
 
 
+# MS metadata cache:
+# the metadata used by the pyms commands (antennas, time axis, spectral windows,
+# fields, observation) is read once with TaQL and kept as a json file per MS,
+# in $LOFARSUN_CACHE_DIR or ~/.cache/lofarSun/ms_meta, the file is rebuilt
+# when any table of the MS is modified
+
+ms_meta_version = 1
+_ms_meta_memory = {}
+
+
+def ms_meta_cache_dir():
+    """ directory of the MS metadata cache files """
+    cache_dir = os.environ.get('LOFARSUN_CACHE_DIR',
+                               os.path.join(os.path.expanduser('~'), '.cache', 'lofarSun'))
+    return os.path.join(cache_dir, 'ms_meta')
+
+
+def ms_mtime(fname):
+    """ latest modification time of the MS, over the main table and the subtables
+
+    Args:
+        fname (string): measurement set name
+
+    Returns:
+        float : modification time (s)
+    """
+    mtime = os.stat(fname).st_mtime
+    for entry in os.scandir(fname):
+        mtime = max(mtime, entry.stat().st_mtime)
+        if entry.is_dir():
+            for sub_entry in os.scandir(entry.path):
+                mtime = max(mtime, sub_entry.stat().st_mtime)
+    return mtime
+
+
+def _to_json(value):
+    # numpy values of the casacore columns to json types
+    if isinstance(value, dict) and 'array' in value:
+        value = value['array']
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_to_json(item) for item in value]
+    return value
+
+
+def read_ms_meta(fname):
+    """ read the metadata of a MS with TaQL, without the cache
+
+    Args:
+        fname (string): measurement set name
+
+    Returns:
+        dict : antenna, time, spectral window, field and observation information
+    """
+    import casacore.tables as pt
+    from astropy.time import Time
+
+    ant_all = pt.taql('select * from '+fname+'/ANTENNA')
+    ant = list(ant_all.getcol('NAME'))
+    nbaseline = int((len(ant)+1)*len(ant)/2)
+    t_all = pt.taql('select TIME from '+fname+' LIMIT ::$nbaseline').getcol('TIME')
+    obs_this_tmp = pt.taql('select * from '+fname+'/OBSERVATION')
+    time_range = (Time(obs_this_tmp.getcol('TIME_RANGE').ravel()[0:2]/3600/24.,
+                       format='mjd').to_datetime())
+
+    observation = {}
+    for col in ['TELESCOPE_NAME', 'OBSERVER', 'PROJECT',
+                'LOFAR_PROJECT_PI', 'LOFAR_OBSERVATION_ID', 'LOFAR_TARGET']:
+        if col in obs_this_tmp.colnames():
+            observation[col] = _to_json(obs_this_tmp.getcol(col))[0]
+
+    spw = pt.taql('select * from '+fname+'/SPECTRAL_WINDOW')
+    spw_cols = ['NAME', 'NUM_CHAN', 'REF_FREQUENCY', 'TOTAL_BANDWIDTH',
+                'CHAN_FREQ', 'CHAN_WIDTH', 'EFFECTIVE_BW']
+    field = pt.taql('select * from '+fname+'/FIELD')
+    field_cols = ['PHASE_DIR', 'CODE', 'NAME']
+    ant_cols = ['NAME', 'MOUNT', 'DISH_DIAMETER', 'POSITION']
+
+    return {
+        'version': ms_meta_version,
+        'path': os.path.abspath(fname),
+        'mtime': ms_mtime(fname),
+        'antenna': [{col: _to_json(ant_all[rowid][col]) for col in ant_cols}
+                    for rowid in ant_all.rownumbers()],
+        'nbaseline': nbaseline,
+        'time': _to_json(t_all),
+        'time_range': [t.isoformat() for t in time_range],
+        'feed_interval': _to_json(pt.taql('select INTERVAL from '+fname+'/FEED').getcol('INTERVAL')[0]),
+        'observation': observation,
+        'spectral_window': [{col: _to_json(spw[rowid][col]) for col in spw_cols}
+                            for rowid in spw.rownumbers()],
+        'field': [{col: _to_json(field[rowid][col]) for col in field_cols}
+                  for rowid in field.rownumbers()],
+    }
+
+
+def get_ms_meta(fname, use_cache=True):
+    """ metadata of a MS, from the cache if it is up to date, read with TaQL
+    and stored in the cache otherwise
+
+    Args:
+        fname (string): measurement set name
+        use_cache (bool): read and write the cache, default True
+
+    Returns:
+        dict : metadata, see read_ms_meta
+    """
+    if not use_cache:
+        return read_ms_meta(fname)
+    path = os.path.abspath(fname)
+    mtime = ms_mtime(fname)
+    if (path, mtime) in _ms_meta_memory:
+        return _ms_meta_memory[(path, mtime)]
+
+    cache_file = os.path.join(ms_meta_cache_dir(),
+                              hashlib.sha1(path.encode()).hexdigest() + '.json')
+    meta = None
+    if os.path.isfile(cache_file):
+        try:
+            with open(cache_file) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = None
+        if (meta is not None and (meta.get('version') != ms_meta_version
+                                  or meta.get('path') != path or meta.get('mtime') != mtime)):
+            meta = None
+    if meta is None:
+        meta = read_ms_meta(fname)
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            # write to a temporary file first, other jobs may read the same MS at the same time
+            tmp_file = cache_file + '.%d.tmp' % os.getpid()
+            with open(tmp_file, 'w') as f:
+                json.dump(meta, f)
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            print(bcolors.WARNING+'[WARNING]'+bcolors.ENDC+' MS metadata not cached: '+str(e))
+    _ms_meta_memory[(path, mtime)] = meta
+    return meta
+
+
 def get_obs_info_from_ms(fname):
     """ get observation information from ms
 
@@ -46,10 +192,9 @@ def get_obs_info_from_ms(fname):
         int : number of baselines
         string : telescope name
     """
-    ant = pt.taql('select NAME from '+fname+'/ANTENNA').getcol("NAME")
-    nbaseline = int((len(ant)+1)*len(ant)/2)
-    telescope_name = pt.taql('select TELESCOPE_NAME from '+fname+'/OBSERVATION').getcol('TELESCOPE_NAME')[0]
-    return ant, nbaseline, telescope_name
+    meta = get_ms_meta(fname)
+    ant = [antenna['NAME'] for antenna in meta['antenna']]
+    return ant, meta['nbaseline'], meta['observation']['TELESCOPE_NAME']
 
 
 def get_t_from_ms(fname):
@@ -62,17 +207,88 @@ def get_t_from_ms(fname):
         int : total number of time index
         list : time range
     """
-    ant, nbaseline, telescope_name = get_obs_info_from_ms(fname)
-    t_all  = pt.taql('select TIME from '+fname+' LIMIT ::$nbaseline').getcol('TIME')
-    N_idx_time =  len(t_all)
-    obs_this_tmp = pt.taql('select * from '+fname+'/OBSERVATION')
-    time_range = (Time(obs_this_tmp.getcol('TIME_RANGE').ravel()[0:2]/3600/24.,
-                           format='mjd').to_datetime())
+    meta = get_ms_meta(fname)
+    N_idx_time = len(meta['time'])
+    time_range = [datetime.datetime.fromisoformat(t) for t in meta['time_range']]
     return N_idx_time, time_range
 
 def get_freq_from_ms(fname):
-    spw = pt.taql('select REF_FREQUENCY from '+fname+'/SPECTRAL_WINDOW')
-    return spw.getcol('REF_FREQUENCY')[0]
+    return get_ms_meta(fname)['spectral_window'][0]['REF_FREQUENCY']
+
+# origin of the MJD seconds of the TIME column
+mjd_epoch = datetime.datetime(1858, 11, 17)
+
+
+def ms_time_axis(fname):
+    """ time axis of the MS, the TIME column of the first baseline
+
+    Args:
+        fname (string): measurement set name
+
+    Returns:
+        np.ndarray : time of each time index (MJD seconds)
+    """
+    return np.array(get_ms_meta(fname)['time'], dtype=np.float64)
+
+
+def ms_datetimes_to_indices(fname, t_list, t_format='%H:%M:%S.%f'):
+    """ convert many datetimes to the index of the nearest time slot of the MS
+
+    Args:
+        fname (string): measurement set name
+        t_list (list): datetime strings in t_format, or datetime objects
+        t_format (string): format of the strings, the fields missing in the
+            format (e.g. the date) are taken from the start of the observation,
+            or from the next day for an observation over midnight
+
+    Returns:
+        np.ndarray : index of each datetime, the datetimes before (after)
+            the observation give the first (last) index
+    """
+    t_axis = ms_time_axis(fname)
+    N_idx_time, time_range = get_t_from_ms(fname)
+    t_start, t_end = time_range[0], time_range[1]
+    # start of the observation with only the fields of t_format
+    t_start_fmt = datetime.datetime.strptime(t_start.strftime(t_format), t_format)
+    no_date = (t_start_fmt.date() != t_start.date())
+
+    t_sec = np.zeros(len(t_list), dtype=np.float64)
+    for idx, t in enumerate(t_list):
+        if isinstance(t, datetime.datetime):
+            t_now = t
+        else:
+            offset = datetime.datetime.strptime(t, t_format) - t_start_fmt
+            if no_date and offset.total_seconds() < 0:
+                # time of the day after midnight, if the observation crosses midnight,
+                # i.e. the next day is nearer to the observation than before its start
+                if t_start + offset + datetime.timedelta(days=1) - t_end < -offset:
+                    offset += datetime.timedelta(days=1)
+            t_now = t_start + offset
+        t_sec[idx] = (t_now - mjd_epoch).total_seconds()
+
+    # nearest time slot, the slots are split half way between the samples
+    edges = (t_axis[1:] + t_axis[:-1]) / 2
+    return np.searchsorted(edges, t_sec, side='right')
+
+
+def ms_indices_to_datetimes(fname, idx_list):
+    """ convert many time indices of the MS to datetimes
+
+    Args:
+        fname (string): measurement set name
+        idx_list (list): time indices
+
+    Returns:
+        list : datetime of each index, the TIME of the slot
+    """
+    t_axis = ms_time_axis(fname)
+    idx_arr = np.asarray(idx_list, dtype=np.int64)
+    if np.any((idx_arr < 0) | (idx_arr >= len(t_axis))):
+        raise ValueError('time index out of range [0, {}) for {}: {}'.format(
+            len(t_axis), fname, idx_arr[(idx_arr < 0) | (idx_arr >= len(t_axis))].tolist()))
+    t_us = np.round(t_axis[idx_arr] * 1e6).astype(np.int64)
+    return [mjd_epoch + datetime.timedelta(microseconds=int(t)) for t in t_us]
+
 
 def ms_datetime_to_index(fname, t, t_format='%H:%M:%S.%f'):
     """ convert datetime to index
@@ -84,23 +300,20 @@ def ms_datetime_to_index(fname, t, t_format='%H:%M:%S.%f'):
     Returns:
         int : index
     """
-    N_idx_time, time_range = get_t_from_ms(fname)
-    t_start = datetime.datetime.strftime(time_range[0],t_format) 
-    t_end   = datetime.datetime.strftime(time_range[1],t_format)
-        
-    # find out the index of 't_now_MS'
-    t_now   = datetime.datetime.strptime(t   , t_format)
-    t_start   = datetime.datetime.strptime(t_start  , t_format)
-    t_end   = datetime.datetime.strptime(t_end   , t_format)
-    now_idx = round((t_now-t_start)/(t_end-t_start) * N_idx_time) 
-    return now_idx
+    return int(ms_datetimes_to_indices(fname, [t], t_format)[0])
 
 def ms_index_to_datetime(fname, idx):
-    N_idx_time, time_range = get_t_from_ms(fname)
-    t_start = time_range[0]
-    t_end   = time_range[1]
-    t_now = float(idx) / float(N_idx_time) * (t_end - t_start) + t_start
-    return t_now
+    return ms_indices_to_datetimes(fname, [idx])[0]
+
+
+def read_list_file(fname):
+    """ non-empty lines of a text file, '-' for stdin """
+    f = sys.stdin if fname == '-' else open(fname)
+    try:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+    finally:
+        if f is not sys.stdin:
+            f.close()
 
 
 def cook_wsclean_cmd(fname, mode="default", multiscale=True,
@@ -145,26 +358,144 @@ def cook_wsclean_cmd(fname, mode="default", multiscale=True,
 
     return clean_cmd
     
+def ms_overview_row(fname):
+    """ one line summary of a MS for the overview of many MSs
+
+    Args:
+        fname (string): measurement set name
+
+    Returns:
+        dict : frequency, time and station information of the MS
+    """
+    meta = get_ms_meta(fname)
+    N_idx_time, time_range = get_t_from_ms(fname)
+    t_axis = np.array(meta['time'], dtype=np.float64)
+    spw = meta['spectral_window'][0]
+    return {
+        'ms': fname,
+        'obs_id': meta['observation'].get('LOFAR_OBSERVATION_ID', ''),
+        'spw_name': spw['NAME'],
+        'ref_freq': spw['REF_FREQUENCY'],
+        'n_chan': spw['NUM_CHAN'],
+        'bandwidth': spw['TOTAL_BANDWIDTH'],
+        't_start': time_range[0].isoformat(),
+        't_end': time_range[1].isoformat(),
+        'n_time': N_idx_time,
+        'dt': float(np.median(np.diff(t_axis))) if len(t_axis) > 1 else meta['feed_interval'],
+        't_first': float(t_axis[0]) if len(t_axis) else np.nan,
+        't_last': float(t_axis[-1]) if len(t_axis) else np.nan,
+        'n_station': len(meta['antenna']),
+        'stations': ','.join(antenna['NAME'] for antenna in meta['antenna']),
+        'flags': '',
+    }
+
+
+def ms_overview_table(fname_list, workers=None):
+    """ overview of many MSs (e.g. all the subbands of an observation), the metadata
+    of the MSs are read in parallel, and the inconsistencies between the MSs flagged
+
+    Args:
+        fname_list (list): measurement set names
+        workers (int): number of processes, default min(number of MS, number of cores)
+
+    Returns:
+        list : one dict per MS (see ms_overview_row), sorted by frequency,
+               'flags' lists the quantities that differ from the majority of the MSs
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    if workers is None:
+        workers = min(len(fname_list), os.cpu_count() or 1)
+    if workers > 1 and len(fname_list) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            rows = list(pool.map(ms_overview_row, fname_list,
+                                 chunksize=max(1, len(fname_list) // (4 * workers))))
+    else:
+        rows = [ms_overview_row(fname) for fname in fname_list]
+    rows.sort(key=lambda row: row['ref_freq'])
+
+    # compare with the most common value among the MSs
+    checks = {'obs_id': None, 'n_time': None, 't_first': 1e-3, 't_last': 1e-3,
+              'dt': 1e-6, 'n_chan': None, 'bandwidth': None, 'stations': None}
+    for key, tol in checks.items():
+        values = [row[key] for row in rows]
+        common = max(values, key=values.count)
+        for row in rows:
+            differ = (abs(row[key] - common) > tol) if tol is not None else (row[key] != common)
+            if differ:
+                row['flags'] = (row['flags'] + ' ' + key).strip()
+    freqs = [row['ref_freq'] for row in rows]
+    for row in rows:
+        if freqs.count(row['ref_freq']) > 1:
+            row['flags'] = (row['flags'] + ' duplicate_freq').strip()
+    return rows
+
+
+def print_ms_overview_table(rows, out_format='table', out=None):
+    """ print the overview of many MSs as a table, json or csv
+
+    Args:
+        rows (list): output of ms_overview_table
+        out_format (string): 'table', 'json' or 'csv'
+        out (file): output, default stdout
+    """
+    out = out or sys.stdout
+    if out_format == 'json':
+        json.dump(rows, out, indent=1)
+        out.write('\n')
+    elif out_format == 'csv':
+        import csv
+        writer = csv.DictWriter(out, fieldnames=list(rows[0].keys()) if rows else [])
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        out.write('MS \tFreq(MHz) \t#Chan \tT_start \tT_end \t#T \tdT(s) \t#Stations \tFlags\n')
+        for row in rows:
+            out.write('\t'.join([row['ms'], str(np.round(row['ref_freq']/1e6, 3)), str(row['n_chan']),
+                                 row['t_start'], row['t_end'], str(row['n_time']),
+                                 str(np.round(row['dt'], 5)), str(row['n_station']),
+                                 bcolors.WARNING+row['flags']+bcolors.ENDC if row['flags'] else ''])+'\n')
+        n_flagged = sum(1 for row in rows if row['flags'])
+        if n_flagged:
+            out.write(bcolors.WARNING+'[WARNING]'+bcolors.ENDC+' {} of {} MS differ from the others\n'.format(
+                n_flagged, len(rows)))
+
+
 #==============================================================================
 # the cli entry points:
 
 def pyms_overview_main():
     parser = ArgumentParser()
-    parser.add_argument("filename", default=None,
-                      help="MS file with full directory", metavar="FILE")
+    parser.add_argument("filename", default=None, nargs='+',
+                      help="MS file(s) with full directory, one line per MS if more than one", metavar="FILE")
     parser.add_argument("-v", "--verbose",
                       action="store_true", dest="verbose", default=False,
                       help="detailed info")
+    parser.add_argument("--format", dest="out_format", default=None, choices=['table', 'json', 'csv'],
+                      help="one line per MS as a table, json or csv, default table for more than one MS")
+    parser.add_argument("-o", "--output", dest="output", default=None,
+                      help="write the table to this file instead of stdout")
+    parser.add_argument("-j", "--workers", dest="workers", default=None, type=int,
+                      help="number of processes to read the MSs, default number of cores")
 
     args = parser.parse_args()
 
     if args.filename==None:
         print(bcolors.FAIL+'Empty input.'+bcolors.ENDC)
+    elif len(args.filename) > 1 or args.out_format is not None:
+        rows = ms_overview_table(args.filename, workers=args.workers)
+        if args.output is None:
+            print_ms_overview_table(rows, args.out_format or 'table')
+        else:
+            with open(args.output, 'w', newline='') as out:
+                print_ms_overview_table(rows, args.out_format or 'table', out)
+        return 0
     else:
-        fname = args.filename
+        fname = args.filename[0]
         
+        meta = get_ms_meta(fname)
         N_idx_time, time_range = get_t_from_ms(fname)
         ant, nbaseline, telescope_name = get_obs_info_from_ms(fname)
+        observation = meta['observation']
 
         print(bcolors.OKGREEN+'[INFO]'+bcolors.ENDC+' Input MS : '+fname)
         print('==============================================')
@@ -179,33 +510,33 @@ def pyms_overview_main():
         info_print('Obs End t : \t', str(time_range[1])+' (UTC)')
         info_print('T_end-T_start: \t', str((time_range[1]-time_range[0]).total_seconds()))
         info_print('dT:\t', str(round((time_range[1]-time_range[0]).total_seconds()/N_idx_time, 5)))
-        info_print('Total t(raw): \t',pt.taql('select INTERVAL from '+fname+'/FEED').getcol('INTERVAL')[0])
+        info_print('Total t(raw): \t',meta['feed_interval'])
         print(' ')
 
 
         print(bcolors.OKGREEN+'[INFO]'+bcolors.ENDC+' Observation ')
         info_print('Telescope : \t',telescope_name)
-        info_print('Observer : \t',pt.taql('select OBSERVER from '+fname+'/OBSERVATION').getcol('OBSERVER')[0])
-        info_print('Project : \t',pt.taql('select PROJECT from '+fname+'/OBSERVATION').getcol('PROJECT')[0])
+        info_print('Observer : \t',observation['OBSERVER'])
+        info_print('Project : \t',observation['PROJECT'])
         if telescope_name=="LOFAR":
             info_print('Project PI: \t',
-                       pt.taql('select LOFAR_PROJECT_PI from '+fname+'/OBSERVATION').getcol('LOFAR_PROJECT_PI')[0])
+                       observation['LOFAR_PROJECT_PI'])
             info_print('LOFAR SASID: \t',
-                       pt.taql('select LOFAR_OBSERVATION_ID from '+fname+'/OBSERVATION').getcol('LOFAR_OBSERVATION_ID')[0])
+                       observation['LOFAR_OBSERVATION_ID'])
             info_print('LOFAR Target: \t',
-                       pt.taql('select LOFAR_TARGET from '+fname+'/OBSERVATION').getcol('LOFAR_TARGET')['array'][0])
+                       observation['LOFAR_TARGET'])
         print(' ')
 
         #info_print('Project PI: \t',pt.taql('select PROJECT from '+fname+'/OBSERVATION').getcol('PROJECT')[0])
         print('==============================================')
 
         print(bcolors.OKGREEN+'[INFO]'+bcolors.ENDC+' Spectral Windows: ')
-        spw = pt.taql('select * from '+fname+'/SPECTRAL_WINDOW')
+        spw = meta['spectral_window']
         show_col = ['NAME','NUM_CHAN', 'REF_FREQUENCY', 'TOTAL_BANDWIDTH', 'CHAN_FREQ', 'CHAN_WIDTH', 'EFFECTIVE_BW']
         print('Name \t#Chan \tCh0(Hz) \tTotBW(Hz) \tChFreq(Hz) \tChW(Hz) \tEffBW(Hz)')
         #obs_this_tmp.colnames()
 
-        for rowid in spw.rownumbers():
+        for rowid in range(len(spw)):
             line_print=''
             for idx,entry in enumerate(show_col):
                 if idx<=1:
@@ -218,13 +549,13 @@ def pyms_overview_main():
         print(' ')
 
         print(bcolors.OKGREEN+'[INFO]'+bcolors.ENDC+' Fields: ')
-        spw = pt.taql('select * from '+fname+'/FIELD')
+        spw = meta['field']
         show_col = ['PHASE_DIR','CODE','NAME']
         print('RA(d) \tDEC(d) \tCode \tName')
         #obs_this_tmp.colnames()
 
-        for rowid in spw.rownumbers():
-            pointing = spw[rowid]['PHASE_DIR'].ravel()
+        for rowid in range(len(spw)):
+            pointing = np.array(spw[rowid]['PHASE_DIR']).ravel()
             print(str(round(pointing[0]*180/np.pi,2))+'\t'+str(round(pointing[1]*180/np.pi,2))+'\t'+str(spw[rowid]['CODE'])+'\t'+str(spw[rowid]['NAME']))
         print(' ')
 
@@ -233,18 +564,18 @@ def pyms_overview_main():
         if args.verbose ==True:
             
             print(bcolors.OKGREEN+'[INFO]'+bcolors.ENDC+' Antenna set: ')
-            ant_all = pt.taql('select * from '+fname+'/ANTENNA')
+            ant_all = meta['antenna']
             show_col = ['NAME','MOUNT', 'DISH_DIAMETER', 'POSITION']
             print('AntName \t#Mount \tDiameter(m) \tPosXYZ(m)')
             #obs_this_tmp.colnames()
 
-            for rowid in ant_all.rownumbers():
+            for rowid in range(len(ant_all)):
                 line_print=''
                 for idx,entry in enumerate(show_col):
                     if idx<=1:
                         line_print += (str(ant_all[rowid][entry])+'\t')
                     else:
-                        line_print += (str(np.round(ant_all[rowid][entry],3))+'\t')
+                        line_print += (str(np.round(np.array(ant_all[rowid][entry]),3))+'\t')
 
                 print(line_print)
             print(' ')
@@ -254,23 +585,30 @@ def pyms_overview_main():
 
 def pyms_datetime_to_index_main():
     parser = ArgumentParser()
-    parser.add_argument("filename", default=None,
-                      help="MS file with full directory", metavar="FILE")
-    parser.add_argument("-t", "--time", dest="time", default='12:00:00.000',
-                      help="default time format is %%H:%%M:%%S.%%f, can be changed by -fmt")
+    parser.add_argument("filename", default=None, nargs='+',
+                      help="MS file(s) with full directory", metavar="FILE")
+    parser.add_argument("-t", "--time", dest="time", default=None, nargs='+',
+                      help="time(s), default time format is %%H:%%M:%%S.%%f, can be changed by -fmt, default 12:00:00.000")
     parser.add_argument("--fmt", "--format", dest="format", default='%H:%M:%S.%f',
                       help="default is %%H:%%M:%%S.%%f")
+    parser.add_argument("-f", "--file", dest="file", default=None,
+                      help="file with one time per line, '-' for stdin")
 
     args = parser.parse_args()
 
     if args.filename==None:
         print(bcolors.FAIL+'Empty input.'+bcolors.ENDC)
     else:
-        fname = args.filename
-        
+        t_list = (args.time or []) + (read_list_file(args.file) if args.file else [])
+        if len(t_list) == 0:
+            t_list = ['12:00:00.000']
+
         t_format = args.format
-        now_idx = ms_datetime_to_index(fname, args.time, t_format)
-        print(now_idx)
+        for fname in args.filename:
+            now_idx = ms_datetimes_to_indices(fname, t_list, t_format)
+            for t, idx in zip(t_list, now_idx):
+                # one MS: only the index, as for a single time
+                print(idx if len(args.filename) == 1 else fname+'\t'+t+'\t'+str(idx))
     return 0
 
 def pyms_cook_wsclean_cmd_main():
@@ -315,26 +653,38 @@ def pyms_cook_wsclean_cmd_main():
     
 def pyms_index_to_datetime_main():
     parser = ArgumentParser()
-    parser.add_argument("filename", default=None,
-                      help="MS file with full directory", metavar="FILE")
-    parser.add_argument("-i", "--idx", dest="idx", default=0, type=int,
-                      help="index of the slot")
+    parser.add_argument("filename", default=None, nargs='+',
+                      help="MS file(s) with full directory", metavar="FILE")
+    parser.add_argument("-i", "--idx", dest="idx", default=None, type=int, nargs='+',
+                      help="index(es) of the slot, default 0")
     parser.add_argument("--fmt", "--format", dest="format", type=str ,default="%H:%M:%S.%f",
                       help="default is %%H:%%M:%%S.%%f") # %% is needed to print % in help
+    parser.add_argument("-f", "--file", dest="file", default=None,
+                      help="file with one index per line, '-' for stdin")
 
     args = parser.parse_args()
 
     if args.filename==None:
         print(bcolors.FAIL+'Empty input.'+bcolors.ENDC)
     else:
-        fname = args.filename
-        t_format = args.format
-        t_now = ms_index_to_datetime(fname, args.idx)
-        print(t_now.strftime(args.format))
+        idx_list = (args.idx or []) + ([int(idx) for idx in read_list_file(args.file)] if args.file else [])
+        if len(idx_list) == 0:
+            idx_list = [0]
+
+        for fname in args.filename:
+            try:
+                t_now = ms_indices_to_datetimes(fname, idx_list)
+            except ValueError as e:
+                print(bcolors.FAIL+str(e)+bcolors.ENDC)
+                return 1
+            for idx, t in zip(idx_list, t_now):
+                print(t.strftime(args.format) if len(args.filename) == 1
+                      else fname+'\t'+str(idx)+'\t'+t.strftime(args.format))
     return 0
 
-from lofarSun.IM import get_peak_beam_from_psf
 def pyms_psf_fit_peak_gauss_main():
+    # lofarSun.IM loads sunpy.map, only this command needs it
+    from lofarSun.IM import get_peak_beam_from_psf
     parser = ArgumentParser()
     parser.add_argument("filename", default=None,
                       help="fits file for PSF with full directory", metavar="FILE")
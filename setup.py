@@ -36,6 +36,7 @@ setup(
   ],
   entry_points={'console_scripts': ['lofarBFcube=lofarSun.BF.GUI.lofarBFgui:main',
                                     'h5toFitsDS=lofarSun.cli.h5_to_fits_spec:main',
+                                    'h5toFitsCube=lofarSun.cli.h5_to_fits_cube:main',
                                     'pymsPSFfitPeakGauss=lofarSun.cli.pyms_utils:pyms_psf_fit_peak_gauss_main',
                                     'pymsOverview=lofarSun.cli.pyms_utils:pyms_overview_main',
                                     'pymsCookWscleanCMD=lofarSun.cli.pyms_utils:pyms_cook_wsclean_cmd_main',
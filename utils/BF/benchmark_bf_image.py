@@ -0,0 +1,71 @@
+"""
+Benchmark of BFcube.bf_image_by_idx
+
+Compare the time per image of scipy.interpolate.griddata on the beams
+(the old behaviour, triangulation and weights computed for every image)
+with the cached interpolation weights of BFcube, for every method,
+and a loop of bf_image_by_idx with one batched bf_image_cube call.
+
+usage:  python benchmark_bf_image.py [n_beams] [n_images]
+"""
+
+import sys
+import time
+import numpy as np
+from scipy.interpolate import griddata
+from lofarSun.BF.BFdata import BFcube
+
+n_beams = int(sys.argv[1]) if len(sys.argv) > 1 else 127
+n_images = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+fov, asecpix = 3000, 20
+
+rng = np.random.default_rng(0)
+cube = BFcube()
+cube.data_cube = rng.random((8, n_images, n_beams))
+cube.xb = rng.uniform(-1500, 1500, n_beams)
+cube.yb = rng.uniform(-1500, 1500, n_beams)
+
+
+def bf_image_griddata(data_beam, method):
+    x = np.arange(-fov, fov, asecpix)
+    X, Y = np.meshgrid(x, x)
+    r = 1.5*np.max(np.sqrt(cube.xb**2+cube.yb**2))
+    theta = np.linspace(0, 2*np.pi, 36)
+    bf_xb = np.hstack((cube.xb, r*np.cos(theta)))
+    bf_yb = np.hstack((cube.yb, r*np.sin(theta)))
+    data_beam_bf = np.hstack(
+        (data_beam, np.ones(np.size(theta))*np.median(data_beam)))-np.min(data_beam)
+    return griddata((bf_xb, bf_yb), data_beam_bf, (X, Y), method=method,
+                    fill_value=np.median(data_beam)-np.min(data_beam))
+
+
+for method in ['nearest', 'linear', 'cubic']:
+    t0 = time.time()
+    res_griddata = [bf_image_griddata(cube.data_cube[0, idx, :], method) for idx in range(n_images)]
+    t_griddata = time.time() - t0
+
+    t0 = time.time()
+    cube.bf_image_weights(fov, asecpix, True, method)
+    t_weights = time.time() - t0
+    t0 = time.time()
+    res_cached = [cube.bf_image_by_idx(0, idx, fov, asecpix, True, method)[2] for idx in range(n_images)]
+    t_cached = time.time() - t0
+
+    assert all(np.allclose(a, b, rtol=1e-10, atol=1e-12) for a, b in zip(res_griddata, res_cached))
+    print('%-8s griddata : %8.2f ms/image   cached : %6.2f ms/image  (weights %6.1f ms once)'
+          % (method, t_griddata / n_images * 1e3, t_cached / n_images * 1e3, t_weights * 1e3))
+
+for method in ['linear', 'cubic']:
+    t0 = time.time()
+    res_loop = np.array([[cube.bf_image_by_idx(f_idx, t_idx, fov, asecpix, True, method)[2]
+                          for t_idx in range(n_images)] for f_idx in range(8)])
+    t_loop = time.time() - t0
+
+    t0 = time.time()
+    x, y, res_cube = cube.bf_image_cube(slice(None), slice(None), fov, asecpix, True, method,
+                                        dtype=np.float64)
+    t_cube = time.time() - t0
+
+    assert np.allclose(res_loop, res_cube, rtol=1e-10, atol=1e-12)
+    print('%-8s loop     : %8.2f ms/image   cube   : %6.2f ms/image'
+          % (method, t_loop / res_cube[..., 0, 0].size * 1e3, t_cube / res_cube[..., 0, 0].size * 1e3))
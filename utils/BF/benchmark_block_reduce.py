@@ -0,0 +1,83 @@
+"""
+Benchmark of the block averaging in bftools
+
+Compare bftools.block_reduce with the previous list/stack based
+averaging_stride and averaging_walk, on the shapes and ratios used in
+proc_selfcalib_dynspec and proc_calib_dynspec, check that all give the
+same result.
+
+usage:  python benchmark_block_reduce.py [n_time] [n_freq]
+"""
+
+import sys
+import time
+import numpy as np
+from lofarSun.BF.bftools import block_reduce
+
+n_time = int(sys.argv[1]) if len(sys.argv) > 1 else 12000
+n_freq = int(sys.argv[2]) if len(sys.argv) > 2 else 3200
+
+
+def averaging_stride_old(arr_query, n_point, axis=0, start_idx=-1, end_idx=-1):
+    # the previous implementation, as reference
+    start_idx = 0 if start_idx < 0 else start_idx
+    end_idx = arr_query.shape[axis] if end_idx < 0 else end_idx
+    out_size = ((end_idx-start_idx) // n_point)
+    if axis == 1:
+        return np.mean(np.array(([arr_query[:, (start_idx+idx):(start_idx+(out_size)*n_point+idx):n_point]
+                                  for idx in range(n_point)])), axis=0)
+    return np.mean(np.array(([arr_query[(start_idx+idx):(start_idx+(out_size)*n_point+idx):n_point, :]
+                              for idx in range(n_point)])), axis=0)
+
+
+def averaging_walk_old(arr_query, n_point, axis=0, start_idx=-1, end_idx=-1):
+    # the previous implementation, as reference
+    start_idx = 0 if start_idx < 0 else start_idx
+    end_idx = arr_query.shape[axis] if end_idx < 0 else end_idx
+    out_size = ((end_idx-start_idx) // n_point)
+    if axis == 1:
+        return np.mean(np.stack(
+            ([(arr_query[:, (start_idx+idx*n_point):(start_idx+(idx+1)*n_point)]) for idx in range(out_size)]), axis=2), axis=axis)
+    return np.mean(np.stack(
+        ([(arr_query[(start_idx+idx*n_point):(start_idx+(idx+1)*n_point), :]) for idx in range(out_size)]), axis=2).swapaxes(1, 2), axis=axis)
+
+
+def timeit(func, *args, **kwargs):
+    t0 = time.time()
+    res = func(*args, **kwargs)
+    return res, time.time() - t0
+
+
+rng = np.random.default_rng(0)
+dynspec = rng.uniform(1, 2, (n_time, n_freq)).astype(np.float32)
+time_sun = np.linspace(0, 1, n_time)
+
+# the same blocks, up to the float32 summation order
+for axis, start_idx, end_idx in [(0, -1, -1), (1, -1, -1), (0, 3, 1001), (1, 5, 99)]:
+    for n_point in [1, 4, 16]:
+        small = dynspec[:1203, :257]
+        ref = averaging_stride_old(small, n_point, axis, start_idx, end_idx)
+        assert np.allclose(block_reduce(small, n_point, axis, start_idx, end_idx), ref, rtol=1e-6)
+        assert np.allclose(averaging_walk_old(small, n_point, axis, start_idx, end_idx), ref, rtol=1e-6)
+print('same result as averaging_stride and averaging_walk')
+
+print('dynamic spectrum shape : ', dynspec.shape)
+print('%28s %10s %10s %10s' % ('case', 'stride (s)', 'walk (s)', 'block (s)'))
+for name, arr, n_point, axis in [
+        ('selfcalib dynspec / 4', dynspec, 4, 0),
+        ('selfcalib time / 4', time_sun[:, None], 4, 0),
+        ('bandpass dynspec / 16', dynspec[:n_time // 4], 16, 0),
+        ('calib dynspec / 16', dynspec, 16, 0),
+        ('frequency / 8', dynspec, 8, 1)]:
+    res_stride, t_stride = timeit(averaging_stride_old, arr, n_point, axis)
+    res_walk, t_walk = timeit(averaging_walk_old, arr, n_point, axis)
+    res, t_block = timeit(block_reduce, arr, n_point, axis)
+    assert np.allclose(res, res_stride, rtol=1e-6) and np.allclose(res, res_walk, rtol=1e-6)
+    print('%28s %10.3f %10.3f %10.3f' % (name, t_stride, t_walk, t_block))
+
+arr_nan = dynspec.copy()
+arr_nan[rng.random(arr_nan.shape) < 0.01] = np.nan
+res_nan, t_nan = timeit(block_reduce, arr_nan, 4, 0, nan_policy='omit')
+res_weight, t_weight = timeit(block_reduce, dynspec, 4, 0, weights=np.isfinite(arr_nan))
+print('%28s %10s %10s %10.3f' % ('nanmean / 4', '', '', t_nan))
+print('%28s %10s %10s %10.3f' % ('weighted / 4', '', '', t_weight))
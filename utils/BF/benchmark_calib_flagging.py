@@ -0,0 +1,102 @@
+"""
+Benchmark of the per-channel flagging and interpolation of the calibration
+
+Compare flag_frequency_slices in bftools, which works on blocks of channels,
+and perform_linear_interpolation, which loops over contiguous channels of the
+transposed spectrum, with the previous loops over the strided columns, and
+check that both give the same result.
+
+usage:  python benchmark_calib_flagging.py [n_time] [n_freq]
+"""
+
+import sys
+import time
+import contextlib
+import io
+import numpy as np
+from lofarSun.BF.bftools import flag_frequency_slices, perform_linear_interpolation
+
+n_time = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+n_freq = int(sys.argv[2]) if len(sys.argv) > 2 else 1600
+
+
+def flag_frequency_slices_loop(dynspec_cal, mask_cal, ratio_flag=1.5, lower_perc=15, upper_perc=40):
+    # the previous implementation, as reference
+    for freq_idx in np.arange(dynspec_cal.shape[1]):
+        mask_freq = mask_cal[:, freq_idx]
+        dyspec_freq = dynspec_cal[:, freq_idx]
+        idx = np.where(dyspec_freq > ratio_flag * np.mean(dyspec_freq[np.where(
+            (dyspec_freq > np.percentile(dyspec_freq, lower_perc)) &
+            (dyspec_freq < np.percentile(dyspec_freq, upper_perc)))[0]]))[0]
+        mask_freq[idx] = 0
+        mask_cal[:, freq_idx] = mask_freq
+    return mask_cal
+
+
+def perform_linear_interpolation_loop(dynspec_cal_copy, mask_cal, t_cal):
+    # the previous implementation, as reference
+    robust_fill_value = 0
+    for freq_idx in np.arange(dynspec_cal_copy.shape[1]):
+        mask_freq = mask_cal[:, freq_idx]
+        dyspec_freq = dynspec_cal_copy[:, freq_idx]
+        try:
+            res_interp = np.interp(t_cal[~mask_freq], t_cal[mask_freq], dyspec_freq[mask_freq])
+            robust_fill_value = np.nanmean(res_interp)
+        except:
+            res_interp = np.full_like(t_cal[~mask_freq], robust_fill_value)
+            print("Warning: interpolation failed for frequency slice", freq_idx)
+        dynspec_cal_copy[~mask_freq, freq_idx] = res_interp.ravel()
+    return dynspec_cal_copy
+
+
+def make_case(rng, n_t, n_f, density):
+    dynspec = (np.abs(rng.standard_normal((n_t, n_f))) + 1).astype(np.float32)
+    dynspec[rng.random((n_t, n_f)) < density] *= 10
+    dynspec[rng.random((n_t, n_f)) < 1e-3] = np.nan
+    t = np.sort(rng.random(n_t)) + 737000
+    mask = rng.random((n_t, n_f)) >= density
+    mask[:, 3] = False      # no unflagged pixel
+    mask[:, 4] = True       # nothing to interpolate
+    mask[:5, 6] = False     # flagged edges
+    mask[-5:, 6] = False
+    mask[:, 8] = False      # failed slice after a slice without flags
+    return dynspec, t, mask
+
+
+def run_quiet(func, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()) as out, np.errstate(all='ignore'):
+        res = func(*args, **kwargs)
+    return res, out.getvalue()
+
+
+rng = np.random.default_rng(0)
+with np.errstate(all='ignore'):
+    import warnings
+    warnings.simplefilter('ignore')
+    for density in [0.01, 0.2, 0.7]:
+        for chunk_size in [None, 1, 7, 256]:
+            dynspec, t, mask = make_case(rng, 301, 37, density)
+            assert np.array_equal(flag_frequency_slices(dynspec, mask.copy(), chunk_size=chunk_size),
+                                  flag_frequency_slices_loop(dynspec, mask.copy()))
+            res, msg = run_quiet(perform_linear_interpolation, dynspec.copy(), mask, t)
+            res_loop, msg_loop = run_quiet(perform_linear_interpolation_loop, dynspec.copy(), mask, t)
+            assert np.array_equal(res, res_loop, equal_nan=True)
+            assert msg == msg_loop
+print('same result as the per-channel loops')
+
+dynspec, t, mask = make_case(rng, n_time, n_freq, 0.05)
+print('dynamic spectrum shape : ', dynspec.shape)
+for name, func, func_loop, args in [
+        ('flag_frequency_slices', flag_frequency_slices, flag_frequency_slices_loop, (dynspec,)),
+        ('perform_linear_interpolation', perform_linear_interpolation, perform_linear_interpolation_loop, ())]:
+    if args:
+        call = lambda f: f(dynspec, mask.copy())
+    else:
+        call = lambda f: run_quiet(f, dynspec.copy(), mask, t)
+    t0 = time.time()
+    call(func_loop)
+    t_loop = time.time() - t0
+    t0 = time.time()
+    call(func)
+    t_new = time.time() - t0
+    print('%30s  loop %8.3f s   bftools %8.3f s   speedup %6.1f' % (name, t_loop, t_new, t_loop / t_new))
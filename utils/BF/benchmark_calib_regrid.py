@@ -0,0 +1,62 @@
+"""
+Benchmark of the bandpass regrid in the calibration of the dynamic spectrum
+
+Compare bftools.regrid_bilinear and the array call of model_flux with the
+previous loops of np.interp over every calibrator time and every solar
+channel (step 8 of proc_calib_dynspec), check that both give the same
+calibrated dynamic spectrum, up to rounding.
+
+usage:  python benchmark_calib_regrid.py [n_time_sun] [n_freq_sun]
+"""
+
+import sys
+import time
+import numpy as np
+from lofarSun.BF.bftools import regrid_bilinear, model_flux
+
+n_time_sun = int(sys.argv[1]) if len(sys.argv) > 1 else 36000
+n_freq_sun = int(sys.argv[2]) if len(sys.argv) > 2 else 1600
+n_time_cal, n_freq_cal = 250, 800
+
+rng = np.random.default_rng(0)
+time_sun = np.linspace(0, 1, n_time_sun)
+freq_sun = np.linspace(10, 90, n_freq_sun)
+t_cal = np.sort(rng.uniform(-0.1, 1.1, n_time_cal))
+f_cal = np.linspace(15, 85, n_freq_cal)
+dynspec_cal = rng.uniform(1, 2, (n_time_cal, n_freq_cal))
+dynspec_sun = rng.uniform(1, 2, (n_time_sun, n_freq_sun)).astype(np.float32)
+
+
+def calibrate_loop():
+    # the previous implementation, as reference
+    calib_bandpass = np.zeros_like(dynspec_sun)
+    tmp_calib_lst = []
+    for time_idx in range(t_cal.shape[0]):
+        tmp_calib_lst.append(np.interp(freq_sun, f_cal, dynspec_cal[time_idx, :]))
+    tmp_calib_arr = np.array(tmp_calib_lst)
+    for freq_idx, freq in enumerate(freq_sun):
+        calib_bandpass[:, freq_idx] = np.interp(time_sun, t_cal, tmp_calib_arr[:, freq_idx])
+    model_arr = np.array([model_flux('CasA', freq) for freq in freq_sun])
+    model_final = np.repeat(model_arr[:, None], calib_bandpass.shape[0], axis=1).T
+    return dynspec_sun / calib_bandpass * model_final
+
+
+def calibrate_regrid():
+    calib_bandpass = regrid_bilinear(t_cal, f_cal, dynspec_cal,
+                                     time_sun, freq_sun).astype(dynspec_sun.dtype, copy=False)
+    return dynspec_sun / calib_bandpass * model_flux('CasA', freq_sun)[None, :]
+
+
+t0 = time.time()
+res_loop = calibrate_loop()
+t_loop = time.time() - t0
+t0 = time.time()
+res = calibrate_regrid()
+t_regrid = time.time() - t0
+
+# the bandpass is the same bit for bit, the vectorised log10 of model_flux
+# may differ from the scalar one in the last bit
+assert np.allclose(res, res_loop, rtol=1e-12, atol=0)
+print('solar dynamic spectrum shape : ', dynspec_sun.shape)
+print('loops  : %8.3f s' % t_loop)
+print('regrid : %8.3f s' % t_regrid)
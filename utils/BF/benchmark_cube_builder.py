@@ -0,0 +1,113 @@
+"""
+Benchmark of the multi-beam cube builder (lofarSun.cli.h5_to_fits_cube)
+
+Write n_beams simulated beam files in the layout of the LOFAR BF hdf5 files,
+then compare the time to build the [freq, time, beam] cube with the previous
+loop of utils/BF/h5_to_fits_cube.py (one read per time bin, strided sampling,
+np.vstack and np.append of the growing arrays) and with build_bf_cube, and
+check the cube of build_bf_cube against the plain average of the beams.
+
+usage:  python benchmark_cube_builder.py [n_beams] [n_times] [n_freqs] [workers] [workdir]
+"""
+
+import os
+import sys
+import time
+import glob
+import tempfile
+import numpy as np
+import h5py
+import datetime
+from lofarSun.BF.BFdata import BFcube
+from lofarSun.sun_ephem import sun_ephem
+from lofarSun.cli.h5_to_fits_cube import find_beam_files, build_bf_cube
+
+n_beams = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+n_times = int(sys.argv[2]) if len(sys.argv) > 2 else 96 * 1200
+n_freqs = int(sys.argv[3]) if len(sys.argv) > 3 else 256
+workers = int(sys.argv[4]) if len(sys.argv) > 4 else 2
+workdir = sys.argv[5] if len(sys.argv) > 5 else tempfile.mkdtemp()
+tsamp = 1 / 96.
+t_bin = 0.25
+f_c_ratio = 2
+
+
+def write_beam(fname, idx_beam, rng):
+    with h5py.File(fname, 'w') as f:
+        f.attrs['PROJECT_ID'] = 'LC0_000'
+        f.attrs['OBSERVATION_ID'] = '000000'
+        f.attrs['ANTENNA_SET'] = 'LBA_OUTER'
+        f.attrs['TELESCOPE'] = 'LOFAR'
+        f.attrs['TARGETS'] = np.array(['Sun '], dtype=h5py.string_dtype())
+        f.attrs['OBSERVATION_START_UTC'] = '2020-06-01T10:00:00.000000000Z'
+        f.attrs['OBSERVATION_END_UTC'] = '2020-06-01T10:%02d:%02d.000000000Z' % divmod(int(n_times * tsamp), 60)
+        group = f.create_group('SUB_ARRAY_POINTING_000/BEAM_%03d' % idx_beam)
+        group.attrs['POINT_RA'] = 70.0 + 0.1 * idx_beam
+        group.attrs['POINT_DEC'] = 22.0 - 0.05 * idx_beam
+        group.attrs['SAMPLING_TIME'] = tsamp
+        group.create_group('COORDINATES/COORDINATE_0').attrs['INCREMENT'] = tsamp
+        group.create_group('COORDINATES/COORDINATE_1').attrs['AXIS_VALUES_WORLD'] = np.linspace(30e6, 80e6, n_freqs)
+        group.create_dataset('STOKES_0', data=rng.random((n_times, n_freqs), dtype=np.float32) + 1,
+                             chunks=(min(1024, n_times), n_freqs))
+
+
+def old_loop(fnames):
+    # the loop of the previous script, without the fits writing
+    x_points = 2000
+    for idx_file, fname in enumerate(fnames):
+        f = h5py.File(fname, 'r')
+        stokes_all = f['SUB_ARRAY_POINTING_000/BEAM_%03d/STOKES_0' % idx_file]
+        n_point = int(round(t_bin / tsamp))
+        for idx_cur in range(n_times // n_point):
+            idx_start, idx_end = idx_cur * n_point, (idx_cur + 1) * n_point
+            stokes = np.abs(stokes_all[idx_start:idx_end:int((idx_end - idx_start) / x_points + 1), :]) + 1e-7
+            array_this = np.mean(np.mean(stokes, 0).reshape(-1, f_c_ratio), 1).T
+            if idx_cur == 0:
+                array_all = array_this
+            else:
+                array_all = np.vstack((array_all, array_this))
+        if idx_file == 0:
+            array_all_beam = [array_all]
+        else:
+            array_all_beam = np.append(array_all_beam, [array_all], axis=0)
+        f.close()
+    return array_all_beam
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    for idx_beam in range(n_beams):
+        write_beam(os.path.join(workdir, 'L0_SAP000_B%03d_S0_P000_bf.h5' % idx_beam), idx_beam, rng)
+    fnames = find_beam_files(workdir)
+    sun_ephem(datetime.datetime(2020, 6, 1, 10))  # load the ephemeris before timing
+
+    t0 = time.time()
+    old_loop(fnames)
+    t_old = time.time() - t0
+
+    timings = {}
+    for n_workers in sorted(set([1, workers])):
+        out_fname = os.path.join(workdir, 'cube_%d.fits' % n_workers)
+        t0 = time.time()
+        build_bf_cube(fnames, out_fname, t_bin=t_bin, f_c_ratio=f_c_ratio, workers=n_workers)
+        timings[n_workers] = time.time() - t0
+
+    cube = BFcube()
+    cube.load_fits(os.path.join(workdir, 'cube_1.fits'))
+    n_point = int(round(t_bin / tsamp))
+    n_bin = (n_times - 1) // n_point
+    for idx_beam, fname in enumerate(fnames):
+        with h5py.File(fname, 'r') as f:
+            data = f['SUB_ARRAY_POINTING_000/BEAM_%03d/STOKES_0' % idx_beam][:n_bin * n_point] + 1e-7
+        ref = data.reshape(n_bin, n_point, -1).mean(1).reshape(n_bin, -1, f_c_ratio).mean(2)
+        assert np.allclose(cube.data_cube[:, :, idx_beam].T, ref, rtol=1e-5)
+    cube_workers = BFcube()
+    cube_workers.load_fits(os.path.join(workdir, 'cube_%d.fits' % workers))
+    assert np.array_equal(cube.data_cube, cube_workers.data_cube)
+
+    print('cube [freq, time, beam] :', cube.data_cube.shape)
+    print('previous loop           : %8.2f s' % t_old)
+    for n_workers, t_build in timings.items():
+        print('build_bf_cube, %2d proc  : %8.2f s' % (n_workers, t_build))
+    for fname in glob.glob(os.path.join(workdir, '*')):
+        os.remove(fname)
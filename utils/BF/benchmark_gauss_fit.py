@@ -0,0 +1,51 @@
+"""
+Benchmark of the Gaussian source fitting of BFcube
+
+Compare the time per fit of bf_fit_gauss_source_by_idx (image, labels and
+dilation for every fit) with the batched bf_fit_gauss_sources on the beam
+intensities, on simulated Gaussian sources, and check that the fitted
+centroids recover the simulated ones.
+
+usage:  python benchmark_gauss_fit.py [n_beams] [n_fits] [workers]
+"""
+
+import sys
+import time
+import numpy as np
+from lofarSun.BF.BFdata import BFcube
+from lofarSun.BF.bflocalisation import gauss2d_beam
+
+n_beams = int(sys.argv[1]) if len(sys.argv) > 1 else 217
+n_fits = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    cube = BFcube()
+    angle = rng.uniform(0, 2*np.pi, n_beams)
+    radius = 1500*np.sqrt(rng.random(n_beams))
+    cube.xb, cube.yb = radius*np.cos(angle), radius*np.sin(angle)
+    x_cent, y_cent = rng.uniform(-500, 500, n_fits), rng.uniform(-500, 500, n_fits)
+    cube.data_cube = np.array([gauss2d_beam([100, x_cent[idx], y_cent[idx], 0.3, 350, 250], cube.xb, cube.yb)
+                               + rng.normal(0, 1, n_beams) + 10 for idx in range(n_fits)])[None, :, :]
+    cube.time_ds = np.linspace(18500, 18500.01, n_fits)
+    cube.freqs_ds = np.array([30.])
+
+    n_single = min(n_fits, 10)
+    t0 = time.time()
+    res_single = [cube.bf_fit_gauss_source_by_idx(0, idx, drawfig=False, verb=False)[0]
+                  for idx in range(n_single)]
+    t_single = (time.time() - t0) / n_single
+
+    t0 = time.time()
+    res = cube.bf_fit_gauss_sources(0, slice(None), workers=workers)[0]
+    t_batch = (time.time() - t0) / n_fits
+
+    offset = np.hypot(res['x_cent'] - x_cent, res['y_cent'] - y_cent)
+    assert res['success'].all()
+    assert np.all(offset < 5 * np.hypot(res['x_cent_err'], res['y_cent_err']) + 1)
+    print('image fit   : %8.2f ms/fit' % (t_single * 1e3))
+    print('batched fit : %8.2f ms/fit (workers %d)' % (t_batch * 1e3, workers))
+    print('centroid offset median %.1f asec, max %.1f asec, median error %.1f asec'
+          % (np.median(offset), np.max(offset), np.median(np.hypot(res['x_cent_err'], res['y_cent_err']))))
@@ -0,0 +1,71 @@
+"""
+Benchmark of the memory mapped reading of BF datasets
+
+Write a synthetic contiguous, uncompressed STOKES dataset (10 GB by default),
+then read it segment by segment with h5py and through the memory map from
+bftools.h5_memmap_dataset, and downsample it both ways with
+downsample_h5_seg_by_time_ratio. Each read is done twice, the second pass
+is served by the page cache when the file fits in memory.
+
+usage:  python benchmark_h5_memmap.py [size_GB] [directory] [n_freq]
+"""
+
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import h5py
+from lofarSun.BF import bftools
+
+size_GB = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+out_dir = sys.argv[2] if len(sys.argv) > 2 else tempfile.gettempdir()
+n_freq = int(sys.argv[3]) if len(sys.argv) > 3 else 6400
+t_c_ratio, f_c_ratio, t_idx_cut = 24, 8, 256
+
+n_time = int(size_GB * 1024 ** 3 / 4 / n_freq)
+fname = os.path.join(out_dir, 'benchmark_memmap_SAP000_B000_S0_P000_bf.h5')
+dataset_uri = '/SUB_ARRAY_POINTING_000/BEAM_000/STOKES_0'
+
+print('writing', fname, ':', n_time, 'x', n_freq, 'float32')
+with h5py.File(fname, 'w') as f:
+    dset = f.create_dataset(dataset_uri, shape=(n_time, n_freq), dtype=np.float32)
+    block = (np.abs(np.random.randn(8192, n_freq)) + 1).astype(np.float32)
+    for idx in range(0, n_time, block.shape[0]):
+        dset[idx:idx + block.shape[0]] = block[:min(block.shape[0], n_time - idx)]
+
+segment_len = t_idx_cut * t_c_ratio
+slabs = [slice(idx, min(idx + segment_len, n_time)) for idx in range(0, n_time, segment_len)]
+
+
+def read_all(data_array):
+    total = 0.
+    for slab in slabs:
+        total += float(np.sum(data_array[slab, :], dtype=np.float64))
+    return total
+
+
+try:
+    with h5py.File(fname, 'r') as f:
+        dset = f[dataset_uri]
+        dset_memmap = bftools.h5_memmap_dataset(dset)
+        assert dset_memmap is not None
+        t_all = np.linspace(0, 1, n_time)
+
+        for name, data_array in [('h5py', dset), ('memmap', dset_memmap)]:
+            for idx_pass in range(2):
+                t0 = time.time()
+                read_all(data_array)
+                t_read = time.time() - t0
+                print('%8s read pass %d : %8.2f s  %8.1f MB/s'
+                      % (name, idx_pass + 1, t_read, size_GB * 1024 / t_read))
+
+        res = {}
+        for name, memmap in [('h5py', False), ('memmap', True)]:
+            t0 = time.time()
+            res[name] = bftools.downsample_h5_seg_by_time_ratio(
+                dset, t_all, 0, 1, n_time, t_c_ratio, f_c_ratio, t_idx_cut=t_idx_cut, memmap=memmap)
+            print('%8s downsample  : %8.2f s' % (name, time.time() - t0))
+        assert np.array_equal(res['h5py'][0], res['memmap'][0])
+finally:
+    os.remove(fname)
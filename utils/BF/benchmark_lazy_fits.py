@@ -0,0 +1,65 @@
+"""
+Benchmark of the lazy loading of FITS cubes (BFcube.load_fits with memmap)
+
+Write a random [freq, time, beam] FITS cube in the layout of h5_to_fits_cube,
+then compare, for the cube loaded in memory, memory-mapped and memory-mapped
+with the beam-major HDF5 copy, the time to load the cube, to read the dynamic
+spectrum of one beam and to read the beams of one image, and check that all
+the reads give the same data.
+
+usage:  python benchmark_lazy_fits.py [n_beams] [n_freqs] [n_times] [workdir]
+"""
+
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+from astropy.io import fits
+from lofarSun.BF.BFdata import BFcube, beam_major_h5_name
+
+n_beams = int(sys.argv[1]) if len(sys.argv) > 1 else 127
+n_freqs = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+n_times = int(sys.argv[3]) if len(sys.argv) > 3 else 2048
+workdir = sys.argv[4] if len(sys.argv) > 4 else tempfile.mkdtemp()
+
+fname = os.path.join(workdir, 'lazy_cube_test.fits')
+rng = np.random.default_rng(0)
+hdu_lofar = fits.PrimaryHDU(rng.random((n_freqs, n_times, n_beams), dtype=np.float32))
+col_f = fits.Column(name='FREQ', array=np.linspace(30, 80, n_freqs), format="D")
+col_t = fits.Column(name='TIME', array=np.linspace(18500, 18500.01, n_times), format="D")
+col_x = fits.Column(name='X', array=rng.uniform(-1500, 1500, n_beams), format="D")
+col_y = fits.Column(name='Y', array=rng.uniform(-1500, 1500, n_beams), format="D")
+fits.HDUList([hdu_lofar,
+              fits.BinTableHDU.from_columns([col_f], name="FREQ"),
+              fits.BinTableHDU.from_columns([col_t], name="TIME"),
+              fits.BinTableHDU.from_columns([col_x, col_y], name="BeamXY")]).writeto(fname, overwrite=True)
+if os.path.exists(beam_major_h5_name(fname)):
+    os.remove(beam_major_h5_name(fname))
+
+results = {}
+for mode, kwargs in [('in memory', {}), ('memmap', {'memmap': True}),
+                     ('memmap + beam-major, first open', {'memmap': True, 'beam_major': True}),
+                     ('memmap + beam-major', {'memmap': True, 'beam_major': True})]:
+    cube = BFcube()
+    t0 = time.time()
+    cube.load_fits(fname, **kwargs)
+    if mode == 'in memory':
+        cube.data_cube = np.array(cube.data_cube)
+    t_load = time.time() - t0
+    t0 = time.time()
+    dyspec = [np.array(cube.data_cube[:, :, beam_idx]) for beam_idx in range(0, n_beams, n_beams // 4)]
+    t_beam = (time.time() - t0) / len(dyspec)
+    t0 = time.time()
+    images = [np.array(cube.data_cube[f_idx, t_idx, :])
+              for f_idx, t_idx in zip(range(0, n_freqs, 16), range(0, n_times, 16))]
+    t_image = (time.time() - t0) / len(images)
+    results[mode] = (dyspec, images)
+    print('%-32s load %8.3f s   one beam %8.2f ms   one image %8.3f ms'
+          % (mode, t_load, t_beam * 1e3, t_image * 1e3))
+
+for mode, (dyspec, images) in results.items():
+    assert all(np.array_equal(a, b) for a, b in zip(dyspec, results['in memory'][0]))
+    assert all(np.array_equal(a, b) for a, b in zip(images, results['in memory'][1]))
+print('cube %d x %d x %d, %.0f MB, same data in all modes'
+      % (n_freqs, n_times, n_beams, os.path.getsize(fname) / 2**20))
@@ -0,0 +1,69 @@
+"""
+Benchmark of the source localisation on the beam samples (lofarSun.BF.bflocalisation)
+
+Compare the time per (freq, time) pixel of the image based localisation
+(bf_image_by_idx, bf_peak_size and bf_fit_gauss_source_by_idx) with
+BFcube.bf_localise on the beam intensities, on simulated Gaussian sources
+moving across the beams, and check that the FWHM areas agree with the ones
+of the linearly interpolated images and that the centroid tracks recover
+the simulated ones.
+
+usage:  python benchmark_localisation.py [n_beams] [n_freqs] [n_times] [workers]
+"""
+
+import sys
+import time
+import numpy as np
+from lofarSun.BF.BFdata import BFcube
+from lofarSun.BF.bflocalisation import gauss2d_beam
+
+n_beams = int(sys.argv[1]) if len(sys.argv) > 1 else 217
+n_freqs = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+n_times = int(sys.argv[3]) if len(sys.argv) > 3 else 256
+workers = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    cube = BFcube()
+    angle = rng.uniform(0, 2*np.pi, n_beams)
+    radius = 1500*np.sqrt(rng.random(n_beams))
+    cube.xb, cube.yb = radius*np.cos(angle), radius*np.sin(angle)
+    # a burst drifting across the field of view, further out at lower frequencies
+    x_track = np.linspace(-600, 600, n_times)[None, :] * np.linspace(1, 0.5, n_freqs)[:, None]
+    y_track = np.linspace(400, -200, n_times)[None, :] * np.ones((n_freqs, 1))
+    cube.data_cube = np.array([[gauss2d_beam([100, x_track[f, t], y_track[f, t], 0.3, 350, 250], cube.xb, cube.yb)
+                                for t in range(n_times)] for f in range(n_freqs)])
+    cube.data_cube += rng.normal(0, 1, cube.data_cube.shape) + 10
+    cube.time_ds = np.linspace(18500, 18500.01, n_times)
+    cube.freqs_ds = np.linspace(30, 60, n_freqs)
+
+    n_single = min(n_times, 5)
+    t0 = time.time()
+    area_image = []
+    for t_idx in range(n_single):
+        X, Y, data_bf = cube.bf_image_by_idx(0, t_idx, fov=3000, asecpix=10,
+                                             extrap=False, interpm='linear')[:3]
+        area_image.append(cube.bf_peak_size(X, Y, np.nan_to_num(data_bf), 10)[2] * 10**2)
+    t_peak_image = (time.time() - t0) / n_single
+    t0 = time.time()
+    for t_idx in range(n_single):
+        cube.bf_fit_gauss_source_by_idx(0, t_idx, drawfig=False, verb=False)
+    t_fit_image = (time.time() - t0) / n_single
+
+    t0 = time.time()
+    res = cube.bf_localise(slice(None), slice(None), workers=workers)
+    t_beam = (time.time() - t0) / res.size
+
+    offset = np.hypot(res['x_cent'] - x_track, res['y_cent'] - y_track)
+    offset_peak = np.hypot(res['peak_x'] - x_track, res['peak_y'] - y_track)
+    area_ratio = np.array(area_image) / res['fwhm_area'][0, :n_single]
+    assert res['success'].all()
+    assert np.mean(offset < 5 * np.hypot(res['x_cent_err'], res['y_cent_err']) + 1) > 0.99
+    assert np.all(np.abs(area_ratio - 1) < 0.05)
+    print('pixels : %d (%d beams)' % (res.size, n_beams))
+    print('image peak and area : %8.2f ms/pixel' % (t_peak_image * 1e3))
+    print('image Gaussian fit  : %8.2f ms/pixel' % (t_fit_image * 1e3))
+    print('bf_localise         : %8.2f ms/pixel (workers %d)' % (t_beam * 1e3, workers))
+    print('centroid offset median %.1f asec, peak offset median %.1f asec, area image/beams %.3f-%.3f'
+          % (np.median(offset), np.median(offset_peak), np.min(area_ratio), np.max(area_ratio)))
@@ -0,0 +1,53 @@
+"""
+Benchmark of mask_extend_xy_npix
+
+Compare the separable dilation in bftools.mask_extend_xy_npix with the
+previous loop over every masked pixel, check that both give the same
+mask, for several mask densities and extension sizes.
+
+usage:  python benchmark_mask_extend.py [n_time] [n_freq]
+"""
+
+import sys
+import time
+import numpy as np
+from lofarSun.BF.bftools import mask_extend_xy_npix
+
+n_time = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+n_freq = int(sys.argv[2]) if len(sys.argv) > 2 else 640
+
+
+def mask_extend_xy_npix_loop(mask, n_pix_x, n_pix_y):
+    # the previous implementation, as reference
+    mask_extend = np.ones_like(mask)
+    for i in range(mask.shape[0]):
+        idx = np.where(1 - mask[i, :])[0]
+        for j in idx:
+            mask_extend[max(i - n_pix_y + 1, 0):min(i + n_pix_y, mask.shape[0]),
+                        max(j - n_pix_x + 1, 0):min(j + n_pix_x, mask.shape[1])] = 0
+    return mask_extend
+
+
+rng = np.random.default_rng(0)
+
+# equivalence on small masks, all the corner cases of the box
+for density in [0, 1e-3, 0.05, 0.5, 1]:
+    for n_pix_x, n_pix_y in [(0, 3), (1, 1), (2, 16), (16, 2), (5, 5), (40, 1)]:
+        for dtype in [bool, np.float64]:
+            mask = (rng.random((97, 61)) >= density).astype(dtype)
+            assert np.array_equal(mask_extend_xy_npix(mask, n_pix_x, n_pix_y),
+                                  mask_extend_xy_npix_loop(mask, n_pix_x, n_pix_y))
+print('same mask as the loop implementation')
+
+print('mask shape : ', (n_time, n_freq))
+print('%10s %12s %12s %10s' % ('density', 'loop (s)', 'dilate (s)', 'speedup'))
+for density in [1e-4, 1e-3, 1e-2, 0.05]:
+    mask = rng.random((n_time, n_freq)) >= density
+    t0 = time.time()
+    res_loop = mask_extend_xy_npix_loop(mask, 2, 16)
+    t_loop = time.time() - t0
+    t0 = time.time()
+    res = mask_extend_xy_npix(mask, 2, 16)
+    t_dilate = time.time() - t0
+    assert np.array_equal(res, res_loop)
+    print('%10.4f %12.3f %12.4f %10.1f' % (density, t_loop, t_dilate, t_loop / t_dilate))
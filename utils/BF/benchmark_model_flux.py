@@ -0,0 +1,46 @@
+"""
+Benchmark of the calibrator flux model
+
+Compare bftools.model_flux evaluated once on all the channels with the
+previous scalar implementation called channel by channel, check that both
+give the same flux for every calibrator.
+
+usage:  python benchmark_model_flux.py [n_freq]
+"""
+
+import sys
+import time
+import numpy as np
+from lofarSun.BF.bftools import model_flux, cal_flux_names, _cal_flux_params
+
+n_freq = int(sys.argv[1]) if len(sys.argv) > 1 else 6400
+freq = np.linspace(10, 90, n_freq)
+
+
+def model_flux_scalar(calibrator, frequency):
+    # the previous implementation, as reference
+    params = _cal_flux_params.get(calibrator.lower())
+    if params is None:
+        raise ValueError(f"Invalid calibrator: {calibrator}")
+    freq_GHz = frequency / 1e3
+    flux_model = sum(p * np.log10(freq_GHz) ** j for j, p in enumerate(params))
+    return 10 ** flux_model * 1e-4
+
+
+for name in cal_flux_names:
+    assert np.allclose(model_flux(name, freq),
+                       [model_flux_scalar(name, f) for f in freq], rtol=1e-12, atol=0)
+flux_all = model_flux(np.array(cal_flux_names)[:, None], freq)
+assert flux_all.shape == (len(cal_flux_names), n_freq)
+assert np.allclose(flux_all[cal_flux_names.index('casa')], model_flux('CasA', freq), rtol=1e-15, atol=0)
+print('same flux as the scalar implementation for', len(cal_flux_names), 'calibrators')
+
+t0 = time.time()
+flux_loop = np.array([model_flux_scalar('CasA', f) for f in freq])
+t_loop = time.time() - t0
+t0 = time.time()
+flux = model_flux('CasA', freq)
+t_array = time.time() - t0
+print('channels : ', n_freq)
+print('scalar loop : %10.5f s' % t_loop)
+print('array call  : %10.5f s   speedup %8.1f' % (t_array, t_loop / t_array))
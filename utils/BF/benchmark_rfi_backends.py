@@ -0,0 +1,62 @@
+"""
+Benchmark of the numpy and torch backends of downsample_h5_seg_by_time_ratio
+
+Check that the RFIconvNumpy flagger gives the same mask as the torch
+RFIconv flagger, and that the reshape-mean box average gives the same
+downsampled segment as the strided conv2d, with and without flagging.
+The convolutions are accumulated in float32 by torch and in float64 by
+SciPy, so a pixel whose filter response is within rounding of 0 may be
+flagged by one backend only, the fraction of such pixels is reported.
+Then compare the segments per second of both backends on the CPU, and
+the time to import bftools alone and together with torch.
+
+usage:  python benchmark_rfi_backends.py [n_freq] [n_segments]
+"""
+
+import sys
+import time
+import subprocess
+import numpy as np
+from lofarSun.BF import bftools
+
+n_freq = int(sys.argv[1]) if len(sys.argv) > 1 else 6400
+n_segments = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+t_c_ratio, f_c_ratio, t_idx_cut = 4, 8, 64
+agg_factor = [1.66, 1.66, 0.45, 0.45]
+
+rng = np.random.default_rng(0)
+data = (np.abs(rng.standard_normal((t_idx_cut * t_c_ratio * n_segments, n_freq))) + 1).astype(np.float32)
+data[rng.random(data.shape) < 0.005] *= 20   # impulsive RFI
+data[:, ::97] *= 3                            # narrow band RFI
+t_all = np.linspace(0, 1, data.shape[0])
+
+# same mask, up to the pixels at the rounding limit
+import torch
+flag_numpy = bftools.get_flagger(agg_factor, 'numpy')(data)
+with torch.no_grad():
+    flag_torch = bftools.get_flagger(agg_factor, 'torch', 'cpu')(
+        torch.tensor(data[None, None, :, :])).squeeze().numpy()
+flag_differ = np.mean(flag_numpy != flag_torch)
+assert flag_differ < 1e-5
+print('%.2f %% flagged, %.1e of the pixels flagged by one backend only'
+      % (100 * flag_numpy.mean(), flag_differ))
+
+res = {}
+for backend in ['torch', 'numpy']:
+    for flagging in [False, True]:
+        t0 = time.time()
+        res[backend, flagging] = bftools.downsample_h5_seg_by_time_ratio(
+            data, t_all, 0, 1, data.shape[0], t_c_ratio, f_c_ratio, flagging=flagging,
+            t_idx_cut=t_idx_cut, agg_factor=agg_factor, device='cpu', n_prefetch=0, backend=backend)[0]
+        t_run = time.time() - t0
+        print('%6s backend, flagging %5s : %8.2f segments/s' % (backend, flagging, n_segments / t_run))
+assert np.allclose(res['torch', False], res['numpy', False], rtol=1e-5)
+box_differ = np.mean(~np.isclose(res['torch', True], res['numpy', True], rtol=1e-5, equal_nan=True))
+assert box_differ < 1e-3
+print('same downsampled data from both backends, %.1e of the flagged boxes differ' % box_differ)
+
+for name, code in [('bftools', 'import lofarSun.BF.bftools'),
+                   ('bftools + torch', 'import lofarSun.BF.bftools, torch')]:
+    t0 = time.time()
+    subprocess.run([sys.executable, '-c', code], check=True)
+    print('import %16s : %6.2f s' % (name, time.time() - t0))
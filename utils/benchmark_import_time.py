@@ -0,0 +1,91 @@
+"""
+Benchmark of the start-up time of the lofarSun command line tools
+
+For every console_scripts entry point in setup.py, the module of the entry
+point is imported in a fresh interpreter with `python -X importtime`, the
+cumulative import time of the module and the wall time of the interpreter
+are reported, with the heavy dependencies loaded by the import.
+Entry points whose module cannot be imported here (e.g. casacore or PyQt5
+not installed) are reported as failed and do not count for --max-seconds.
+
+usage:  python benchmark_import_time.py [--repeat N] [--json out.json] [--max-seconds S]
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import subprocess
+from argparse import ArgumentParser
+
+repo_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+heavy_modules = ['torch', 'sunpy', 'sunpy.map', 'skimage', 'PyQt5', 'casacore', 'h5py', 'matplotlib.pyplot']
+
+
+def console_scripts(setup_path):
+    # [(name, module, function)] of the console_scripts in setup.py
+    with open(setup_path) as f:
+        setup_src = f.read()
+    return re.findall(r"['\"]\s*([\w\-]+)\s*=\s*([\w.]+)\s*:\s*(\w+)\s*['\"]", setup_src)
+
+
+def time_import(module):
+    # cumulative import time (s) of module, wall time (s), heavy modules loaded, error
+    code = ('import sys, %s; print(",".join(m for m in %r if m in sys.modules))'
+            % (module, heavy_modules))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([repo_dir] + [p for p in [env.get('PYTHONPATH')] if p])
+    t0 = time.time()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          capture_output=True, text=True, env=env, cwd=repo_dir)
+    t_wall = time.time() - t0
+    if proc.returncode != 0:
+        err_lines = [line for line in proc.stderr.splitlines() if not line.startswith('import time:')]
+        return None, t_wall, [], err_lines[-1] if err_lines else 'exit code %d' % proc.returncode
+    t_import = None
+    for line in proc.stderr.splitlines():
+        match = re.match(r'import time:\s*(\d+)\s*\|\s*(\d+)\s*\|(\s*)(\S+)', line)
+        if match and match.group(4) == module and len(match.group(3)) == 1:
+            t_import = int(match.group(2)) * 1e-6
+    loaded = [m for m in proc.stdout.strip().split(',') if m]
+    return t_import, t_wall, loaded, None
+
+
+def main():
+    parser = ArgumentParser(description='import time of the lofarSun console_scripts')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs for each entry point, the fastest is kept')
+    parser.add_argument('--json', default=None, help='write the results to this json file')
+    parser.add_argument('--max-seconds', type=float, default=None,
+                        help='exit with 1 if any entry point takes longer to import')
+    args = parser.parse_args()
+
+    results = []
+    for name, module, func in console_scripts(os.path.join(repo_dir, 'setup.py')):
+        runs = [time_import(module) for idx in range(max(args.repeat, 1))]
+        t_import, t_wall, loaded, error = min(runs, key=lambda run: run[1])
+        results.append({'entry_point': name, 'module': module, 'function': func,
+                        'import_s': t_import, 'wall_s': t_wall,
+                        'heavy_modules': loaded, 'error': error})
+        if error is None:
+            print('%-22s %-38s import %6.3f s  wall %6.3f s  [%s]'
+                  % (name, module, t_import, t_wall, ' '.join(loaded)))
+        else:
+            print('%-22s %-38s failed: %s' % (name, module, error))
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'results': results}, f, indent=2)
+
+    if args.max_seconds is not None:
+        slow = [res['entry_point'] for res in results
+                if res['error'] is None and res['import_s'] > args.max_seconds]
+        if slow:
+            print('slower than %.3f s : %s' % (args.max_seconds, ' '.join(slow)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
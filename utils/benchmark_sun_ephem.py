@@ -0,0 +1,55 @@
+"""
+Benchmark and accuracy check of the cached solar ephemeris (lofarSun.sun_ephem)
+
+Compare the time to get the solar RA, DEC and P angle of many snapshot
+times, one sunpy call per time (as j2000xy and IMdata did before) against
+the cached daily grid, and check that the interpolation error stays below
+ephem_max_error_deg over random times of n_days days.
+
+usage:  python benchmark_sun_ephem.py [n_snapshots] [n_days]
+"""
+
+import sys
+import time
+import datetime
+import numpy as np
+from sunpy.coordinates.sun import sky_position, P
+from lofarSun.sun_ephem import sun_ephem, ephem_max_error_deg
+
+n_snapshots = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+n_days = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+# snapshots of one observation, 1.2 s apart
+t_obs = [datetime.datetime(2021, 9, 6, 10, 0) + datetime.timedelta(seconds=1.2 * idx)
+         for idx in range(n_snapshots)]
+sky_position(t_obs[0], False)  # load the sunpy data files before timing
+
+t0 = time.time()
+res_sunpy = []
+for t in t_obs:
+    [RA, DEC] = sky_position(t, False)
+    res_sunpy.append([RA.degree % 360, DEC.degree, P(t).degree])
+t_sunpy = time.time() - t0
+
+t0 = time.time()
+res_cached = [sun_ephem(t) for t in t_obs]
+t_cached = time.time() - t0
+
+t0 = time.time()
+res_cached_again = [sun_ephem(t) for t in t_obs]
+t_cached_again = time.time() - t0
+
+# random times over many days, against the exact values
+rng = np.random.default_rng(0)
+t_rand = (np.datetime64('2014-01-01', 'us')
+          + (rng.random(n_days * 50) * n_days * 86400e6).astype('timedelta64[us]'))
+err = [np.max(np.abs((res - ref + 180) % 360 - 180))
+       for res, ref in zip(sun_ephem(t_rand), sun_ephem(t_rand, exact=True))]
+
+assert np.max(np.abs(np.array(res_cached) - np.array(res_sunpy))) < ephem_max_error_deg
+assert max(err) < ephem_max_error_deg
+print('snapshots : ', n_snapshots)
+print('sunpy per call   : %10.2f ms' % (t_sunpy / n_snapshots * 1e3))
+print('cached, new day  : %10.2f ms' % (t_cached / n_snapshots * 1e3))
+print('cached, memoised : %10.4f ms' % (t_cached_again / n_snapshots * 1e3))
+print('max error (deg) RA %.2e DEC %.2e P %.2e' % tuple(err))